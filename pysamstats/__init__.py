@@ -7,3 +7,4 @@ __version__ = '1.1.2'
 
 from .pileup import *
 from .binned import *
+from .native import open_stats, NativeStats
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division
+import shutil
+import struct
+import tempfile
+import zlib
+
+
+import numpy as np
+
+
+BIGWIG_MAGIC = 0x888FFC26
+BPT_MAGIC = 0x78CA8C91
+CIRTREE_MAGIC = 0x2468ACE0
+VERSION = 4
+HEADER_SIZE = 64
+ZOOM_HEADER_SIZE = 24
+SUMMARY_SIZE = 40
+
+# bedGraph section type
+SECTION_BEDGRAPH = 1
+
+# items per data or zoom block, and children per index node, as in the UCSC
+# tools
+ITEMS_PER_SLOT = 1024
+BLOCK_SIZE = 256
+
+# zoom levels summarise bins of ZOOM_REDUCTION bases, growing by
+# ZOOM_INCREMENT at each level
+MAX_ZOOM_LEVELS = 10
+ZOOM_REDUCTION = 32
+ZOOM_INCREMENT = 4
+
+item_dtype = np.dtype([('start', '<u4'), ('end', '<u4'), ('value', '<f4')])
+
+zoom_dtype = np.dtype([('chrom', '<u4'), ('start', '<u4'), ('end', '<u4'), ('valid', '<u4'),
+                       ('min', '<f4'), ('max', '<f4'), ('sum', '<f4'), ('sumsq', '<f4')])
+
+
+def _levels(n, block_size):
+    # number of nodes at each level of a tree, from the leaves up
+    counts = [max(1, -(-n // block_size))]
+    while counts[-1] > 1:
+        counts.append(-(-counts[-1] // block_size))
+    return counts
+
+
+def write_chrom_tree(f, chroms, lengths):
+    """Write a B+ tree mapping contig names to IDs and lengths, where the ID of
+    each contig is its index in `chroms`."""
+
+    items = sorted((c.encode('ascii'), i, l) for i, (c, l) in enumerate(zip(chroms, lengths)))
+    n = len(items)
+    block_size = max(1, min(BLOCK_SIZE, n))
+    key_size = max([1] + [len(k) for k, _, _ in items])
+    f.write(struct.pack('<IIIIQQ', BPT_MAGIC, block_size, key_size, 8, n, 0))
+
+    # levels are written from the root down, with every node padded to the
+    # block size
+    counts = _levels(n, block_size)
+    node_size = 4 + block_size * (key_size + 8)
+    starts = dict()
+    offset = f.tell()
+    for level in reversed(range(len(counts))):
+        starts[level] = offset
+        offset += counts[level] * node_size
+
+    for level in reversed(range(len(counts))):
+        span = block_size ** level
+        for k in range(counts[level]):
+            if level == 0:
+                node = items[k * block_size:(k + 1) * block_size]
+                f.write(struct.pack('<BBH', 1, 0, len(node)))
+                for key, i, l in node:
+                    f.write(key.ljust(key_size, b'\0') + struct.pack('<II', i, l))
+                f.write(b'\0' * (block_size - len(node)) * (key_size + 8))
+            else:
+                # children are nodes of the level below, each keyed by the
+                # first item under it
+                children = range(k * block_size, min((k + 1) * block_size, counts[level - 1]))
+                f.write(struct.pack('<BBH', 0, 0, len(children)))
+                for j in children:
+                    f.write(items[j * span][0].ljust(key_size, b'\0') +
+                            struct.pack('<Q', starts[level - 1] + j * node_size))
+                f.write(b'\0' * (block_size - len(children)) * (key_size + 8))
+
+
+def write_rtree(f, blocks, end_file_offset):
+    """Write an R tree indexing blocks, given as (chrom, start, end, offset,
+    size) tuples in genome order."""
+
+    n = len(blocks)
+    first = blocks[0][:2] if n else (0, 0)
+    last = blocks[-1][0:3:2] if n else (0, 0)
+    f.write(struct.pack('<IIQIIIIQII', CIRTREE_MAGIC, BLOCK_SIZE, n, first[0], first[1], last[0],
+                        last[1], end_file_offset, ITEMS_PER_SLOT, 0))
+
+    # levels are written from the root down, with every node padded to the
+    # block size
+    counts = _levels(n, BLOCK_SIZE)
+    leaf_size = 4 + BLOCK_SIZE * 32
+    node_size = 4 + BLOCK_SIZE * 24
+    starts = dict()
+    offset = f.tell()
+    for level in reversed(range(len(counts))):
+        starts[level] = offset
+        offset += counts[level] * (leaf_size if level == 0 else node_size)
+
+    def bounds(level, j):
+        # genome range of blocks under node j of a level
+        span = BLOCK_SIZE ** (level + 1)
+        b, e = blocks[j * span], blocks[min((j + 1) * span, n) - 1]
+        return b[0], b[1], e[0], e[2]
+
+    for level in reversed(range(len(counts))):
+        for k in range(counts[level]):
+            if level == 0:
+                node = blocks[k * BLOCK_SIZE:(k + 1) * BLOCK_SIZE]
+                f.write(struct.pack('<BBH', 1, 0, len(node)))
+                for chrom, start, end, offset, size in node:
+                    f.write(struct.pack('<IIIIQQ', chrom, start, chrom, end, offset, size))
+                f.write(b'\0' * (BLOCK_SIZE - len(node)) * 32)
+            else:
+                children = range(k * BLOCK_SIZE, min((k + 1) * BLOCK_SIZE, counts[level - 1]))
+                f.write(struct.pack('<BBH', 0, 0, len(children)))
+                for j in children:
+                    child = starts[level - 1] + j * (leaf_size if level == 1 else node_size)
+                    f.write(struct.pack('<IIIIQ', *(bounds(level - 1, j) + (child,))))
+                f.write(b'\0' * (BLOCK_SIZE - len(children)) * 24)
+
+
+def summarise(starts, ends, values, reduction):
+    """Split intervals at multiples of `reduction` and summarise the values in
+    each bin, returning arrays of bin numbers, numbers of bases covered, and
+    the minimum, maximum, sum and sum of squares of the values over those
+    bases."""
+
+    b0 = starts // reduction
+    n = (ends - 1) // reduction - b0 + 1
+    idx = np.repeat(np.arange(len(starts)), n)
+    bins = b0[idx] + np.arange(len(idx)) - np.repeat(np.cumsum(n) - n, n)
+    width = (np.minimum(ends[idx], (bins + 1) * reduction) -
+             np.maximum(starts[idx], bins * reduction)).astype('f8')
+    v = values[idx].astype('f8')
+    grp = np.concatenate([[0], np.flatnonzero(np.diff(bins)) + 1])
+    return (bins[grp], np.add.reduceat(width, grp), np.minimum.reduceat(v, grp),
+            np.maximum.reduceat(v, grp), np.add.reduceat(v * width, grp),
+            np.add.reduceat(v * v * width, grp))
+
+
+class _ZoomLevel(object):
+    # summaries of one zoom level, written as compressed blocks to a temporary
+    # file until the data section is complete
+
+    def __init__(self, reduction):
+        self.reduction = reduction
+        self.spool = tempfile.TemporaryFile()
+        self.blocks = list()
+        self.count = 0
+        self.max_block_size = 0
+        self.pending = None
+        self.records = np.empty(0, dtype=zoom_dtype)
+
+    def add(self, tid, length, starts, ends, values):
+        summary = summarise(starts, ends, values, self.reduction)
+        if self.pending is not None:
+            if summary[0][0] == self.pending[0]:
+                # same bin as the last interval added
+                summary = [s.copy() for s in summary]
+                summary[1][0] += self.pending[1]
+                summary[2][0] = min(summary[2][0], self.pending[2])
+                summary[3][0] = max(summary[3][0], self.pending[3])
+                summary[4][0] += self.pending[4]
+                summary[5][0] += self.pending[5]
+            else:
+                summary = [np.concatenate([[p], s]) for p, s in zip(self.pending, summary)]
+        # the last bin may continue
+        self.pending = tuple(s[-1] for s in summary)
+        self._emit(tid, length, *(s[:-1] for s in summary))
+
+    def flush(self, tid, length):
+        if self.pending is not None:
+            self._emit(tid, length, *([p] for p in self.pending))
+            self.pending = None
+        self._write_blocks(tid, final=True)
+
+    def _emit(self, tid, length, bins, valid, vmin, vmax, vsum, vsumsq):
+        bins = np.asarray(bins)
+        if not len(bins):
+            return
+        a = np.empty(len(bins), dtype=zoom_dtype)
+        a['chrom'] = tid
+        a['start'] = bins * self.reduction
+        a['end'] = np.minimum((bins + 1) * self.reduction, length)
+        a['valid'] = valid
+        a['min'] = vmin
+        a['max'] = vmax
+        a['sum'] = vsum
+        a['sumsq'] = vsumsq
+        self.count += len(a)
+        self.records = np.concatenate([self.records, a])
+        self._write_blocks(tid)
+
+    def _write_blocks(self, tid, final=False):
+        while len(self.records) >= ITEMS_PER_SLOT or (final and len(self.records)):
+            a, self.records = self.records[:ITEMS_PER_SLOT], self.records[ITEMS_PER_SLOT:]
+            data = a.tobytes()
+            self.max_block_size = max(self.max_block_size, len(data))
+            data = zlib.compress(data)
+            self.blocks.append((tid, int(a['start'][0]), int(a['end'][-1]), self.spool.tell(),
+                                len(data)))
+            self.spool.write(data)
+
+
+class BigWigWriter(object):
+    """Write a bigWig file from intervals added in genome order, merging
+    neighbouring intervals with equal values, and summarising values for
+    each zoom level as intervals are added.
+
+    Parameters
+    ----------
+
+    path : string
+        Output file path.
+    chroms : list of strings
+        Contigs, in genome order.
+    lengths : list of ints
+        Contig lengths.
+
+    Notes
+    -----
+    Data blocks are written as intervals are added. Zoom levels are written
+    after the data, skipping any level which doesn't at least halve the number
+    of records of the level below, as in the UCSC tools.
+
+    """
+
+    def __init__(self, path, chroms, lengths):
+        self.chroms = list(chroms)
+        self.lengths = list(lengths)
+        self._tids = dict((c, i) for i, c in enumerate(self.chroms))
+        self._file = open(path, 'wb')
+
+        # header, zoom headers and total summary are written on close
+        self._file.write(b'\0' * (HEADER_SIZE + MAX_ZOOM_LEVELS * ZOOM_HEADER_SIZE +
+                                  SUMMARY_SIZE))
+        self._chrom_tree_offset = self._file.tell()
+        write_chrom_tree(self._file, self.chroms, self.lengths)
+        self._data_offset = self._file.tell()
+        self._file.write(struct.pack('<Q', 0))
+
+        self._blocks = list()
+        self._max_block_size = 0
+        self._count = 0
+        self._zooms = [_ZoomLevel(ZOOM_REDUCTION * ZOOM_INCREMENT ** i)
+                       for i in range(MAX_ZOOM_LEVELS)]
+        self._tid = None
+        self._pending = None
+        self._items = np.empty(0, dtype=item_dtype)
+        self._summary = [0, np.inf, -np.inf, 0., 0.]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, chrom, starts, ends, values):
+        """Add intervals on a contig, with zero-based, half-open coordinates,
+        after all intervals already added."""
+
+        tid = self._tids[chrom]
+        if tid != self._tid:
+            if self._tid is not None and tid < self._tid:
+                raise ValueError('contigs are not in genome order: %r' % chrom)
+            self._flush_chrom()
+            self._tid = tid
+
+        starts = np.asarray(starts, dtype='i8')
+        ends = np.asarray(ends, dtype='i8')
+        values = np.asarray(values, dtype='f4')
+        if self._pending is not None:
+            starts, ends, values = [np.concatenate([[p], a])
+                                    for p, a in zip(self._pending, (starts, ends, values))]
+        if not len(starts):
+            return
+        if np.any(starts[1:] < ends[:-1]):
+            raise ValueError('intervals overlap or are not in order on %r' % chrom)
+
+        # merge runs of neighbouring intervals with equal values
+        breaks = np.flatnonzero((starts[1:] != ends[:-1]) | (values[1:] != values[:-1])) + 1
+        last = np.concatenate([breaks - 1, [len(starts) - 1]])
+        breaks = np.concatenate([[0], breaks])
+        starts, ends, values = starts[breaks], ends[last], values[breaks]
+
+        # the last run may continue
+        self._pending = starts[-1], ends[-1], values[-1]
+        self._write_runs(starts[:-1], ends[:-1], values[:-1])
+
+    def _write_runs(self, starts, ends, values):
+        starts, ends, values = np.asarray(starts), np.asarray(ends), np.asarray(values)
+        if not len(starts):
+            return
+        a = np.empty(len(starts), dtype=item_dtype)
+        a['start'] = starts
+        a['end'] = ends
+        a['value'] = values
+        self._items = np.concatenate([self._items, a])
+        self._write_blocks()
+
+        length = self.lengths[self._tid]
+        for zoom in self._zooms:
+            zoom.add(self._tid, length, starts, ends, values)
+
+        width = (ends - starts).astype('f8')
+        v = values.astype('f8')
+        s = self._summary
+        s[0] += int(width.sum())
+        s[1] = min(s[1], v.min())
+        s[2] = max(s[2], v.max())
+        s[3] += float((v * width).sum())
+        s[4] += float((v * v * width).sum())
+
+    def _write_blocks(self, final=False):
+        f = self._file
+        while len(self._items) >= ITEMS_PER_SLOT or (final and len(self._items)):
+            a, self._items = self._items[:ITEMS_PER_SLOT], self._items[ITEMS_PER_SLOT:]
+            data = struct.pack('<IIIIIBBH', self._tid, a['start'][0], a['end'][-1], 0, 0,
+                               SECTION_BEDGRAPH, 0, len(a)) + a.tobytes()
+            self._max_block_size = max(self._max_block_size, len(data))
+            data = zlib.compress(data)
+            self._blocks.append((self._tid, int(a['start'][0]), int(a['end'][-1]), f.tell(),
+                                 len(data)))
+            self._count += len(a)
+            f.write(data)
+
+    def _flush_chrom(self):
+        if self._tid is None:
+            return
+        if self._pending is not None:
+            self._write_runs(*([p] for p in self._pending))
+            self._pending = None
+        self._write_blocks(final=True)
+        for zoom in self._zooms:
+            zoom.flush(self._tid, self.lengths[self._tid])
+
+    def close(self):
+        """Write the index, zoom levels and header, and close the file."""
+
+        f = self._file
+        if f.closed:
+            return
+        try:
+            self._flush_chrom()
+
+            # data section
+            index_offset = f.tell()
+            write_rtree(f, self._blocks, index_offset)
+            f.seek(self._data_offset)
+            f.write(struct.pack('<Q', len(self._blocks)))
+            f.seek(0, 2)
+
+            # zoom levels
+            zoom_headers = list()
+            max_block_size = self._max_block_size
+            count = self._count
+            for zoom in self._zooms:
+                if zoom.count == 0 or zoom.count * 2 > count:
+                    # not worth reading instead of the level below
+                    continue
+                data_offset = f.tell()
+                f.write(struct.pack('<I', zoom.count))
+                base = f.tell()
+                zoom.spool.seek(0)
+                shutil.copyfileobj(zoom.spool, f)
+                zoom_index_offset = f.tell()
+                write_rtree(f, [b[:3] + (base + b[3], b[4]) for b in zoom.blocks],
+                            zoom_index_offset)
+                zoom_headers.append(struct.pack('<IIQQ', zoom.reduction, 0, data_offset,
+                                                zoom_index_offset))
+                max_block_size = max(max_block_size, zoom.max_block_size)
+                count = zoom.count
+            f.write(struct.pack('<I', BIGWIG_MAGIC))
+
+            # header, zoom headers and total summary
+            summary_offset = HEADER_SIZE + MAX_ZOOM_LEVELS * ZOOM_HEADER_SIZE
+            f.seek(0)
+            f.write(struct.pack('<IHHQQQHHQQIQ', BIGWIG_MAGIC, VERSION, len(zoom_headers),
+                                self._chrom_tree_offset, self._data_offset, index_offset, 0, 0,
+                                0, summary_offset, max_block_size, 0))
+            f.write(b''.join(zoom_headers))
+            f.seek(summary_offset)
+            bases, vmin, vmax, vsum, vsumsq = self._summary
+            if not bases:
+                vmin = vmax = 0.
+            f.write(struct.pack('<Qdddd', bases, vmin, vmax, vsum, vsumsq))
+
+        finally:
+            f.close()
+            for zoom in self._zooms:
+                zoom.spool.close()
@@ -5,6 +5,7 @@ import functools
 
 import pysamstats.opt as opt
 import pysamstats.util as util
+import pysamstats.parallel as parallel
 import pysamstats.config as config
 
 
@@ -23,6 +24,11 @@ _doc_params = """
         Start position.
     end : int
         End position.
+    regions : string or list of tuples, optional
+        BED file path, or list of (chrom, start, end) tuples in the coordinate system given by
+        `one_based`, selecting several regions instead of `chrom`, `start` and `end`. Regions are
+        sorted and merged, then walked in genome order in a single pass, with bins aligned to the
+        start of each region.
     one_based : bool
         Coordinate system, False if zero-based (default), True if one-based.
     window_size : int
@@ -33,7 +39,10 @@ _doc_params = """
         Only reads with mapping quality equal to or greater than this value will be counted (0
         by default).
     no_dup : bool, optional
-        If True, don't count reads flagged as duplicate."""
+        If True, don't count reads flagged as duplicate.
+    n_jobs : int, optional
+        Number of processes to use (1 by default, -1 for all CPUs). If greater than 1, contigs
+        are computed in parallel and merged back in genome order."""
 
 
 
@@ -48,26 +57,66 @@ def stat_binned(type,
                 window_size=300,
                 window_offset=None,
                 min_mapq=0,
-                no_dup=False):
+                no_dup=False,
+                n_jobs=1,
+                batch_size=None,
+                regions=None,
+                record_type='dict'):
     """Generate statistics per genome window, based on all reads whose alignment starts within
     the window.
     {params}
+    batch_size : int, optional
+        If given, generate numpy structured arrays each holding records for up to this many
+        windows, instead of one dict per window.
+    record_type : {{'dict', 'tuple'}}, optional
+        If 'tuple', generate one tuple per window instead of a dict, holding the fields in the
+        order of the default dtype. Ignored if `batch_size` is given.
 
     Returns
     -------
     recs : iterator
-        An iterator yielding dict objects, where each dict holds data for a single window.
+        An iterator yielding dict objects, where each dict holds data for a single window, or
+        tuples if `record_type` is 'tuple', or structured arrays if `batch_size` is given.
 
     """
 
+    if record_type not in ('dict', 'tuple'):
+        raise ValueError('unsupported record type: %r' % record_type)
+
     try:
         stat = stats_classes_binned[type]()
     except KeyError:
         raise ValueError('unsupported statistics type: %r' % type)
 
+    if parallel.determine_n_jobs(n_jobs) > 1:
+        # bins are aligned to the start of the region, so shard by whole contigs
+        return parallel.stat_sharded(functools.partial(stat_binned, type), alignmentfile,
+                                     fafile=fafile, n_jobs=n_jobs, split=False, chrom=chrom,
+                                     start=start, end=end, regions=regions, one_based=one_based,
+                                     window_size=window_size, window_offset=window_offset,
+                                     min_mapq=min_mapq, no_dup=no_dup, batch_size=batch_size,
+                                     record_type=record_type)
+
+    if batch_size is not None:
+        dtype = util.determine_dtype(getattr(config, 'dtype_' + type + '_binned'), alignmentfile)
+        return opt.iter_binned_batches(stat, alignmentfile=alignmentfile, fafile=fafile,
+                                       chrom=chrom, start=start, end=end, regions=regions,
+                                       one_based=one_based, window_size=window_size,
+                                       window_offset=window_offset,
+                                       min_mapq=min_mapq, no_dup=no_dup, batch_size=batch_size,
+                                       dtype=dtype)
+
+    if record_type == 'tuple':
+        return opt.iter_binned_rows(stat, alignmentfile=alignmentfile, fafile=fafile,
+                                    chrom=chrom, start=start, end=end, regions=regions,
+                                    one_based=one_based, window_size=window_size,
+                                    window_offset=window_offset, min_mapq=min_mapq,
+                                    no_dup=no_dup)
+
     return opt.iter_binned(stat, alignmentfile=alignmentfile, fafile=fafile, chrom=chrom,
-                           start=start, end=end, one_based=one_based, window_size=window_size,
-                           window_offset=window_offset, min_mapq=min_mapq, no_dup=no_dup)
+                           start=start, end=end, regions=regions, one_based=one_based,
+                           window_size=window_size, window_offset=window_offset,
+                           min_mapq=min_mapq, no_dup=no_dup)
 
 
 stat_binned.__doc__ = stat_binned.__doc__.format(params=_doc_params)
@@ -86,7 +135,9 @@ def load_binned(type,
                 min_mapq=0,
                 no_dup=False,
                 dtype=None,
-                fields=None):
+                fields=None,
+                n_jobs=1,
+                regions=None):
     """Load statistics per genome window, based on all reads whose alignment starts within
     the window.
     {params}
@@ -102,15 +153,21 @@ def load_binned(type,
 
     """
 
-    statfun = functools.partial(stat_binned, type)
     try:
         default_dtype = getattr(config, 'dtype_' + type + '_binned')
-    except KeyError:
+        stat = stats_classes_binned[type]()
+    except (AttributeError, KeyError):
         raise ValueError('unsupported statistics type: %r' % type)
 
-    return util.load_stats(statfun, user_dtype=dtype, default_dtype=default_dtype,
+    if parallel.determine_n_jobs(n_jobs) > 1:
+        loadfun = functools.partial(parallel.load_sharded, functools.partial(stat_binned, type),
+                                    n_jobs=n_jobs, split=False)
+    else:
+        loadfun = functools.partial(opt.load_binned, stat)
+
+    return util.load_stats(loadfun, user_dtype=dtype, default_dtype=default_dtype,
                            user_fields=fields, alignmentfile=alignmentfile, fafile=fafile,
-                           chrom=chrom, start=start, end=end, one_based=one_based,
+                           chrom=chrom, start=start, end=end, regions=regions, one_based=one_based,
                            window_size=window_size, window_offset=window_offset,
                            min_mapq=min_mapq, no_dup=no_dup)
 
@@ -1,25 +1,176 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, division
-import itertools
+import functools
 import time
 import csv
 import sys
+import os
+import json
+import collections
+
+
+from pysam import AlignmentFile
 
 
 import pysamstats
-from pysamstats.util import flatten, determine_max_seqid
+import pysamstats.opt as opt
+from pysamstats.util import select, determine_dtype, merge_dtypes
 import pysamstats.config as config
 
 
+def _lookup_stats(stats_type):
+    """Look up the statistics function and default dtype for a statistics type,
+    or for a list of pileup statistics types to compute in a single pass."""
+
+    if isinstance(stats_type, (list, tuple)):
+        stats_function = functools.partial(pysamstats.stat_pileup, list(stats_type))
+        default_dtype = merge_dtypes([getattr(config, 'dtype_' + t) for t in stats_type])
+    else:
+        stats_function = getattr(pysamstats, 'stat_' + stats_type)
+        default_dtype = getattr(config, 'dtype_' + stats_type)
+
+    return stats_function, default_dtype
+
+
+def _field_kwargs(stats_type, fields, kwargs):
+    """Pass the selected fields down to pileup statistics functions, so only
+    those fields are computed."""
+
+    if isinstance(stats_type, (list, tuple)) or not stats_type.endswith('_binned'):
+        return dict(kwargs, fields=fields)
+    return kwargs
+
+
+def _row_fields(stats_type, fields, default_dtype):
+    """Names of the items in each tuple record generated by the statistics
+    function, given the fields passed down by `_field_kwargs`."""
+
+    names = [t[0] for t in default_dtype]
+    if isinstance(stats_type, (list, tuple)) or not stats_type.endswith('_binned'):
+        names = [f for f in names if f in ('chrom', 'pos') or f in fields]
+    return names
+
+
+def _unquoted(dialect, fields, alignmentfile):
+    """Whether no value needs quoting in the given CSV dialect, so rows can be
+    formatted by the text writer with the same output as the csv module."""
+
+    if dialect.quoting not in (csv.QUOTE_MINIMAL, csv.QUOTE_NONE) or len(fields) < 2:
+        return False
+    if 'chrom' in fields:
+        special = set(dialect.delimiter + dialect.lineterminator + '\r\n' +
+                      (dialect.quotechar or '') + (dialect.escapechar or ''))
+        if isinstance(alignmentfile, str):
+            alignmentfile = AlignmentFile(alignmentfile)
+        for chrom in alignmentfile.references:
+            if special.intersection(chrom) or not all(ord(c) < 128 for c in chrom):
+                return False
+    return True
+
+
+def _load_checkpoint(path, state):
+    """Read a checkpoint file, checking it was written for the same statistics
+    type and fields as `state`."""
+
+    with open(path) as f:
+        saved = json.load(f)
+    for k in state:
+        if saved.get(k) != state[k]:
+            raise ValueError('checkpoint %r was written with a different %s: %r'
+                             % (path, k, saved.get(k)))
+    return saved
+
+
+def _save_checkpoint(path, state):
+    """Atomically replace a checkpoint file."""
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _resume_kwargs(stats_type, alignmentfile, chrom, pos, kwargs):
+    """Statistics function arguments selecting the records after the last
+    record written before a checkpoint, at position `pos` of `chrom`.
+
+    Regions before `chrom` are dropped. For pileup statistics the region
+    holding `chrom` is moved to start after `pos`, keeping its last base so
+    that records past the end of the region are still generated if not
+    truncated. Binned statistics restart from the start of the region, so that
+    bins stay aligned. Either way, some records may already have been written,
+    see `_skip_written`.
+
+    """
+
+    if not isinstance(alignmentfile, AlignmentFile):
+        alignmentfile = AlignmentFile(alignmentfile)
+    one_based = kwargs.get('one_based', False)
+
+    # regions in zero-based coordinates, as selected by the arguments
+    if kwargs.get('regions') is not None:
+        regions = opt.normalise_regions(alignmentfile, kwargs['regions'], one_based)
+    elif kwargs.get('chrom') is None:
+        regions = [(c, 0, l) for c, l in zip(alignmentfile.references, alignmentfile.lengths)]
+    else:
+        start, end = opt.normalise_coords(alignmentfile, kwargs['chrom'], kwargs.get('start'),
+                                          kwargs.get('end'), one_based)
+        regions = [(kwargs['chrom'], start, end)]
+
+    binned = not isinstance(stats_type, (list, tuple)) and stats_type.endswith('_binned')
+    tids = dict((c, i) for i, c in enumerate(alignmentfile.references))
+    offset = 1 if one_based else 0
+    remaining = list()
+    for c, s, e in regions:
+        if tids[c] < tids[chrom]:
+            continue
+        if tids[c] == tids[chrom] and not binned:
+            s = max(s, min(pos - offset + 1, e - 1))
+        remaining.append((c, s + offset, e + offset))
+
+    return dict(kwargs, chrom=None, start=None, end=None, regions=remaining)
+
+
+def _skip_written(batches, chrom, pos):
+    """Drop records up to and including position `pos` of `chrom` from batches
+    of records."""
+
+    chrom = chrom.encode('ascii')
+    for a in batches:
+        a = a[(a['chrom'] != chrom) | (a['pos'] > pos)]
+        if len(a):
+            yield a
+
+
+def _checkpointed(chunks, save, interval):
+    """Pass through (chrom, chunk) tuples, calling `save` with the chrom and pos
+    of the last record of the previous chunk, once it has been written, at
+    most every `interval` seconds."""
+
+    before = time.time()
+    last = None
+    for c, a in chunks:
+        if last is not None and time.time() - before >= interval:
+            save(last['chrom'].decode('ascii'), int(last['pos']))
+            before = time.time()
+        yield c, a
+        if len(a):
+            last = a[-1]
+
+
 def write_csv(stats_type, outfile, alignmentfile, fields=None, dialect='excel-tab',
-              write_header=True, progress=None, **kwargs):
+              write_header=True, progress=None, bgzf=False, tabix=True, threads=1,
+              checkpoint=None, resume=False, checkpoint_interval=60, **kwargs):
     """Write statistics output to a CSV file.
 
     Parameters
     ----------
 
-    stats_type : string
-        Statistics type, one of 'coverage', 'coverage_ext', etc.
+    stats_type : string or list of strings
+        Statistics type, one of 'coverage', 'coverage_ext', etc., or a list of
+        pileup statistics types to compute in a single pass.
     outfile : file-like
         Output file to write to.
     alignmentfile : pysam.AlignmentFile or string
@@ -32,55 +183,156 @@ def write_csv(stats_type, outfile, alignmentfile, fields=None, dialect='excel-ta
         If True write a header row.
     progress : int
         Log progress to stderr every N rows.
+    bgzf : bool
+        If True, `outfile` is a file path, and output is compressed in BGZF
+        format as it is written, like bgzip.
+    tabix : bool
+        If True and `bgzf` is True, build a tabix index on the chrom and pos
+        fields as output is written, saved to `outfile` + '.tbi'.
+    threads : int
+        Number of threads to use for BGZF compression.
+    checkpoint : string
+        Path to a checkpoint file, recording the last record written and the
+        byte offset in `outfile` after it, which must then be a real file.
+    resume : bool
+        If True and `checkpoint` exists, truncate `outfile` at the offset
+        recorded there and write only the records after the last record
+        recorded. The file must be opened for reading and writing.
+    checkpoint_interval : float
+        Minimum number of seconds between checkpoints.
     **kwargs
         Passed through to the statistics function.
 
+    Notes
+    -----
+    Checkpoints require output in a CSV dialect that doesn't quote values,
+    and are not supported with `bgzf`.
+
     """
 
     # lookup stats function
-    stats_function = getattr(pysamstats, 'stat_' + stats_type)
+    stats_function, default_dtype = _lookup_stats(stats_type)
 
     # determine field names
     if fields is None:
-        dtype = getattr(config, 'dtype_' + stats_type)
-        fields = [t[0] for t in dtype]
-
-    # setup record generator
-    recs = stats_function(alignmentfile, **kwargs)
+        fields = [t[0] for t in default_dtype]
 
-    # flatten records to rows
-    rows = flatten(recs, *fields)
+    if bgzf:
+        if checkpoint is not None:
+            raise ValueError('checkpoints are not supported with bgzf output')
+        if tabix:
+            if 'chrom' not in fields or 'pos' not in fields:
+                raise ValueError('tabix index requires the chrom and pos fields')
+            if not _unquoted(csv.get_dialect(dialect) if isinstance(dialect, str) else dialect,
+                             fields, alignmentfile):
+                raise ValueError('tabix index requires output without quoted values')
+        with opt.BgzfWriter(outfile, threads=threads, index=tabix,
+                            seq_col=fields.index('chrom') + 1 if tabix else 1,
+                            pos_col=fields.index('pos') + 1 if tabix else 2,
+                            one_based=kwargs.get('one_based', False),
+                            skip=1 if write_header else 0) as bgzf_file:
+            write_csv(stats_type, bgzf_file, alignmentfile, fields=fields, dialect=dialect,
+                      write_header=write_header, progress=progress, **kwargs)
+        return
 
     # initialise writer
     writer = csv.writer(outfile, dialect=dialect)
+    unquoted = _unquoted(writer.dialect, fields, alignmentfile)
+
+    if checkpoint is not None:
+        if not unquoted:
+            raise ValueError('checkpoints require output without quoted values')
+        title = ','.join(stats_type) if isinstance(stats_type, (list, tuple)) else stats_type
+        state = dict(type=title, fields=fields)
+        saved = None
+        if resume and os.path.exists(checkpoint):
+            saved = _load_checkpoint(checkpoint, state)
+        if saved is not None:
+            if saved.get('complete'):
+                return
+            # discard anything written after the checkpoint, header included
+            outfile.seek(saved['offset'])
+            outfile.truncate()
+            write_header = False
+            if saved['chrom'] is not None:
+                kwargs = _resume_kwargs(stats_type, alignmentfile, saved['chrom'],
+                                        saved['pos'], kwargs)
+
+        def save(chrom, pos, complete=False):
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            _save_checkpoint(checkpoint, dict(state, chrom=chrom, pos=pos,
+                                              offset=outfile.tell(), complete=complete))
 
     # write header row
     if write_header:
         writer.writerow(fields)
 
-    if progress is None:
+    if unquoted:
+
+        # format whole batches of records as text
+        batch_size = min(progress, 2**16) if progress else 2**16
+        batches = stats_function(alignmentfile, batch_size=batch_size,
+                                 **_field_kwargs(stats_type, fields, kwargs))
+        text_writer = opt.TextWriter(outfile, fields, delimiter=writer.dialect.delimiter,
+                                     lineterminator=writer.dialect.lineterminator)
+
+        if checkpoint is not None:
+            if saved is not None and saved['chrom'] is not None:
+                batches = _skip_written(batches, saved['chrom'], saved['pos'])
+            else:
+                save(None, None)
+            batches = (a for _, a in _checkpointed(((None, a) for a in batches), save,
+                                                   checkpoint_interval))
+
+        counts = (text_writer.write(a) for a in batches)
+
+    else:
+
+        # setup row generator
+        recs = stats_function(alignmentfile, record_type='tuple',
+                              **_field_kwargs(stats_type, fields, kwargs))
+
+        # select fields from rows
+        rows = select(recs, _row_fields(stats_type, fields, default_dtype), *fields)
+        if len(fields) == 1:
+            rows = ((row,) for row in rows)
+
         # N.B., don't use writer.writerows(recs)!
-        for row in rows:
-            writer.writerow(row)
+        counts = (writer.writerow(row) and 1 for row in rows)
+
+    _consume(counts, progress)
+
+    if checkpoint is not None:
+        save(None, None, complete=True)
+
+
+def _consume(counts, progress):
+    """Consume an iterator of numbers of rows written, logging progress to
+    stderr every `progress` rows if given."""
+
+    if progress is None:
+        for _ in counts:
+            pass
 
     else:
         counter = 0
-        modulus = progress
+        counter_before = 0
         before = time.time()
         before_all = before
-        for row in rows:
-            counter += 1
-            writer.writerow(row)
-            if counter % modulus == 0:
+        for n in counts:
+            counter += n
+            if counter % progress < n:
                 after = time.time()
                 elapsed = after - before_all
                 batch_elapsed = after - before
                 msg = '[pysamstats] %s rows in %.2fs (%d rows/s); batch in ' \
                       '%.2fs (%d rows/s)' \
                       % (counter, elapsed, counter / elapsed, batch_elapsed,
-                         progress / batch_elapsed)
+                         (counter - counter_before) / batch_elapsed)
                 print(msg, file=sys.stderr)
                 before = after
+                counter_before = counter
         after_all = time.time()
         elapsed_all = after_all - before_all
         msg = '[pysamstats] %s rows in %.2fs (%d rows/s)' \
@@ -88,15 +340,46 @@ def write_csv(stats_type, outfile, alignmentfile, fields=None, dialect='excel-ta
         print(msg, file=sys.stderr)
 
 
+def _contig_chunks(batches, chunk_size):
+    """Regroup structured arrays of records into chunks of up to `chunk_size`
+    records from a single contig, yielding (chrom, chunk) tuples."""
+
+    import numpy as np
+
+    chrom = None
+    pending = list()
+    n = 0
+    for a in batches:
+        while len(a):
+            c = a['chrom'][0]
+            if c != chrom and pending:
+                yield chrom, np.concatenate(pending)
+                pending, n = list(), 0
+            chrom = c
+            # number of records from this contig, up to the end of the chunk
+            other = np.flatnonzero(a['chrom'] != c)
+            k = min(other[0] if len(other) else len(a), chunk_size - n)
+            pending.append(a[:k])
+            n += k
+            a = a[k:]
+            if n == chunk_size:
+                yield chrom, np.concatenate(pending)
+                pending, n = list(), 0
+    if pending:
+        yield chrom, np.concatenate(pending)
+
+
 def write_hdf5(stats_type, outfile, alignmentfile, fields=None, progress=None, hdf5_group='/',
                hdf5_dataset='data', hdf5_complevel=1, hdf5_complib='zlib', hdf5_shuffle=True,
-               hdf5_fletcher32=False, hdf5_chunksize=2**20, dtype=None, **kwargs):
+               hdf5_fletcher32=False, hdf5_chunksize=2**20, hdf5_per_contig=False, threads=1,
+               dtype=None, checkpoint=None, resume=False, checkpoint_interval=60, **kwargs):
     """Write statistics output to an HDF5 file. Requires PyTables.
 
     Parameters
     ----------
-    stats_type : string
-        Statistics type, one of 'coverage', 'coverage_ext', etc.
+    stats_type : string or list of strings
+        Statistics type, one of 'coverage', 'coverage_ext', etc., or a list of
+        pileup statistics types to compute in a single pass.
     outfile : string
         Output file path.
     alignmentfile : pysam.AlignmentFile or string
@@ -110,7 +393,7 @@ def write_hdf5(stats_type, outfile, alignmentfile, fields=None, progress=None, h
     hdf5_dataset : string
         Name of dataset to create.
     hdf5_complib : string
-        Name of compression library (defaults to 'zlib').
+        Name of compression library (defaults to 'zlib'), e.g., 'blosc:lz4'.
     hdf5_complevel : int
         Compression level.
     hdf5_chunksize : int
@@ -119,8 +402,23 @@ def write_hdf5(stats_type, outfile, alignmentfile, fields=None, progress=None, h
         If True, use byte shuffle filter.
     hdf5_fletcher32 : bool
         If True, use fletcher 32 filter.
+    hdf5_per_contig : bool
+        If True, write one dataset per contig, named after the contig and
+        without the chrom field, under a group named `hdf5_dataset`, with an
+        index on the pos field.
+    threads : int
+        Number of threads to use for Blosc compression.
     dtype : dict
         Override dtype.
+    checkpoint : string
+        Path to a checkpoint file, recording the last record written and the
+        number of rows in the dataset holding it.
+    resume : bool
+        If True and `checkpoint` exists, truncate the output at the number of
+        rows recorded there and append only the records after the last record
+        recorded.
+    checkpoint_interval : float
+        Minimum number of seconds between checkpoints.
     **kwargs
         Passed through to the statistics function.
 
@@ -128,7 +426,8 @@ def write_hdf5(stats_type, outfile, alignmentfile, fields=None, progress=None, h
     -----
     The length of the chunks in number of items is calculated by dividing the
     chunk size in number of bytes by the size of each row in number of bytes as
-    determined from the dtype.
+    determined from the dtype. Records are computed in batches of the same
+    length, which are appended as arrays.
 
     """
 
@@ -136,109 +435,570 @@ def write_hdf5(stats_type, outfile, alignmentfile, fields=None, progress=None, h
     import numpy as np
     h5file = None
 
-    # lookup stats function
-    stats_function = getattr(pysamstats, 'stat_' + stats_type)
-
-    # lookup default dtype
-    default_dtype = getattr(config, 'dtype_' + stats_type)
+    # lookup stats function and default dtype
+    stats_function, default_dtype = _lookup_stats(stats_type)
 
     # determine field names
     if fields is None:
         fields = [t[0] for t in default_dtype]
+    if hdf5_per_contig:
+        # chrom is given by the dataset
+        fields = [f for f in fields if f != 'chrom']
 
     # determine dtype
-    default_dtype = dict(default_dtype)
-    max_seqid_len = determine_max_seqid(alignmentfile)
-    default_dtype["chrom"] = "a{0}".format(max_seqid_len)
-
-    # update if user passed
-    if dtype is not None:
-        default_dtype.update(dict(dtype))
-    dtype = default_dtype
-
-    # fields
-    if len(fields) == 1:
-        dtype = dtype[fields[0]]
-    else:
-        dtype = [(f, dtype[f]) for f in fields]
-    dtype = np.dtype(dtype)
+    dtype = dict(determine_dtype(default_dtype, alignmentfile, dtype))
+
+    # fields, as a table even if there is only one
+    dtype = np.dtype([(f, dtype[f]) for f in fields])
+
+    # determine chunk shape
+    hdf5_chunklen = int(hdf5_chunksize/dtype.itemsize)
+    hdf5_chunkshape = (hdf5_chunklen,)
+
+    title = ','.join(stats_type) if isinstance(stats_type, (list, tuple)) else stats_type
+    group = hdf5_group.rstrip('/') + '/' + hdf5_dataset
+
+    saved = None
+    if checkpoint is not None:
+        state = dict(type=title, fields=fields, hdf5_group=hdf5_group,
+                     hdf5_dataset=hdf5_dataset, hdf5_per_contig=hdf5_per_contig)
+        if resume and os.path.exists(checkpoint):
+            saved = _load_checkpoint(checkpoint, state)
+            if saved.get('complete'):
+                return
+            if saved['chrom'] is None:
+                # nothing to keep
+                saved = None
+            else:
+                if isinstance(alignmentfile, str):
+                    alignmentfile = AlignmentFile(alignmentfile)
+                kwargs = _resume_kwargs(stats_type, alignmentfile, saved['chrom'],
+                                        saved['pos'], kwargs)
+
+        def save(chrom, pos, complete=False):
+            rows = 0
+            if chrom is not None:
+                if hdf5_per_contig:
+                    rows = h5file.get_node(group, chrom).nrows
+                else:
+                    rows = h5file.get_node(hdf5_group, hdf5_dataset).nrows
+            h5file.flush()
+            _save_checkpoint(checkpoint, dict(state, chrom=chrom, pos=pos, rows=int(rows),
+                                              complete=complete))
 
     # setup record generator
-    recs = stats_function(alignmentfile, **kwargs)
-
-    # flatten records to rows
-    rows = flatten(recs, *fields)
+    batches = stats_function(alignmentfile, batch_size=hdf5_chunklen,
+                             **_field_kwargs(stats_type, fields, kwargs))
+    if saved is not None:
+        batches = _skip_written(batches, saved['chrom'], saved['pos'])
+    if hdf5_per_contig:
+        chunks = _contig_chunks(batches, hdf5_chunklen)
+    else:
+        chunks = ((None, a) for a in batches)
+    if checkpoint is not None:
+        chunks = _checkpointed(chunks, save, checkpoint_interval)
+    filters = tables.Filters(complevel=hdf5_complevel, complib=hdf5_complib,
+                             shuffle=hdf5_shuffle, fletcher32=hdf5_fletcher32)
+    if hdf5_complib.startswith('blosc'):
+        tables.set_blosc_max_threads(threads)
+
+    def create_table(where, name):
+        # replace any existing node at that location
+        try:
+            h5file.remove_node(where, name, recursive=True)
+        except tables.NoSuchNodeError:
+            pass
+        return h5file.create_table(where, name, dtype, title=title, filters=filters,
+                                   createparents=True, chunkshape=hdf5_chunkshape)
+
+    def index(table):
+        if table is not None and 'pos' in fields and not table.cols.pos.is_indexed:
+            table.cols.pos.create_index(kind='ultralight')
+
+    def append_chunks():
+        chrom = None
+        h5table = None
+        if saved is not None:
+            # discard anything written after the checkpoint
+            if not hdf5_per_contig:
+                h5table = h5file.get_node(hdf5_group, hdf5_dataset)
+            else:
+                tids = dict((c, i) for i, c in enumerate(alignmentfile.references))
+                for node in list(h5file.get_node(group)):
+                    if tids[node._v_name] > tids[saved['chrom']]:
+                        node._f_remove()
+                chrom = saved['chrom'].encode('ascii')
+                h5table = h5file.get_node(group, saved['chrom'])
+                # the contig may have been finished and indexed, in which case
+                # the index is rebuilt when it is finished again
+                if 'pos' in fields and h5table.cols.pos.is_indexed:
+                    h5table.cols.pos.remove_index()
+            h5table.truncate(saved['rows'])
+        elif not hdf5_per_contig:
+            h5table = create_table(hdf5_group, hdf5_dataset)
+        else:
+            try:
+                h5file.remove_node(group, recursive=True)
+            except tables.NoSuchNodeError:
+                pass
+
+        for c, a in chunks:
+
+            if hdf5_per_contig and c != chrom:
+                # start a new dataset
+                index(h5table)
+                chrom = c
+                h5table = create_table(group, chrom.decode('ascii'))
+
+            # convert to output dtype
+            b = np.empty(len(a), dtype=dtype)
+            for f in fields:
+                b[f] = a[f]
+            h5table.append(b)
+            yield len(b)
+
+        if hdf5_per_contig:
+            index(h5table)
 
     try:
 
         # open output file
         h5file = tables.open_file(outfile, mode='a')
 
-        # determine chunk shape
-        hdf5_chunklen = int(hdf5_chunksize/dtype.itemsize)
-        hdf5_chunkshape = (hdf5_chunklen,)
+        if checkpoint is not None and saved is None:
+            save(None, None)
 
-        # replace any existing node at that location
-        try:
-            h5file.remove_node(hdf5_group, hdf5_dataset)
-        except tables.NoSuchNodeError:
-            pass
+        # append chunk at a time
+        _consume(append_chunks(), progress)
 
-        # create dataset
-        h5table = h5file.create_table(
-            hdf5_group, hdf5_dataset, dtype,
-            title=stats_type,
-            filters=tables.Filters(complevel=hdf5_complevel,
-                                   complib=hdf5_complib,
-                                   shuffle=hdf5_shuffle,
-                                   fletcher32=hdf5_fletcher32),
-            createparents=True,
-            chunkshape=hdf5_chunkshape)
-
-        # record initial time
-        counter = 0
-        counter_before = 0
-        before = time.time()
-        before_all = before
+        if checkpoint is not None:
+            save(None, None, complete=True)
 
-        # load data in batches of size `hdf5_chunklen`
-        chunk = list(itertools.islice(rows, hdf5_chunklen))
+    finally:
+        if h5file is not None:
+            h5file.close()
 
-        # load chunk at a time
-        while chunk:
 
-            # write chunk
-            h5table.append(chunk)
-            h5table.flush()
+def write_parquet(stats_type, outfile, alignmentfile, fields=None, progress=None,
+                  parquet_row_group_size=2**20, parquet_compression='snappy', dtype=None,
+                  **kwargs):
+    """Write statistics output to a Parquet file. Requires pyarrow.
 
-            # keep track of number of records loaded
-            n = len(chunk)  # may be shorter than chunklen if final batch
-            counter += n
+    Parameters
+    ----------
+    stats_type : string or list of strings
+        Statistics type, one of 'coverage', 'coverage_ext', etc., or a list of
+        pileup statistics types to compute in a single pass.
+    outfile : string
+        Output file path.
+    alignmentfile : pysam.AlignmentFile or string
+        Input BAM or SAM file or file path.
+    fields : list of strings
+        List of field names to output (all by default).
+    progress : int
+        Log progress to stderr approximately every N rows.
+    parquet_row_group_size : int
+        Maximum number of rows in each row group.
+    parquet_compression : string
+        Name of compression codec, e.g., 'snappy', 'zstd' or 'none'.
+    dtype : dict
+        Override dtype.
+    **kwargs
+        Passed through to the statistics function.
 
-            # log progress
-            if progress and (counter % progress) < hdf5_chunklen:
-                after = time.time()
-                elapsed = after - before_all
-                batch_elapsed = after - before
-                batch_size = counter - counter_before
-                msg = '[pysamstats] %s rows in %.2fs (%d rows/s); last %s ' \
-                      'rows in %.2fs (%d rows/s)' \
-                      % (counter, elapsed, counter / elapsed,
-                         batch_size, batch_elapsed, batch_size / batch_elapsed)
-                print(msg, file=sys.stderr)
-                before = after
-                counter_before = counter
+    Notes
+    -----
+    Row groups never span more than one contig. The chrom field is dictionary
+    encoded, with all contigs in the alignment file as the dictionary.
+
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import numpy as np
+
+    # lookup stats function and default dtype
+    stats_function, default_dtype = _lookup_stats(stats_type)
 
-            # load next batch
-            chunk = list(itertools.islice(rows, hdf5_chunklen))
+    # determine field names
+    if fields is None:
+        fields = [t[0] for t in default_dtype]
 
-        if progress:
-            after_all = time.time()
-            elapsed_all = after_all - before_all
-            msg = '[pysamstats] %s rows in %.2fs (%d rows/s)' \
-                  % (counter, elapsed_all, counter / elapsed_all)
-            print(msg, file=sys.stderr)
+    # determine dtype
+    dtype = dict(determine_dtype(default_dtype, alignmentfile, dtype))
+
+    # determine schema
+    if isinstance(alignmentfile, str):
+        alignmentfile = AlignmentFile(alignmentfile)
+    chroms = pa.array(alignmentfile.references, type=pa.string())
+    tids = dict((c.encode('ascii'), i) for i, c in enumerate(alignmentfile.references))
+    schema = list()
+    for f in fields:
+        if f == 'chrom':
+            schema.append((f, pa.dictionary(pa.int32(), pa.string())))
+        elif np.dtype(dtype[f]).kind == 'S':
+            schema.append((f, pa.string()))
+        else:
+            schema.append((f, pa.from_numpy_dtype(np.dtype(dtype[f]))))
+    title = ','.join(stats_type) if isinstance(stats_type, (list, tuple)) else stats_type
+    schema = pa.schema(schema, metadata={'pysamstats_type': title})
+
+    def to_table(chrom, a):
+        columns = list()
+        for f in fields:
+            if f == 'chrom':
+                indices = pa.array(np.full(len(a), tids[chrom], dtype='i4'))
+                columns.append(pa.DictionaryArray.from_arrays(indices, chroms))
+            elif np.dtype(dtype[f]).kind == 'S':
+                columns.append(pa.array(np.char.decode(a[f].astype(dtype[f]), 'ascii')))
+            else:
+                columns.append(pa.array(a[f].astype(dtype[f], copy=False)))
+        return pa.Table.from_arrays(columns, schema=schema)
 
+    # setup record generator
+    batches = stats_function(alignmentfile, batch_size=min(parquet_row_group_size, 2**16),
+                             **_field_kwargs(stats_type, fields, kwargs))
+
+    writer = pq.ParquetWriter(outfile, schema, compression=parquet_compression)
+    try:
+        counts = (writer.write_table(to_table(chrom, a), row_group_size=len(a)) or len(a)
+                  for chrom, a in _contig_chunks(batches, parquet_row_group_size))
+        _consume(counts, progress)
     finally:
-        if h5file is not None:
-            h5file.close()
+        writer.close()
+
+
+def write_zarr(stats_type, outfile, alignmentfile, fields=None, progress=None, zarr_group='/',
+               zarr_chunklen=2**16, zarr_compressor='default', threads=1, dtype=None, **kwargs):
+    """Write statistics output to a Zarr store, with one group per contig
+    holding one array per field. Requires zarr.
+
+    Parameters
+    ----------
+    stats_type : string or list of strings
+        Statistics type, one of 'coverage', 'coverage_ext', etc., or a list of
+        pileup statistics types to compute in a single pass.
+    outfile : string or zarr store
+        Output directory path or store.
+    alignmentfile : pysam.AlignmentFile or string
+        Input BAM or SAM file or file path.
+    fields : list of strings
+        List of field names to output (all by default).
+    progress : int
+        Log progress to stderr approximately every N rows.
+    zarr_group : string
+        Group to write contig groups to.
+    zarr_chunklen : int
+        Length of chunks in number of items.
+    zarr_compressor : numcodecs codec
+        Compressor, or 'default' for the zarr default compressor.
+    threads : int
+        Number of threads to use for compressing and writing chunks.
+    dtype : dict
+        Override dtype.
+    **kwargs
+        Passed through to the statistics function.
+
+    Notes
+    -----
+    Records are computed in batches of `zarr_chunklen` and regrouped at contig
+    boundaries, so each batch fills exactly one chunk of each array, and chunks
+    are written concurrently. Arrays are created with the length of the contig,
+    which bounds the number of records, and trimmed once all chunks are written.
+    The chrom field is implied by the group. If `pad` is True and no `regions`
+    are given, positions are consecutive and the pos field is implied too, by
+    the "pos_start" attribute of each contig group. Contig groups left in
+    `zarr_group` by a previous run are removed.
+
+    """
+
+    import zarr
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+
+    # lookup stats function and default dtype
+    stats_function, default_dtype = _lookup_stats(stats_type)
+
+    # determine field names
+    if fields is None:
+        fields = [t[0] for t in default_dtype]
+
+    # determine dtype
+    dtype = dict(determine_dtype(default_dtype, alignmentfile, dtype))
+
+    # positions are consecutive if padded over whole contigs or a single region
+    implicit_pos = kwargs.get('pad', False) and kwargs.get('regions') is None
+    names = [f for f in fields if f != 'chrom' and not (implicit_pos and f == 'pos')]
+
+    # setup record generator
+    if isinstance(alignmentfile, str):
+        alignmentfile = AlignmentFile(alignmentfile)
+    batches = stats_function(alignmentfile, batch_size=zarr_chunklen,
+                             **_field_kwargs(stats_type, fields, kwargs))
+
+    root = zarr.open_group(outfile, mode='a', path=zarr_group)
+
+    # contig groups from a previous run would be mixed with the output
+    for name in set(root.attrs.get('contigs', [])) | set(alignmentfile.references):
+        if name in root:
+            del root[name]
+    root.attrs['pysamstats_type'] = \
+        ','.join(stats_type) if isinstance(stats_type, (list, tuple)) else stats_type
+    root.attrs['contigs'] = list()
+
+    def write_chunk(arrays, offset, a):
+        for f in names:
+            arrays[f][offset:offset + len(a)] = a[f]
+        return len(a)
+
+    def write_chunks(executor):
+        pending = collections.deque()
+        chrom = None
+        arrays = dict()
+        rows = list()
+        pos_start = n = 0
+        for c, a in _contig_chunks(batches, zarr_chunklen):
+
+            if c != chrom:
+                # start a new contig group
+                chrom = c
+                name = chrom.decode('ascii')
+                group = root.create_group(name, overwrite=True)
+                root.attrs['contigs'] = root.attrs['contigs'] + [name]
+                if implicit_pos:
+                    pos_start = int(a['pos'][0])
+                    group.attrs['pos_start'] = pos_start
+                size = alignmentfile.get_reference_length(name)
+                arrays = dict()
+                for f in names:
+                    compressor = dict() if zarr_compressor == 'default' \
+                        else dict(compressor=zarr_compressor)
+                    arrays[f] = group.create_dataset(f, shape=(size,), chunks=(zarr_chunklen,),
+                                                     dtype=dtype[f], **compressor)
+                n = 0
+                rows.append([arrays, n])
+
+            if implicit_pos and (a['pos'][0] != pos_start + n or
+                                 a['pos'][-1] != pos_start + n + len(a) - 1):
+                raise ValueError('positions are not consecutive')
+
+            # grow arrays here if ever needed, so worker threads only write
+            # whole chunks
+            if n + len(a) > size:
+                size = max(2 * size, n + len(a))
+                for f in names:
+                    arrays[f].resize(size)
+            pending.append(executor.submit(write_chunk, arrays, n, a))
+            n += len(a)
+            rows[-1][1] = n
+
+            # bound the number of chunks held in memory
+            while pending and (pending[0].done() or len(pending) > 4 * threads):
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+        # trim arrays to the number of records written
+        for arrays, n in rows:
+            for f in names:
+                arrays[f].resize(n)
+
+    threads = max(1, threads)
+    executor = ThreadPoolExecutor(threads)
+    try:
+        _consume(write_chunks(executor), progress)
+    finally:
+        executor.shutdown()
+
+
+def write_native(stats_type, outfile, alignmentfile, fields=None, progress=None,
+                 native_blocklen=2**16, native_compression=None, native_complevel=1, dtype=None,
+                 **kwargs):
+    """Write statistics output to a directory of raw column files, with one
+    file per field per contig, which can be opened for random access by
+    position with :func:`pysamstats.open_stats`.
+
+    Parameters
+    ----------
+    stats_type : string or list of strings
+        Statistics type, one of 'coverage', 'coverage_ext', etc., or a list of
+        pileup statistics types to compute in a single pass.
+    outfile : string
+        Output directory path.
+    alignmentfile : pysam.AlignmentFile or string
+        Input BAM or SAM file or file path.
+    fields : list of strings
+        List of field names to output (all by default).
+    progress : int
+        Log progress to stderr approximately every N rows.
+    native_blocklen : int
+        Number of records in each block, the unit of compression and of the
+        positional index.
+    native_compression : string
+        None for raw, memory-mappable columns, or 'zlib' to compress each block.
+    native_complevel : int
+        Compression level.
+    dtype : dict
+        Override dtype.
+    **kwargs
+        Passed through to the statistics function.
+
+    Notes
+    -----
+    The chrom field is implied by the contig, and the pos field is always
+    written, as it is needed to locate records by position. A manifest records
+    the dtype, the number of records in each contig and before it, and the
+    first position in each block of each contig, as a coarse index.
+
+    """
+
+    import zlib
+    import numpy as np
+    from pysamstats.native import MANIFEST, FORMAT, FORMAT_VERSION, column_path
+
+    if native_compression not in (None, 'zlib'):
+        raise ValueError('unsupported compression: %r' % native_compression)
+
+    # lookup stats function and default dtype
+    stats_function, default_dtype = _lookup_stats(stats_type)
+
+    # determine field names
+    if fields is None:
+        fields = [t[0] for t in default_dtype]
+    names = [f for f in fields if f != 'chrom']
+    if 'pos' not in names:
+        names.insert(0, 'pos')
+
+    # determine dtype
+    dtype = dict(determine_dtype(default_dtype, alignmentfile, dtype))
+    dtype = np.dtype([(f, dtype[f]) for f in names])
+
+    # setup record generator
+    batches = stats_function(alignmentfile, batch_size=native_blocklen,
+                             **_field_kwargs(stats_type, fields, kwargs))
+
+    # a directory without a manifest is incomplete
+    if not os.path.isdir(outfile):
+        os.makedirs(outfile)
+    manifest_path = os.path.join(outfile, MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    contigs = list()
+    files = dict()
+
+    def close_files():
+        for f in files.values():
+            f.close()
+        files.clear()
+
+    def write_blocks():
+        for chrom, a in _contig_chunks(batches, native_blocklen):
+            chrom = chrom.decode('ascii')
+
+            if not contigs or contigs[-1]['chrom'] != chrom:
+                # start a new contig
+                close_files()
+                contig = dict(chrom=chrom, offset=sum(c['rows'] for c in contigs), rows=0,
+                              index=list())
+                if native_compression is not None:
+                    contig['blocks'] = dict((f, [0]) for f in names)
+                contigs.append(contig)
+                if not os.path.isdir(os.path.join(outfile, chrom)):
+                    os.makedirs(os.path.join(outfile, chrom))
+                for f in names:
+                    files[f] = open(column_path(outfile, chrom, f), 'wb')
+
+            contig['index'].append(int(a['pos'][0]))
+            for f in names:
+                data = np.ascontiguousarray(a[f], dtype=dtype[f]).tobytes()
+                if native_compression is not None:
+                    data = zlib.compress(data, native_complevel)
+                    contig['blocks'][f].append(contig['blocks'][f][-1] + len(data))
+                files[f].write(data)
+            contig['rows'] += len(a)
+            yield len(a)
+
+    try:
+        _consume(write_blocks(), progress)
+    finally:
+        close_files()
+
+    manifest = dict(
+        format=FORMAT,
+        version=FORMAT_VERSION,
+        type=','.join(stats_type) if isinstance(stats_type, (list, tuple)) else stats_type,
+        one_based=kwargs.get('one_based', False),
+        compression=native_compression,
+        blocklen=native_blocklen,
+        dtype=[(f, dtype[f].str) for f in names],
+        contigs=contigs,
+    )
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def write_bigwig(stats_type, outfile, alignmentfile, fields=None, progress=None, **kwargs):
+    """Write one field of pileup statistics output to a bigWig file, for
+    viewing in genome browsers.
+
+    Parameters
+    ----------
+    stats_type : string
+        Pileup statistics type, e.g., 'coverage', 'coverage_strand' or 'mapq'.
+    outfile : string
+        Output file path.
+    alignmentfile : pysam.AlignmentFile or string
+        Input BAM or SAM file or file path.
+    fields : list of strings
+        A single numeric field to output (by default the first numeric field
+        after pos, e.g., reads_all for coverage).
+    progress : int
+        Log progress to stderr approximately every N rows.
+    **kwargs
+        Passed through to the statistics function.
+
+    Notes
+    -----
+    Runs of neighbouring positions with equal values are merged into single
+    intervals. The data section is written as records are computed, and zoom
+    level summaries are computed in the same pass.
+
+    """
+
+    import numpy as np
+    from pysamstats.bigwig import BigWigWriter
+
+    if isinstance(stats_type, (list, tuple)) or stats_type.endswith('_binned'):
+        raise ValueError('bigWig output requires a single pileup statistics type')
+
+    # lookup stats function and default dtype
+    stats_function, default_dtype = _lookup_stats(stats_type)
+
+    # determine field
+    numeric = [f for f, t in default_dtype
+               if f not in ('chrom', 'pos') and np.dtype(t).kind in 'iuf']
+    if fields is None:
+        fields = numeric[:1]
+    if len(fields) != 1 or fields[0] not in numeric:
+        raise ValueError('bigWig output requires a single numeric field, one of %s' % numeric)
+    field = fields[0]
+
+    if isinstance(alignmentfile, str):
+        alignmentfile = AlignmentFile(alignmentfile)
+    offset = 1 if kwargs.get('one_based', False) else 0
+
+    # setup record generator
+    batches = stats_function(alignmentfile, batch_size=2**16,
+                             **_field_kwargs(stats_type, fields, kwargs))
+
+    with BigWigWriter(outfile, alignmentfile.references, alignmentfile.lengths) as writer:
+
+        def add_chunks():
+            for chrom, a in _contig_chunks(batches, 2**16):
+                starts = a['pos'].astype('i8') - offset
+                writer.add(chrom.decode('ascii'), starts, starts + 1, a[field])
+                yield len(a)
+
+        _consume(add_chunks(), progress)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division
+import collections
+import json
+import os
+import zlib
+
+
+import numpy as np
+
+
+# name of the file describing the contents of a native output directory
+MANIFEST = 'manifest.json'
+
+# identifies the native output format in the manifest
+FORMAT = 'pysamstats-native'
+FORMAT_VERSION = 1
+
+
+def column_path(path, chrom, field):
+    """Path to the file holding one field of one contig in a native output
+    directory."""
+    return os.path.join(path, chrom, field + '.bin')
+
+
+class NativeStats(object):
+    """Statistics written by :func:`pysamstats.io.write_native`, giving random
+    access to each field by contig and position.
+
+    Parameters
+    ----------
+
+    path : string
+        Output directory path.
+
+    Attributes
+    ----------
+
+    stats_type : string
+        Statistics type, or comma-separated statistics types.
+    dtype : numpy dtype
+        Fields stored for each contig, always including pos.
+    contigs : list of strings
+        Contigs with at least one record, in genome order.
+    one_based : bool
+        Coordinate system of the pos field.
+
+    Notes
+    -----
+    Uncompressed fields are memory-mapped, so reads are views of the files on
+    disk. Compressed fields are compressed in blocks, and only the blocks
+    overlapping the rows read are decompressed.
+
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get('format') != FORMAT or manifest.get('version') != FORMAT_VERSION:
+            raise ValueError('%r is not a pysamstats native output directory' % path)
+        self.path = path
+        self.stats_type = manifest['type']
+        self.dtype = np.dtype([(str(f), str(d)) for f, d in manifest['dtype']])
+        self.one_based = manifest['one_based']
+        self.compression = manifest['compression']
+        self.blocklen = manifest['blocklen']
+        self.contigs = [c['chrom'] for c in manifest['contigs']]
+        self._contigs = dict((c['chrom'], c) for c in manifest['contigs'])
+        self._columns = dict()
+
+    def __repr__(self):
+        return '<NativeStats %r: %s, %s rows in %s contigs>' \
+               % (self.path, self.stats_type, len(self), len(self.contigs))
+
+    def __len__(self):
+        return sum(c['rows'] for c in self._contigs.values())
+
+    def _contig(self, chrom):
+        try:
+            return self._contigs[chrom]
+        except KeyError:
+            raise KeyError('no records for contig %r' % chrom)
+
+    def rows(self, chrom):
+        """Number of records for a contig."""
+        return self._contig(chrom)['rows']
+
+    def offset(self, chrom):
+        """Number of records before a contig, over all contigs in genome
+        order."""
+        return self._contig(chrom)['offset']
+
+    def column(self, chrom, field):
+        """All values of a field for a contig, as a memory-mapped array if
+        uncompressed."""
+
+        contig = self._contig(chrom)
+        if self.compression is not None:
+            return self._read(chrom, field, 0, contig['rows'])
+        key = chrom, field
+        if key not in self._columns:
+            dtype = self.dtype[field]
+            if contig['rows'] == 0:
+                # an empty file can't be mapped
+                self._columns[key] = np.empty(0, dtype=dtype)
+            else:
+                self._columns[key] = np.memmap(column_path(self.path, chrom, field), dtype=dtype,
+                                               mode='r', shape=(contig['rows'],))
+        return self._columns[key]
+
+    def _read(self, chrom, field, start, stop):
+        # read rows from start to stop of a field
+        if self.compression is None:
+            return self.column(chrom, field)[start:stop]
+        contig = self._contig(chrom)
+        dtype = self.dtype[field]
+        if stop <= start:
+            return np.empty(0, dtype=dtype)
+        first, last = start // self.blocklen, (stop - 1) // self.blocklen
+        offsets = contig['blocks'][field]
+        with open(column_path(self.path, chrom, field), 'rb') as f:
+            f.seek(offsets[first])
+            data = f.read(offsets[last + 1] - offsets[first])
+        blocks = list()
+        for i in range(first, last + 1):
+            k = offsets[i] - offsets[first]
+            blocks.append(zlib.decompress(data[k:k + offsets[i + 1] - offsets[i]]))
+        a = np.frombuffer(b''.join(blocks), dtype=dtype)
+        return a[start - first * self.blocklen:stop - first * self.blocklen]
+
+    def _search(self, chrom, pos, side):
+        # row of a position in a contig, as numpy.searchsorted, starting from
+        # the coarse index of the first position in each block
+        contig = self._contig(chrom)
+        block = max(0, np.searchsorted(contig['index'], pos, side='right') - 1)
+        start = block * self.blocklen
+        stop = min(start + self.blocklen, contig['rows'])
+        return start + int(np.searchsorted(self._read(chrom, 'pos', start, stop), pos, side=side))
+
+    def locate(self, chrom, start=None, end=None):
+        """Rows of the records for a contig with position `start` or greater and
+        less than `end`, in the coordinate system of the pos field, returned as
+        a slice."""
+
+        i = 0 if start is None else self._search(chrom, start, 'left')
+        j = self.rows(chrom) if end is None else self._search(chrom, end, 'left')
+        return slice(i, max(i, j))
+
+    def fetch(self, chrom, start=None, end=None, fields=None):
+        """Values of fields for the records for a contig with position `start`
+        or greater and less than `end`, in the coordinate system of the pos
+        field.
+
+        Parameters
+        ----------
+
+        chrom : string
+            Chromosome/contig.
+        start : int
+            Start position.
+        end : int
+            End position.
+        fields : list of strings
+            Names of fields to read (all by default).
+
+        Returns
+        -------
+
+        columns : OrderedDict
+            Arrays of values keyed by field name, as views of memory-mapped
+            files if uncompressed.
+
+        """
+
+        if fields is None:
+            fields = self.dtype.names
+        rows = self.locate(chrom, start, end)
+        return collections.OrderedDict((f, self._read(chrom, f, rows.start, rows.stop))
+                                       for f in fields)
+
+
+def open_stats(path):
+    """Open statistics written by :func:`pysamstats.io.write_native`.
+
+    Parameters
+    ----------
+
+    path : string
+        Output directory path.
+
+    Returns
+    -------
+
+    stats : NativeStats
+
+    """
+    return NativeStats(path)
@@ -3,19 +3,32 @@
 from __future__ import print_function, division, absolute_import
 
 
-from libc.stdint cimport uint32_t, uint8_t, uint64_t, int64_t
-from libc.math cimport sqrt
-from numpy import around as round
-from cpython cimport PyBytes_FromStringAndSize
-from pysam.libchtslib cimport bam1_t, bam_pileup1_t
+cimport cython
+from libc.stdint cimport uint32_t, uint8_t, uint64_t, int64_t, int32_t
+from libc.stdlib cimport malloc, calloc, realloc, free
+from libc.string cimport memcpy, memmove, memset, memcmp
+from libc.math cimport sqrt, rint
+import numpy as np
+from cpython cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from pysam.libchtslib cimport bam1_t, bam_pileup1_t, bam_pileup_cd, bam_get_cigar, bam_get_seq, \
+    bam_get_qual, htsFile, hts_itr_t, sam_itr_next, bam_plp_auto_f, bam_mplp_t, bam_mplp_init, \
+    bam_mplp_init_overlaps, bam_mplp_set_maxcnt, bam_mplp_constructor, bam_mplp_auto, \
+    bam_mplp_destroy, hts_idx_t, hts_idx_init, hts_idx_push, hts_idx_finish, hts_idx_set_meta, \
+    hts_idx_save, hts_idx_destroy, HTS_FMT_TBI, bgzf_compress
 from pysam.libcfaidx cimport FastaFile
 from pysam.libcalignmentfile cimport AlignmentFile, IteratorRowRegion
-from pysam.libcalignedsegment cimport pysam_bam_get_cigar, pysam_bam_get_seq, \
-    pysam_bam_get_qual, PileupColumn
+from pysam.libcalignedsegment cimport pysam_bam_get_cigar, PileupColumn
 
 
 import sys as _sys
+import io
 import itertools
+import struct
+import collections
+import functools
+
+
+from pysamstats import config, util
 
 
 # PY2/3 compatibility
@@ -69,54 +82,338 @@ DEF BAM_CDIFF      = 8
 
 cdef char* CODE2CIGAR= "MIDNSHP=X"
 
+# properties of a read which are the same at every position it covers, cached
+# as bit flags in the pileup (see read_props)
+DEF READ_SOFTCLIPPED      = 1
+DEF READ_MATE_UNMAPPED    = 2
+DEF READ_MATE_OTHER_CHR   = 4
+DEF READ_MATE_SAME_STRAND = 8
+DEF READ_FACEAWAY         = 16
+
 cdef char* bam_nt16_rev_table = "=ACMGRSVTWYHKDBN"
 
 
+def value_fields(dtype):
+    """Names of the fields in a statistics dtype which are computed by the stat
+    object, i.e., all fields except chrom and pos."""
+    return tuple(f for f, _ in dtype if f not in ('chrom', 'pos'))
+
+
+def selects(fields, tokens):
+    """Whether any of `fields` is named with one of `tokens`, e.g., the tokens
+    ('matches',) select 'matches_pp' and 'rms_baseq_matches'."""
+    return any(t in f.split('_') for f in fields for t in tokens)
+
+
+######################
+# REFERENCE SEQUENCE #
+######################
+
+
+cdef class RefCache(object):
+    """Cache of reference sequence, fetched from a FASTA file in large blocks
+    and held upper-cased in a contiguous buffer, so that lookups of single
+    bases and windows at successive positions are served without further
+    calls to the FASTA file. A running count of G/C bases is kept alongside
+    the buffer, so the GC content of any window is a single subtraction.
+
+    """
+
+    cdef:
+        FastaFile fafile
+        Py_ssize_t block_size
+        object chrom
+        bytes seq
+        const char* buf
+        int32_t* gc_cum
+        Py_ssize_t start, end, n
+
+    def __init__(self, FastaFile fafile, Py_ssize_t block_size=2**20):
+        self.fafile = fafile
+        self.block_size = block_size
+        self.chrom = None
+        self.seq = b''
+        self.buf = self.seq
+        self.start = self.end = self.n = 0
+
+    def __dealloc__(self):
+        free(self.gc_cum)
+
+    cdef int load(self, chrom, Py_ssize_t start, Py_ssize_t end) except -1:
+        """Ensure the region from `start` to `end` is held in the buffer."""
+        cdef:
+            Py_ssize_t i
+            int32_t* gc_cum
+        if start >= self.start and end <= self.end and chrom == self.chrom:
+            return 0
+        end = max(end, start + self.block_size)
+        seq = self.fafile.fetch(chrom, start, end).upper()
+        if not PY2:
+            seq = seq.encode('ascii')
+        self.chrom = chrom
+        self.seq = seq
+        self.buf = self.seq
+        self.start = start
+        self.end = end
+        self.n = len(self.seq)
+
+        # running count of G/C, where gc_cum[i] counts bases before offset i
+        gc_cum = <int32_t*> realloc(self.gc_cum, (self.n + 1) * sizeof(int32_t))
+        if gc_cum == NULL:
+            raise MemoryError()
+        self.gc_cum = gc_cum
+        gc_cum[0] = 0
+        for i in range(self.n):
+            gc_cum[i + 1] = gc_cum[i] + (self.buf[i] == b'G' or self.buf[i] == b'C')
+        return 0
+
+    cdef int base(self, chrom, Py_ssize_t pos) except -1:
+        """Reference base at `pos`, or 0 beyond the end of the chromosome."""
+        self.load(chrom, pos, pos + 1)
+        pos -= self.start
+        if pos < self.n:
+            return self.buf[pos]
+        return 0
+
+    cdef int cached_base(self, Py_ssize_t pos) noexcept nogil:
+        """Reference base at `pos` in the chromosome held in the buffer, 0
+        beyond the end of the chromosome, or -1 if `pos` isn't held, in which
+        case the base must be loaded with base()."""
+        if pos < self.start or pos >= self.end:
+            return -1
+        pos -= self.start
+        if pos < self.n:
+            return self.buf[pos]
+        return 0
+
+    cdef int gc_count(self, chrom, Py_ssize_t start, Py_ssize_t end,
+                      Py_ssize_t* n) except -1:
+        """Number of G/C bases in the reference sequence from `start` to `end`,
+        storing in `n` the number of bases available, which is fewer at the end
+        of the chromosome."""
+        cdef Py_ssize_t i
+        if start < 0:
+            start = 0
+        self.load(chrom, start, end)
+        i = min(start - self.start, self.n)
+        n[0] = max(0, min(end, self.start + self.n) - start)
+        return self.gc_cum[i + n[0]] - self.gc_cum[i]
+
+
+cdef inline int get_refbase(RefCache ref, chrom, Py_ssize_t pos) except -1:
+    """Character code of the reference base at `pos`, or 0 if there is none."""
+    if ref is None:
+        return 0
+    return ref.base(chrom, pos)
+
+
+cdef inline int get_gc_count(RefCache ref, chrom, Py_ssize_t start, Py_ssize_t end,
+                             Py_ssize_t* n) except -1:
+    if ref is None:
+        raise ValueError('a FASTA file is required to compute GC content')
+    return ref.gc_count(chrom, start, end, n)
+
+
 cdef class PileupStat(object):
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
-        return dict()
+    # names of fields written by put(), in dtype order
+    fields = ()
+
+    # whether records for positions with no reads vary with position, other
+    # than by reference base
+    position_dependent = False
+
+    # whether recv() reads per-read properties cached in the pileup
+    uses_read_props = False
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    # N.B. recv(), write() and reset() don't need the GIL, so a pileup engine
+    # can count reads and write records for a run of columns without it, apart
+    # from for position dependent statistics, which write records with put()
+
+    cdef:
+        int32_t* values
+        int ref_index
+        # following statistic, where several are chained in a MultiPileupStat
+        PileupStat next
+
+    def __dealloc__(self):
+        free(self.values)
+
+    cdef int alloc_values(self) except -1:
+        """Allocate the buffer holding values for a single record, on first use,
+        as fields of some statistics are only known once initialised."""
+        fields = self.fields
+        self.values = <int32_t*> malloc(max(1, len(fields)) * sizeof(int32_t))
+        if self.values == NULL:
+            raise MemoryError()
+        self.ref_index = fields.index('ref') if 'ref' in fields else -1
+        return 0
+
+    cdef int put(self, chrom, pos, RefCache ref, int refc, int32_t* out) except -1:
+        """Write values for the current record into `out`, one per field, then
+        reset counters. The reference base is given and written as its
+        character code, or 0 if there is none."""
+        self.write(refc, out)
+        return 0
+
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
+        """As put(), for statistics which aren't position dependent."""
         pass
 
+    cdef dict rec(self, chrom, pos, RefCache ref, int refc):
+        cdef:
+            Py_ssize_t i
+
+        if self.values == NULL:
+            self.alloc_values()
+        self.put(chrom, pos, ref, refc, self.values)
+        rec = {f: self.values[i] for i, f in enumerate(self.fields)}
+        if self.ref_index >= 0:
+            rec['ref'] = refstr(refc)
+        return rec
 
-#############################
-# BASIC COVERAGE STATISTICS #
-#############################
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
+        pass
 
+    cdef void reset(self) noexcept nogil:
+        """Reset counters, after values for a record have been written."""
+        pass
 
-# noinspection PyAttributeOutsideInit
-cdef class CountPp:
-    cdef:
-        int all, pp
+    cdef int select(self, fields) except -1:
+        """Skip work in recv() which is only needed for fields other than
+        `fields`. Values of the other fields are undefined afterwards."""
+        return 0
 
-    def __init__(self):
-        self.reset()
+    cdef void recv_chain(self, bam_pileup1_t* read, int refnt) noexcept nogil:
+        self.recv(read, refnt)
+        if self.next is not None:
+            self.next.recv_chain(read, refnt)
+
+    cdef void write_chain(self, int refc, int32_t* buf, Py_ssize_t* offsets) noexcept nogil:
+        self.write(refc, buf + offsets[0])
+        if self.next is not None:
+            self.next.write_chain(refc, buf, offsets + 1)
+
+
+cdef inline object refstr(int refc):
+    cdef char c = <char> refc
+    refbase = PyBytes_FromStringAndSize(&c, 1 if c else 0)
+    if PY2:
+        return refbase
+    return str(refbase, 'ascii')
+
+
+# 4-bit codes of bases in the BAM sequence encoding, indexed by character, or
+# -1 for characters which have no code
+cdef int nt16_codes[256]
+memset(nt16_codes, -1, sizeof(nt16_codes))
+for _i, _c in enumerate(bam_nt16_rev_table[:16]):
+    nt16_codes[_c] = _i
+del _i, _c
+
+# codes of the bases counted by the variation statistics, in dtype order
+DEF NT16_A = 1
+DEF NT16_C = 2
+DEF NT16_G = 4
+DEF NT16_T = 8
+DEF NT16_N = 15
+
+
+cdef inline int ref_nt16(int refc) noexcept nogil:
+    """Code of the reference base, or -1 if there is none."""
+    if refc:
+        return nt16_codes[<unsigned char> refc]
+    return -1
+
+
+cdef inline int seq_nt16(bam1_t* b, int32_t k) noexcept nogil:
+    """Code of the base at position `k` in the read, or -1 if the read has no
+    sequence."""
+    if not b.core.l_qseq:
+        return -1
+    return bam_get_seq(b)[k // 2] >> 4 * (1 - k % 2) & 0xf
+
+
+############
+# COUNTERS #
+############
+
+
+# Counts are held by each statistic in a contiguous C array laid out in dtype
+# order, so they are incremented inline, written out with a single memcpy and
+# reset with a single memset. These are the indexes of the counts for one
+# group of reads, which the statistics repeat for each group they count.
+
+# reads overall and in proper pairs
+cdef enum:
+    PP_ALL
+    PP_PP
+    PP_N
+
+# reads overall and by strand
+cdef enum:
+    STRAND_ALL
+    STRAND_FWD
+    STRAND_REV
+    STRAND_N
+
+# reads overall and by strand, then in proper pairs and by strand
+cdef enum:
+    PPS_ALL
+    PPS_FWD
+    PPS_REV
+    PPS_PP
+    PPS_PP_FWD
+    PPS_PP_REV
+    PPS_N
+
+
+cdef inline void incr_pp(int32_t* counts, bint is_proper_pair) noexcept nogil:
+    counts[PP_ALL] += 1
+    if is_proper_pair:
+        counts[PP_PP] += 1
+
+
+cdef inline void incr_strand(int32_t* counts, bint is_reverse) noexcept nogil:
+    counts[STRAND_ALL] += 1
+    if is_reverse:
+        counts[STRAND_REV] += 1
+    else:
+        counts[STRAND_FWD] += 1
 
-    def reset(self):
-        self.all = self.pp = 0
 
-    cdef void incr(self, bint is_proper_pair):
-        self.all += 1
-        if is_proper_pair:
-            self.pp += 1
+cdef inline void incr_pp_strand(int32_t* counts, bint is_reverse,
+                                bint is_proper_pair) noexcept nogil:
+    counts[PPS_ALL] += 1
+    if is_reverse:
+        counts[PPS_REV] += 1
+    else:
+        counts[PPS_FWD] += 1
+    if is_proper_pair:
+        counts[PPS_PP] += 1
+        if is_reverse:
+            counts[PPS_PP_REV] += 1
+        else:
+            counts[PPS_PP_FWD] += 1
+
+
+#############################
+# BASIC COVERAGE STATISTICS #
+#############################
 
 
 # noinspection PyAttributeOutsideInit
 cdef class Coverage(PileupStat):
 
-    cdef:
-        CountPp reads
+    fields = value_fields(config.dtype_coverage)
 
-    def __init__(self):
-        self.reads = CountPp()
-        self.reset()
+    cdef:
+        int32_t reads[PP_N]
 
-    def reset(self):
-        self.reads.reset()
+    cdef void reset(self) noexcept nogil:
+        memset(self.reads, 0, sizeof(self.reads))
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             bint is_proper_pair
 
@@ -124,64 +421,34 @@ cdef class Coverage(PileupStat):
         is_proper_pair = <bint>(read.b.core.flag & BAM_FPROPER_PAIR)
 
         # do the counting
-        self.reads.incr(is_proper_pair)
+        incr_pp(self.reads, is_proper_pair)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
 
-        # make record
-        rec = {'reads_all': self.reads.all,
-               'reads_pp': self.reads.pp}
+        # write values in dtype order
+        memcpy(out, self.reads, sizeof(self.reads))
 
         # reset counters
         self.reset()
 
-        return rec
-
 
 ################################
 # STRANDED COVERAGE STATISTICS #
 ################################
 
 
-# noinspection PyAttributeOutsideInit
-cdef class CountPpStrand:
-    cdef:
-        int all, pp, fwd, rev, pp_fwd, pp_rev
-
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.all = self.fwd = self.rev = self.pp = self.pp_fwd = self.pp_rev = 0
-
-    cdef void incr(self, bint is_reverse, bint is_proper_pair):
-        self.all += 1
-        if is_reverse:
-            self.rev += 1
-            if is_proper_pair:
-                self.pp += 1
-                self.pp_rev += 1
-        else:
-            self.fwd += 1
-            if is_proper_pair:
-                self.pp += 1
-                self.pp_fwd += 1
-
-
 # noinspection PyAttributeOutsideInit
 cdef class CoverageStrand(PileupStat):
 
-    cdef:
-        CountPpStrand reads
+    fields = value_fields(config.dtype_coverage_strand)
 
-    def __init__(self):
-        self.reads = CountPpStrand()
-        self.reset()
+    cdef:
+        int32_t reads[PPS_N]
 
-    def reset(self):
-        self.reads.reset()
+    cdef void reset(self) noexcept nogil:
+        memset(self.reads, 0, sizeof(self.reads))
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
@@ -193,107 +460,88 @@ cdef class CoverageStrand(PileupStat):
         is_proper_pair = <bint>(flag & BAM_FPROPER_PAIR)
 
         # do the counting
-        self.reads.incr(is_reverse, is_proper_pair)
+        incr_pp_strand(self.reads, is_reverse, is_proper_pair)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
 
-        # make record
-        rec = {'reads_all': self.reads.all,
-               'reads_fwd': self.reads.fwd,
-               'reads_rev': self.reads.rev,
-               'reads_pp': self.reads.pp,
-               'reads_pp_fwd': self.reads.pp_fwd,
-               'reads_pp_rev': self.reads.pp_rev}
+        # write values in dtype order
+        memcpy(out, self.reads, sizeof(self.reads))
 
         # reset counters
         self.reset()
 
-        return rec
-
 
 ################################
 # EXTENDED COVERAGE STATISTICS #
 ################################
 
 
+# groups of reads counted by the extended coverage statistics, in dtype order
+cdef enum:
+    EXT_ALL
+    EXT_PP
+    EXT_MATE_UNMAPPED
+    EXT_MATE_OTHER_CHR
+    EXT_MATE_SAME_STRAND
+    EXT_FACEAWAY
+    EXT_SOFTCLIPPED
+    EXT_DUPLICATE
+    EXT_N
+
+
 # noinspection PyAttributeOutsideInit
 cdef class CoverageExt(PileupStat):
 
+    fields = value_fields(config.dtype_coverage_ext)
+    uses_read_props = True
+
     cdef:
-        int reads_all
-        int reads_pp
-        int reads_mate_unmapped
-        int reads_mate_other_chr
-        int reads_mate_same_strand
-        int reads_faceaway
-        int reads_softclipped
-        int reads_duplicate
+        int32_t reads[EXT_N]
+        bint count_softclipped
 
     def __init__(self):
-        self.reset()
+        self.count_softclipped = True
 
-    def reset(self):
-        self.reads_all = 0
-        self.reads_pp = 0
-        self.reads_mate_unmapped = 0
-        self.reads_mate_other_chr = 0
-        self.reads_mate_same_strand = 0
-        self.reads_faceaway = 0
-        self.reads_softclipped = 0
-        self.reads_duplicate = 0
-
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void reset(self) noexcept nogil:
+        memset(self.reads, 0, sizeof(self.reads))
+
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
-            bint is_proper_pair
-            bint is_reverse
-            bint is_duplicate
-            bint mate_is_unmappped
-            bint mate_is_reverse
-            int tlen
+            int64_t props
 
         # convenience variables
         flag = read.b.core.flag
-        is_reverse = <bint>(flag & BAM_FREVERSE)
-        is_proper_pair = <bint>(flag & BAM_FPROPER_PAIR)
-        is_duplicate = <bint>(flag & BAM_FDUP)
-        mate_is_unmapped = <bint>(flag & BAM_FMUNMAP)
-        mate_is_reverse = <bint>(flag & BAM_FMREVERSE)
-        tlen = read.b.core.isize
+        props = read.cd.i
 
         # do the counting
-        self.reads_all += 1
-        if is_duplicate:
-            self.reads_duplicate += 1
-        if is_proper_pair:
-            self.reads_pp += 1
-        if mate_is_unmapped:
-            self.reads_mate_unmapped += 1
-        elif col.tid != read.b.core.mtid:
-            self.reads_mate_other_chr += 1
-        elif (is_reverse and mate_is_reverse) or (not is_reverse and not mate_is_reverse):
-            self.reads_mate_same_strand += 1
-        elif (is_reverse and tlen > 0) or (not is_reverse and tlen < 0):
-            self.reads_faceaway += 1
-        if is_softclipped(read.b):
-            self.reads_softclipped += 1
-
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
-
-        # make record
-        rec = {'reads_all': self.reads_all,
-               'reads_pp': self.reads_pp,
-               'reads_mate_unmapped': self.reads_mate_unmapped,
-               'reads_mate_other_chr': self.reads_mate_other_chr,
-               'reads_mate_same_strand': self.reads_mate_same_strand,
-               'reads_faceaway': self.reads_faceaway,
-               'reads_softclipped': self.reads_softclipped,
-               'reads_duplicate': self.reads_duplicate}
+        self.reads[EXT_ALL] += 1
+        if flag & BAM_FDUP:
+            self.reads[EXT_DUPLICATE] += 1
+        if flag & BAM_FPROPER_PAIR:
+            self.reads[EXT_PP] += 1
+        if props & READ_MATE_UNMAPPED:
+            self.reads[EXT_MATE_UNMAPPED] += 1
+        elif props & READ_MATE_OTHER_CHR:
+            self.reads[EXT_MATE_OTHER_CHR] += 1
+        elif props & READ_MATE_SAME_STRAND:
+            self.reads[EXT_MATE_SAME_STRAND] += 1
+        elif props & READ_FACEAWAY:
+            self.reads[EXT_FACEAWAY] += 1
+        if self.count_softclipped and props & READ_SOFTCLIPPED:
+            self.reads[EXT_SOFTCLIPPED] += 1
+
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
+
+        # write values in dtype order
+        memcpy(out, self.reads, sizeof(self.reads))
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        self.count_softclipped = selects(fields, ('softclipped',))
+        return 0
 
 
 ##########################################
@@ -301,129 +549,61 @@ cdef class CoverageExt(PileupStat):
 ##########################################
 
 
-# noinspection PyAttributeOutsideInit
-cdef class CountStrand:
-    cdef:
-        int all, fwd, rev
-
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.all = self.fwd = self.rev = 0
-
-    cdef void incr(self, bint is_reverse):
-        self.all += 1
-        if is_reverse:
-            self.rev += 1
-        else:
-            self.fwd += 1
-
-
 # noinspection PyAttributeOutsideInit
 cdef class CoverageExtStrand(PileupStat):
 
+    fields = value_fields(config.dtype_coverage_ext_strand)
+    uses_read_props = True
+
     cdef:
-        CountStrand all
-        CountStrand pp
-        CountStrand mate_unmapped
-        CountStrand mate_other_chr
-        CountStrand same_strand
-        CountStrand faceaway
-        CountStrand softclipped
-        CountStrand duplicate
+        int32_t reads[EXT_N][STRAND_N]
+        bint count_softclipped
 
     def __init__(self):
-        self.all = CountStrand()
-        self.pp = CountStrand()
-        self.mate_unmapped = CountStrand()
-        self.mate_other_chr = CountStrand()
-        self.same_strand = CountStrand()
-        self.faceaway = CountStrand()
-        self.softclipped = CountStrand()
-        self.duplicate = CountStrand()
-        self.reset()
+        self.count_softclipped = True
 
-    def reset(self):
-        self.all.reset()
-        self.pp.reset()
-        self.mate_unmapped.reset()
-        self.mate_other_chr.reset()
-        self.same_strand.reset()
-        self.faceaway.reset()
-        self.softclipped.reset()
-        self.duplicate.reset()
-
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void reset(self) noexcept nogil:
+        memset(self.reads, 0, sizeof(self.reads))
+
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
-            bint is_proper_pair
             bint is_reverse
-            bint is_duplicate
-            bint mate_is_unmappped
-            bint mate_is_reverse
-            int tlen
+            int64_t props
 
         # convenience variables
         flag = read.b.core.flag
         is_reverse = <bint>(flag & BAM_FREVERSE)
-        is_proper_pair = <bint>(flag & BAM_FPROPER_PAIR)
-        is_duplicate = <bint>(flag & BAM_FDUP)
-        mate_is_unmapped = <bint>(flag & BAM_FMUNMAP)
-        mate_is_reverse = <bint>(flag & BAM_FMREVERSE)
-        tlen = read.b.core.isize
+        props = read.cd.i
 
         # do the counting
-        self.all.incr(is_reverse)
-        if is_proper_pair:
-            self.pp.incr(is_reverse)
-        if mate_is_unmapped:
-            self.mate_unmapped.incr(is_reverse)
-        elif col.tid != read.b.core.mtid:
-            self.mate_other_chr.incr(is_reverse)
-        elif is_reverse and mate_is_reverse:
-            self.same_strand.incr(is_reverse)
-        elif not is_reverse and not mate_is_reverse:
-            self.same_strand.incr(is_reverse)
-        elif (is_reverse and tlen > 0) or (not is_reverse and tlen < 0):
-            self.faceaway.incr(is_reverse)
-        if is_softclipped(read.b):
-            self.softclipped.incr(is_reverse)
-        if is_duplicate:
-            self.duplicate.incr(is_reverse)
-
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
-
-        # make record
-        rec = {'reads_all': self.all.all,
-               'reads_fwd': self.all.fwd,
-               'reads_rev': self.all.rev,
-               'reads_pp': self.pp.all,
-               'reads_pp_fwd': self.pp.fwd,
-               'reads_pp_rev': self.pp.rev,
-               'reads_mate_unmapped': self.mate_unmapped.all,
-               'reads_mate_unmapped_fwd': self.mate_unmapped.fwd,
-               'reads_mate_unmapped_rev': self.mate_unmapped.rev,
-               'reads_mate_other_chr': self.mate_other_chr.all,
-               'reads_mate_other_chr_fwd': self.mate_other_chr.fwd,
-               'reads_mate_other_chr_rev': self.mate_other_chr.rev,
-               'reads_mate_same_strand': self.same_strand.all,
-               'reads_mate_same_strand_fwd': self.same_strand.fwd,
-               'reads_mate_same_strand_rev': self.same_strand.rev,
-               'reads_faceaway': self.faceaway.all,
-               'reads_faceaway_fwd': self.faceaway.fwd,
-               'reads_faceaway_rev': self.faceaway.rev,
-               'reads_softclipped': self.softclipped.all,
-               'reads_softclipped_fwd': self.softclipped.fwd,
-               'reads_softclipped_rev': self.softclipped.rev,
-               'reads_duplicate': self.duplicate.all,
-               'reads_duplicate_fwd': self.duplicate.fwd,
-               'reads_duplicate_rev': self.duplicate.rev}
+        incr_strand(self.reads[EXT_ALL], is_reverse)
+        if flag & BAM_FPROPER_PAIR:
+            incr_strand(self.reads[EXT_PP], is_reverse)
+        if props & READ_MATE_UNMAPPED:
+            incr_strand(self.reads[EXT_MATE_UNMAPPED], is_reverse)
+        elif props & READ_MATE_OTHER_CHR:
+            incr_strand(self.reads[EXT_MATE_OTHER_CHR], is_reverse)
+        elif props & READ_MATE_SAME_STRAND:
+            incr_strand(self.reads[EXT_MATE_SAME_STRAND], is_reverse)
+        elif props & READ_FACEAWAY:
+            incr_strand(self.reads[EXT_FACEAWAY], is_reverse)
+        if self.count_softclipped and props & READ_SOFTCLIPPED:
+            incr_strand(self.reads[EXT_SOFTCLIPPED], is_reverse)
+        if flag & BAM_FDUP:
+            incr_strand(self.reads[EXT_DUPLICATE], is_reverse)
+
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
+
+        # write values in dtype order
+        memcpy(out, self.reads, sizeof(self.reads))
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        self.count_softclipped = selects(fields, ('softclipped',))
+        return 0
 
 
 ########################
@@ -431,108 +611,87 @@ cdef class CoverageExtStrand(PileupStat):
 ########################
 
 
+cdef inline int32_t* put_bases(int32_t* bases, Py_ssize_t k, int32_t* out) noexcept nogil:
+    """Write the `k` counts for each of A, C, T, G and N, from counts indexed
+    by base code."""
+    memcpy(out, bases + NT16_A * k, k * sizeof(int32_t))
+    memcpy(out + k, bases + NT16_C * k, k * sizeof(int32_t))
+    memcpy(out + 2 * k, bases + NT16_T * k, k * sizeof(int32_t))
+    memcpy(out + 3 * k, bases + NT16_G * k, k * sizeof(int32_t))
+    memcpy(out + 4 * k, bases + NT16_N * k, k * sizeof(int32_t))
+    return out + 5 * k
+
+
+# groups of reads counted by the variation statistics, in dtype order
+cdef enum:
+    VAR_READS
+    VAR_MATCHES
+    VAR_MISMATCHES
+    VAR_DELETIONS
+    VAR_INSERTIONS
+    VAR_N
+
+
 # noinspection PyAttributeOutsideInit
 cdef class Variation(PileupStat):
 
+    fields = value_fields(config.dtype_variation)
+
     cdef:
-        CountPp reads
-        CountPp matches
-        CountPp mismatches
-        CountPp deletions
-        CountPp insertions
-        CountPp A
-        CountPp C
-        CountPp T
-        CountPp G
-        CountPp N
+        int32_t reads[VAR_N][PP_N]
+        # counts for each base, indexed by code
+        int32_t bases[16][PP_N]
+        bint count_seq
 
     def __init__(self):
-        self.reads = CountPp()
-        self.matches = CountPp()
-        self.mismatches = CountPp()
-        self.deletions = CountPp()
-        self.insertions = CountPp()
-        self.A = CountPp()
-        self.C = CountPp()
-        self.T = CountPp()
-        self.G = CountPp()
-        self.N = CountPp()
-        self.reset()
+        self.count_seq = True
 
-    def reset(self):
-        self.reads.reset()
-        self.matches.reset()
-        self.mismatches.reset()
-        self.deletions.reset()
-        self.insertions.reset()
-        self.A.reset()
-        self.C.reset()
-        self.T.reset()
-        self.G.reset()
-        self.N.reset()
-
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void reset(self) noexcept nogil:
+        memset(self.reads, 0, sizeof(self.reads))
+        memset(self.bases, 0, sizeof(self.bases))
+
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
-            bytes alnbase
+            int alnnt
 
         # convenience variables
         flag = read.b.core.flag
         is_proper_pair = <bint>(flag & BAM_FPROPER_PAIR)
 
         # do the counting
-        self.reads.incr(is_proper_pair)
+        incr_pp(self.reads[VAR_READS], is_proper_pair)
         if read.is_del:
             if not read.is_refskip:
-                self.deletions.incr(is_proper_pair)
+                incr_pp(self.reads[VAR_DELETIONS], is_proper_pair)
         else:
-            alnbase = get_seq_base(read.b, read.qpos)
-            if alnbase == b'A':
-                self.A.incr(is_proper_pair)
-            elif alnbase == b'T':
-                self.T.incr(is_proper_pair)
-            elif alnbase == b'C':
-                self.C.incr(is_proper_pair)
-            elif alnbase == b'G':
-                self.G.incr(is_proper_pair)
-            elif alnbase == b'N':
-                self.N.incr(is_proper_pair)
             if read.indel > 0:
-                self.insertions.incr(is_proper_pair)
-            if alnbase == refbase:
-                self.matches.incr(is_proper_pair)
+                incr_pp(self.reads[VAR_INSERTIONS], is_proper_pair)
+            if not self.count_seq:
+                return
+            alnnt = seq_nt16(read.b, read.qpos)
+            if alnnt >= 0:
+                incr_pp(self.bases[alnnt], is_proper_pair)
+            if alnnt >= 0 and alnnt == refnt:
+                incr_pp(self.reads[VAR_MATCHES], is_proper_pair)
             else:
-                self.mismatches.incr(is_proper_pair)
+                incr_pp(self.reads[VAR_MISMATCHES], is_proper_pair)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
 
-        # make record
-        if PY2:
-            ref = refbase
-        else:
-            ref = str(refbase, 'ascii')
-        rec = {'ref': ref,
-               'reads_all': self.reads.all,
-               'reads_pp': self.reads.pp,
-               'matches': self.matches.all,
-               'matches_pp': self.matches.pp,
-               'mismatches': self.mismatches.all,
-               'mismatches_pp': self.mismatches.pp,
-               'deletions': self.deletions.all,
-               'deletions_pp': self.deletions.pp,
-               'insertions': self.insertions.all,
-               'insertions_pp': self.insertions.pp,
-               'A': self.A.all, 'A_pp': self.A.pp,
-               'C': self.C.all, 'C_pp': self.C.pp,
-               'T': self.T.all, 'T_pp': self.T.pp,
-               'G': self.G.all, 'G_pp': self.G.pp,
-               'N': self.N.all, 'N_pp': self.N.pp}
+        # write values in dtype order
+        out[0] = refc
+        memcpy(out + 1, self.reads, sizeof(self.reads))
+        put_bases(&self.bases[0][0], PP_N, out + 1 + VAR_N * PP_N)
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        # the aligned base is only needed for base and match counts
+        self.count_seq = selects(fields, ('matches', 'mismatches', 'A', 'C', 'T', 'G', 'N'))
+        return 0
 
 
 #################################
@@ -543,48 +702,27 @@ cdef class Variation(PileupStat):
 # noinspection PyAttributeOutsideInit
 cdef class VariationStrand(PileupStat):
 
+    fields = value_fields(config.dtype_variation_strand)
+
     cdef:
-        CountPpStrand reads
-        CountPpStrand matches
-        CountPpStrand mismatches
-        CountPpStrand deletions
-        CountPpStrand insertions
-        CountPpStrand A
-        CountPpStrand C
-        CountPpStrand T
-        CountPpStrand G
-        CountPpStrand N
+        int32_t reads[VAR_N][PPS_N]
+        # counts for each base, indexed by code
+        int32_t bases[16][PPS_N]
+        bint count_seq
 
     def __init__(self):
-        self.reads = CountPpStrand()
-        self.matches = CountPpStrand()
-        self.mismatches = CountPpStrand()
-        self.deletions = CountPpStrand()
-        self.insertions = CountPpStrand()
-        self.A = CountPpStrand()
-        self.C = CountPpStrand()
-        self.T = CountPpStrand()
-        self.G = CountPpStrand()
-        self.N = CountPpStrand()
-        self.reset()
+        self.count_seq = True
 
-    def reset(self):
-        self.reads.reset()
-        self.matches.reset()
-        self.mismatches.reset()
-        self.deletions.reset()
-        self.insertions.reset()
-        self.A.reset()
-        self.T.reset()
-        self.C.reset()
-        self.G.reset()
-        self.N.reset()
-
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void reset(self) noexcept nogil:
+        memset(self.reads, 0, sizeof(self.reads))
+        memset(self.bases, 0, sizeof(self.bases))
+
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
-            bytes alnbase
+            bint is_reverse
+            int alnnt
 
         # convenience variables
         flag = read.b.core.flag
@@ -592,82 +730,37 @@ cdef class VariationStrand(PileupStat):
         is_reverse = <bint>(flag & BAM_FREVERSE)
 
         # do the counting
-        self.reads.incr(is_reverse, is_proper_pair)
+        incr_pp_strand(self.reads[VAR_READS], is_reverse, is_proper_pair)
         if read.is_del:
             if not read.is_refskip:
-                self.deletions.incr(is_reverse, is_proper_pair)
+                incr_pp_strand(self.reads[VAR_DELETIONS], is_reverse, is_proper_pair)
         else:
-            alnbase = get_seq_base(read.b, read.qpos)
-            if alnbase == b'A':
-                self.A.incr(is_reverse, is_proper_pair)
-            elif alnbase == b'T':
-                self.T.incr(is_reverse, is_proper_pair)
-            elif alnbase == b'C':
-                self.C.incr(is_reverse, is_proper_pair)
-            elif alnbase == b'G':
-                self.G.incr(is_reverse, is_proper_pair)
-            elif alnbase == b'N':
-                self.N.incr(is_reverse, is_proper_pair)
             if read.indel > 0:
-                self.insertions.incr(is_reverse, is_proper_pair)
-            if alnbase == refbase:
-                self.matches.incr(is_reverse, is_proper_pair)
+                incr_pp_strand(self.reads[VAR_INSERTIONS], is_reverse, is_proper_pair)
+            if not self.count_seq:
+                return
+            alnnt = seq_nt16(read.b, read.qpos)
+            if alnnt >= 0:
+                incr_pp_strand(self.bases[alnnt], is_reverse, is_proper_pair)
+            if alnnt >= 0 and alnnt == refnt:
+                incr_pp_strand(self.reads[VAR_MATCHES], is_reverse, is_proper_pair)
             else:
-                self.mismatches.incr(is_reverse, is_proper_pair)
+                incr_pp_strand(self.reads[VAR_MISMATCHES], is_reverse, is_proper_pair)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
 
-        # make record
-        if PY2:
-            ref = refbase
-        else:
-            ref = str(refbase, 'ascii')
-        rec = {'ref': ref,
-               'reads_all': self.reads.all,
-               'reads_fwd': self.reads.fwd,
-               'reads_rev': self.reads.rev,
-               'reads_pp': self.reads.pp,
-               'reads_pp_fwd': self.reads.pp_fwd,
-               'reads_pp_rev': self.reads.pp_rev,
-               'matches': self.matches.all,
-               'matches_fwd': self.matches.fwd,
-               'matches_rev': self.matches.rev,
-               'matches_pp': self.matches.pp,
-               'matches_pp_fwd': self.matches.pp_fwd,
-               'matches_pp_rev': self.matches.pp_rev,
-               'mismatches': self.mismatches.all,
-               'mismatches_fwd': self.mismatches.fwd,
-               'mismatches_rev': self.mismatches.rev,
-               'mismatches_pp': self.mismatches.pp,
-               'mismatches_pp_fwd': self.mismatches.pp_fwd,
-               'mismatches_pp_rev': self.mismatches.pp_rev,
-               'deletions': self.deletions.all,
-               'deletions_fwd': self.deletions.fwd,
-               'deletions_rev': self.deletions.rev,
-               'deletions_pp': self.deletions.pp,
-               'deletions_pp_fwd': self.deletions.pp_fwd,
-               'deletions_pp_rev': self.deletions.pp_rev,
-               'insertions': self.insertions.all,
-               'insertions_fwd': self.insertions.fwd,
-               'insertions_rev': self.insertions.rev,
-               'insertions_pp': self.insertions.pp,
-               'insertions_pp_fwd': self.insertions.pp_fwd,
-               'insertions_pp_rev': self.insertions.pp_rev,
-               'A': self.A.all, 'A_fwd': self.A.fwd, 'A_rev': self.A.rev,
-               'A_pp': self.A.pp, 'A_pp_fwd': self.A.pp_fwd, 'A_pp_rev': self.A.pp_rev,
-               'C': self.C.all, 'C_fwd': self.C.fwd, 'C_rev': self.C.rev,
-               'C_pp': self.C.pp, 'C_pp_fwd': self.C.pp_fwd, 'C_pp_rev': self.C.pp_rev,
-               'T': self.T.all, 'T_fwd': self.T.fwd, 'T_rev': self.T.rev,
-               'T_pp': self.T.pp, 'T_pp_fwd': self.T.pp_fwd, 'T_pp_rev': self.T.pp_rev,
-               'G': self.G.all, 'G_fwd': self.G.fwd, 'G_rev': self.G.rev,
-               'G_pp': self.G.pp, 'G_pp_fwd': self.G.pp_fwd, 'G_pp_rev': self.G.pp_rev,
-               'N': self.N.all, 'N_fwd': self.N.fwd, 'N_rev': self.N.rev,
-               'N_pp': self.N.pp, 'N_pp_fwd': self.N.pp_fwd, 'N_pp_rev': self.N.pp_rev}
+        # write values in dtype order
+        out[0] = refc
+        memcpy(out + 1, self.reads, sizeof(self.reads))
+        put_bases(&self.bases[0][0], PPS_N, out + 1 + VAR_N * PPS_N)
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        # the aligned base is only needed for base and match counts
+        self.count_seq = selects(fields, ('matches', 'mismatches', 'A', 'C', 'T', 'G', 'N'))
+        return 0
 
 
 ##########################
@@ -686,11 +779,13 @@ cdef class TlenHelper:
         double d2
         int64_t s  # sum
         int64_t sq  # sum of squares
+        bint track_var  # whether to keep the running variance
 
     def __init__(self):
+        self.track_var = True
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.n = 0
         self.m = 0
         self.m2 = 0
@@ -699,37 +794,41 @@ cdef class TlenHelper:
         self.s = 0
         self.sq = 0
 
-    cdef void update(self, int64_t x):
+    cdef void update(self, int64_t x) noexcept nogil:
         self.n += 1
         self.s += x
         self.sq += x ** 2
+        if not self.track_var:
+            return
         self.d = x - self.m
         self.m += self.d / self.n
         self.d2 = x - self.m
         self.m2 += self.d * self.d2
 
-    def variance(self):
+    cdef int32_t variance(self) noexcept nogil:
         if self.n < 2:
             return 0
         else:
-            return int(round(self.m2 / (self.n - 1)))
+            return <int32_t> rint(self.m2 / (self.n - 1))
 
-    def std(self):
+    cdef int32_t std(self) noexcept nogil:
         if self.n < 2:
             return 0
         else:
-            return int(round(sqrt(self.m2 / (self.n - 1))))
+            return <int32_t> rint(sqrt(self.m2 / (self.n - 1)))
 
-    def mean(self):
+    cdef int32_t mean(self) noexcept nogil:
         return mean(self.s, self.n)
 
-    def rms(self):
+    cdef int32_t rms(self) noexcept nogil:
         return rootmean(self.sq, self.n)
 
 
 # noinspection PyAttributeOutsideInit
 cdef class Tlen(PileupStat):
 
+    fields = value_fields(config.dtype_tlen)
+
     cdef:
         int reads_all
         TlenHelper tlen
@@ -740,12 +839,12 @@ cdef class Tlen(PileupStat):
         self.tlen_pp = TlenHelper()
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.reads_all = 0
         self.tlen.reset()
         self.tlen_pp.reset()
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
@@ -768,23 +867,27 @@ cdef class Tlen(PileupStat):
         if is_proper_pair:
             self.tlen_pp.update(tlen)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
 
-        # make record
-        rec = {'reads_all': self.reads_all,
-               'reads_paired': self.tlen.n,
-               'reads_pp': self.tlen_pp.n,
-               'mean_tlen': self.tlen.mean(),
-               'mean_tlen_pp': self.tlen_pp.mean(),
-               'rms_tlen': self.tlen.rms(),
-               'rms_tlen_pp': self.tlen_pp.rms(),
-               'std_tlen': self.tlen.std(),
-               'std_tlen_pp': self.tlen_pp.std()}
+        # write values in dtype order
+        out[0] = self.reads_all
+        out[1] = self.tlen.n
+        out[2] = self.tlen_pp.n
+        out[3] = self.tlen.mean()
+        out[4] = self.tlen_pp.mean()
+        out[5] = self.tlen.rms()
+        out[6] = self.tlen_pp.rms()
+        out[7] = self.tlen.std()
+        out[8] = self.tlen_pp.std()
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        # the running variance is only needed for standard deviations
+        self.tlen.track_var = 'std_tlen' in fields
+        self.tlen_pp.track_var = 'std_tlen_pp' in fields
+        return 0
 
 
 ####################################
@@ -795,16 +898,17 @@ cdef class Tlen(PileupStat):
 # noinspection PyAttributeOutsideInit
 cdef class TlenStrand(PileupStat):
 
+    fields = value_fields(config.dtype_tlen_strand)
+
     cdef:
-        int reads_all
-        int reads_fwd
-        int reads_rev
+        int32_t reads[STRAND_N]
         TlenHelper tlen
         TlenHelper tlen_fwd
         TlenHelper tlen_rev
         TlenHelper tlen_pp
         TlenHelper tlen_pp_fwd
         TlenHelper tlen_pp_rev
+        bint count_strand
 
     def __init__(self):
         self.tlen = TlenHelper()
@@ -813,12 +917,11 @@ cdef class TlenStrand(PileupStat):
         self.tlen_pp = TlenHelper()
         self.tlen_pp_fwd = TlenHelper()
         self.tlen_pp_rev = TlenHelper()
+        self.count_strand = True
         self.reset()
 
-    def reset(self):
-        self.reads_all = 0
-        self.reads_fwd = 0
-        self.reads_rev = 0
+    cdef void reset(self) noexcept nogil:
+        memset(self.reads, 0, sizeof(self.reads))
         self.tlen.reset()
         self.tlen_fwd.reset()
         self.tlen_rev.reset()
@@ -826,7 +929,7 @@ cdef class TlenStrand(PileupStat):
         self.tlen_pp_fwd.reset()
         self.tlen_pp_rev.reset()
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
@@ -844,63 +947,67 @@ cdef class TlenStrand(PileupStat):
         tlen = read.b.core.isize
 
         # do the counting
-        self.reads_all += 1
-        if is_reverse:
-            self.reads_rev += 1
-        else:
-            self.reads_fwd += 1
+        incr_strand(self.reads, is_reverse)
 
         # N.B. insert size is only meaningful if mate is mapped to same chromosome
         if not mate_is_unmapped and not mate_other_chr:
             self.tlen.update(tlen)
-            if is_reverse:
-                self.tlen_rev.update(tlen)
-            else:
-                self.tlen_fwd.update(tlen)
+            if self.count_strand:
+                if is_reverse:
+                    self.tlen_rev.update(tlen)
+                else:
+                    self.tlen_fwd.update(tlen)
         if is_proper_pair:
             self.tlen_pp.update(tlen)
-            if is_reverse:
-                self.tlen_pp_rev.update(tlen)
-            else:
-                self.tlen_pp_fwd.update(tlen)
-
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
-
-        # make record
-        rec = {
-            'reads_all': self.reads_all,
-            'reads_fwd': self.reads_fwd,
-            'reads_rev': self.reads_rev,
-            'reads_paired': self.tlen.n,
-            'reads_paired_fwd': self.tlen_fwd.n,
-            'reads_paired_rev': self.tlen_rev.n,
-            'reads_pp': self.tlen_pp.n,
-            'reads_pp_fwd': self.tlen_pp_fwd.n,
-            'reads_pp_rev': self.tlen_pp_rev.n,
-            'mean_tlen': self.tlen.mean(),
-            'mean_tlen_fwd': self.tlen_fwd.mean(),
-            'mean_tlen_rev': self.tlen_rev.mean(),
-            'mean_tlen_pp': self.tlen_pp.mean(),
-            'mean_tlen_pp_fwd': self.tlen_pp_fwd.mean(),
-            'mean_tlen_pp_rev': self.tlen_pp_rev.mean(),
-            'rms_tlen': self.tlen.rms(),
-            'rms_tlen_fwd': self.tlen_fwd.rms(),
-            'rms_tlen_rev': self.tlen_rev.rms(),
-            'rms_tlen_pp': self.tlen_pp.rms(),
-            'rms_tlen_pp_fwd': self.tlen_pp_fwd.rms(),
-            'rms_tlen_pp_rev': self.tlen_pp_rev.rms(),
-            'std_tlen': self.tlen.std(),
-            'std_tlen_fwd': self.tlen_fwd.std(),
-            'std_tlen_rev': self.tlen_rev.std(),
-            'std_tlen_pp': self.tlen_pp.std(),
-            'std_tlen_pp_fwd': self.tlen_pp_fwd.std(),
-            'std_tlen_pp_rev': self.tlen_pp_rev.std(),
-        }
+            if self.count_strand:
+                if is_reverse:
+                    self.tlen_pp_rev.update(tlen)
+                else:
+                    self.tlen_pp_fwd.update(tlen)
+
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
+
+        # write values in dtype order
+        memcpy(out, self.reads, sizeof(self.reads))
+        out[3] = self.tlen.n
+        out[4] = self.tlen_fwd.n
+        out[5] = self.tlen_rev.n
+        out[6] = self.tlen_pp.n
+        out[7] = self.tlen_pp_fwd.n
+        out[8] = self.tlen_pp_rev.n
+        out[9] = self.tlen.mean()
+        out[10] = self.tlen_fwd.mean()
+        out[11] = self.tlen_rev.mean()
+        out[12] = self.tlen_pp.mean()
+        out[13] = self.tlen_pp_fwd.mean()
+        out[14] = self.tlen_pp_rev.mean()
+        out[15] = self.tlen.rms()
+        out[16] = self.tlen_fwd.rms()
+        out[17] = self.tlen_rev.rms()
+        out[18] = self.tlen_pp.rms()
+        out[19] = self.tlen_pp_fwd.rms()
+        out[20] = self.tlen_pp_rev.rms()
+        out[21] = self.tlen.std()
+        out[22] = self.tlen_fwd.std()
+        out[23] = self.tlen_rev.std()
+        out[24] = self.tlen_pp.std()
+        out[25] = self.tlen_pp_fwd.std()
+        out[26] = self.tlen_pp_rev.std()
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        # insert sizes by strand are only needed for fields by strand, and the
+        # running variance only for standard deviations
+        self.count_strand = selects(fields, ('fwd', 'rev'))
+        self.tlen.track_var = 'std_tlen' in fields
+        self.tlen_fwd.track_var = 'std_tlen_fwd' in fields
+        self.tlen_rev.track_var = 'std_tlen_rev' in fields
+        self.tlen_pp.track_var = 'std_tlen_pp' in fields
+        self.tlen_pp_fwd.track_var = 'std_tlen_pp_fwd' in fields
+        self.tlen_pp_rev.track_var = 'std_tlen_pp_rev' in fields
+        return 0
 
 
 ##############################
@@ -919,13 +1026,13 @@ cdef class MapqHelper:
     def __init__(self):
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.n = 0
         self.nz = 0
         self.max = 0
         self.sqsum = 0
 
-    cdef void update(self, uint64_t mapq):
+    cdef void update(self, uint64_t mapq) noexcept nogil:
         self.n += 1
         if mapq == 0:
             self.nz += 1
@@ -933,27 +1040,31 @@ cdef class MapqHelper:
             self.max = mapq
         self.sqsum += mapq**2
 
-    def rms(self):
+    cdef int32_t rms(self) noexcept nogil:
         return rootmean(self.sqsum, self.n)
 
 
 # noinspection PyAttributeOutsideInit
 cdef class Mapq(PileupStat):
 
+    fields = value_fields(config.dtype_mapq)
+
     cdef:
         MapqHelper all
         MapqHelper pp
+        bint count_pp
 
     def __init__(self):
         self.all = MapqHelper()
         self.pp = MapqHelper()
+        self.count_pp = True
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.all.reset()
         self.pp.reset()
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
@@ -967,25 +1078,27 @@ cdef class Mapq(PileupStat):
         # do the counting
         mapq = read.b.core.qual
         self.all.update(mapq)
-        if is_proper_pair:
+        if self.count_pp and is_proper_pair:
             self.pp.update(mapq)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
 
-        # make record
-        rec = {'reads_all': self.all.n,
-               'reads_pp': self.pp.n,
-               'reads_mapq0': self.all.nz,
-               'reads_mapq0_pp': self.pp.nz,
-               'rms_mapq': self.all.rms(),
-               'rms_mapq_pp': self.pp.rms(),
-               'max_mapq': self.all.max,
-               'max_mapq_pp': self.pp.max}
+        # write values in dtype order
+        out[0] = self.all.n
+        out[1] = self.pp.n
+        out[2] = self.all.nz
+        out[3] = self.pp.nz
+        out[4] = self.all.rms()
+        out[5] = self.pp.rms()
+        out[6] = self.all.max
+        out[7] = self.pp.max
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        self.count_pp = selects(fields, ('pp',))
+        return 0
 
 
 ########################################
@@ -996,6 +1109,8 @@ cdef class Mapq(PileupStat):
 # noinspection PyAttributeOutsideInit
 cdef class MapqStrand(PileupStat):
 
+    fields = value_fields(config.dtype_mapq_strand)
+
     cdef:
         MapqHelper all
         MapqHelper fwd
@@ -1003,6 +1118,8 @@ cdef class MapqStrand(PileupStat):
         MapqHelper pp
         MapqHelper pp_fwd
         MapqHelper pp_rev
+        bint count_strand
+        bint count_pp
 
     def __init__(self):
         self.all = MapqHelper()
@@ -1011,9 +1128,11 @@ cdef class MapqStrand(PileupStat):
         self.pp = MapqHelper()
         self.pp_fwd = MapqHelper()
         self.pp_rev = MapqHelper()
+        self.count_strand = True
+        self.count_pp = True
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.all.reset()
         self.fwd.reset()
         self.rev.reset()
@@ -1021,7 +1140,7 @@ cdef class MapqStrand(PileupStat):
         self.pp_fwd.reset()
         self.pp_rev.reset()
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
@@ -1037,51 +1156,54 @@ cdef class MapqStrand(PileupStat):
         # do the counting
         mapq = read.b.core.qual
         self.all.update(mapq)
-        if is_reverse:
-            self.rev.update(mapq)
-        else:
-            self.fwd.update(mapq)
-        if is_proper_pair:
-            self.pp.update(mapq)
+        if self.count_strand:
             if is_reverse:
-                self.pp_rev.update(mapq)
+                self.rev.update(mapq)
             else:
-                self.pp_fwd.update(mapq)
-
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
-
-        # make record
-        rec = {
-            'reads_all': self.all.n,
-            'reads_fwd': self.fwd.n,
-            'reads_rev': self.rev.n,
-            'reads_pp': self.pp.n,
-            'reads_pp_fwd': self.pp_fwd.n,
-            'reads_pp_rev': self.pp_rev.n,
-            'reads_mapq0': self.all.nz,
-            'reads_mapq0_fwd': self.fwd.nz,
-            'reads_mapq0_rev': self.rev.nz,
-            'reads_mapq0_pp': self.pp.nz,
-            'reads_mapq0_pp_fwd': self.pp_fwd.nz,
-            'reads_mapq0_pp_rev': self.pp_rev.nz,
-            'rms_mapq': self.all.rms(),
-            'rms_mapq_fwd': self.fwd.rms(),
-            'rms_mapq_rev': self.rev.rms(),
-            'rms_mapq_pp': self.pp.rms(),
-            'rms_mapq_pp_fwd': self.pp_fwd.rms(),
-            'rms_mapq_pp_rev': self.pp_rev.rms(),
-            'max_mapq': self.all.max,
-            'max_mapq_fwd': self.fwd.max,
-            'max_mapq_rev': self.rev.max,
-            'max_mapq_pp': self.pp.max,
-            'max_mapq_pp_fwd': self.pp_fwd.max,
-            'max_mapq_pp_rev': self.pp_rev.max,
-        }
+                self.fwd.update(mapq)
+        if self.count_pp and is_proper_pair:
+            self.pp.update(mapq)
+            if self.count_strand:
+                if is_reverse:
+                    self.pp_rev.update(mapq)
+                else:
+                    self.pp_fwd.update(mapq)
+
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
+
+        # write values in dtype order
+        out[0] = self.all.n
+        out[1] = self.fwd.n
+        out[2] = self.rev.n
+        out[3] = self.pp.n
+        out[4] = self.pp_fwd.n
+        out[5] = self.pp_rev.n
+        out[6] = self.all.nz
+        out[7] = self.fwd.nz
+        out[8] = self.rev.nz
+        out[9] = self.pp.nz
+        out[10] = self.pp_fwd.nz
+        out[11] = self.pp_rev.nz
+        out[12] = self.all.rms()
+        out[13] = self.fwd.rms()
+        out[14] = self.rev.rms()
+        out[15] = self.pp.rms()
+        out[16] = self.pp_fwd.rms()
+        out[17] = self.pp_rev.rms()
+        out[18] = self.all.max
+        out[19] = self.fwd.max
+        out[20] = self.rev.max
+        out[21] = self.pp.max
+        out[22] = self.pp_fwd.max
+        out[23] = self.pp_rev.max
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        self.count_strand = selects(fields, ('fwd', 'rev'))
+        self.count_pp = selects(fields, ('pp',))
+        return 0
 
 
 ###########################
@@ -1100,18 +1222,18 @@ cdef class BaseqHelper:
     def __init__(self):
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.n = 0
         self.n_nodel = 0
         self.sqsum = 0
 
-    cdef void update(self, int64_t baseq_squared):
+    cdef void update(self, int64_t baseq_squared) noexcept nogil:
         self.n += 1
         if baseq_squared >= 0:
             self.n_nodel += 1
             self.sqsum += baseq_squared
 
-    def rms(self):
+    cdef int32_t rms(self) noexcept nogil:
         return rootmean(self.sqsum, self.n_nodel)
 
 
@@ -1127,11 +1249,11 @@ cdef class BaseqPpHelper:
         self.pp = BaseqHelper()
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.all.reset()
         self.pp.reset()
 
-    cdef void update(self, int64_t baseq_squared, bint is_proper_pair):
+    cdef void update(self, int64_t baseq_squared, bint is_proper_pair) noexcept nogil:
         self.all.update(baseq_squared)
         if is_proper_pair:
             self.pp.update(baseq_squared)
@@ -1140,17 +1262,21 @@ cdef class BaseqPpHelper:
 # noinspection PyAttributeOutsideInit
 cdef class Baseq(PileupStat):
 
+    fields = value_fields(config.dtype_baseq)
+
     cdef:
         BaseqPpHelper helper
+        bint read_qual
 
     def __init__(self):
         self.helper = BaseqPpHelper()
+        self.read_qual = True
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.helper.reset()
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
@@ -1162,26 +1288,27 @@ cdef class Baseq(PileupStat):
         is_proper_pair = <bint>(flag & BAM_FPROPER_PAIR)
 
         # do the counting
-        if not read.is_del:
-            baseq = pysam_bam_get_qual(read.b)[read.qpos]
+        if self.read_qual and not read.is_del:
+            baseq = bam_get_qual(read.b)[read.qpos]
             baseq_squared = baseq**2
 
         self.helper.update(baseq_squared, is_proper_pair)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
 
-        # make record
-        rec = {
-            'reads_all': self.helper.all.n,
-            'reads_pp': self.helper.pp.n,
-            'rms_baseq': self.helper.all.rms(),
-            'rms_baseq_pp': self.helper.pp.rms(),
-        }
+        # write values in dtype order
+        out[0] = self.helper.all.n
+        out[1] = self.helper.pp.n
+        out[2] = self.helper.all.rms()
+        out[3] = self.helper.pp.rms()
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        # base qualities are only needed for their root mean square
+        self.read_qual = selects(fields, ('baseq',))
+        return 0
 
 
 # noinspection PyAttributeOutsideInit
@@ -1194,6 +1321,7 @@ cdef class BaseqStrandPpHelper:
         BaseqHelper pp
         BaseqHelper pp_fwd
         BaseqHelper pp_rev
+        bint count_strand
 
     def __init__(self):
         self.all = BaseqHelper()
@@ -1202,9 +1330,10 @@ cdef class BaseqStrandPpHelper:
         self.pp = BaseqHelper()
         self.pp_fwd = BaseqHelper()
         self.pp_rev = BaseqHelper()
+        self.count_strand = True
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.all.reset()
         self.fwd.reset()
         self.rev.reset()
@@ -1212,34 +1341,41 @@ cdef class BaseqStrandPpHelper:
         self.pp_fwd.reset()
         self.pp_rev.reset()
 
-    cdef void update(self, int64_t baseq_squared, bint is_proper_pair, bint is_reverse):
+    cdef void update(self, int64_t baseq_squared, bint is_proper_pair,
+                     bint is_reverse) noexcept nogil:
         self.all.update(baseq_squared)
-        if is_reverse:
-            self.rev.update(baseq_squared)
-        else:
-            self.fwd.update(baseq_squared)
-        if is_proper_pair:
-            self.pp.update(baseq_squared)
+        if self.count_strand:
             if is_reverse:
-                self.pp_rev.update(baseq_squared)
+                self.rev.update(baseq_squared)
             else:
-                self.pp_fwd.update(baseq_squared)
+                self.fwd.update(baseq_squared)
+        if is_proper_pair:
+            self.pp.update(baseq_squared)
+            if self.count_strand:
+                if is_reverse:
+                    self.pp_rev.update(baseq_squared)
+                else:
+                    self.pp_fwd.update(baseq_squared)
 
 
 # noinspection PyAttributeOutsideInit
 cdef class BaseqStrand(PileupStat):
 
+    fields = value_fields(config.dtype_baseq_strand)
+
     cdef:
         BaseqStrandPpHelper helper
+        bint read_qual
 
     def __init__(self):
         self.helper = BaseqStrandPpHelper()
+        self.read_qual = True
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.helper.reset()
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
@@ -1253,34 +1389,36 @@ cdef class BaseqStrand(PileupStat):
         is_reverse = <bint>(flag & BAM_FREVERSE)
 
         # do the counting
-        if not read.is_del:
-            baseq = pysam_bam_get_qual(read.b)[read.qpos]
+        if self.read_qual and not read.is_del:
+            baseq = bam_get_qual(read.b)[read.qpos]
             baseq_squared = baseq**2
 
         self.helper.update(baseq_squared, is_proper_pair, is_reverse)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
-
-        # make record
-        rec = {
-            'reads_all': self.helper.all.n,
-            'reads_fwd': self.helper.fwd.n,
-            'reads_rev': self.helper.rev.n,
-            'reads_pp': self.helper.pp.n,
-            'reads_pp_fwd': self.helper.pp_fwd.n,
-            'reads_pp_rev': self.helper.pp_rev.n,
-            'rms_baseq': self.helper.all.rms(),
-            'rms_baseq_fwd': self.helper.fwd.rms(),
-            'rms_baseq_rev': self.helper.rev.rms(),
-            'rms_baseq_pp': self.helper.pp.rms(),
-            'rms_baseq_pp_fwd': self.helper.pp_fwd.rms(),
-            'rms_baseq_pp_rev': self.helper.pp_rev.rms(),
-        }
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
+
+        # write values in dtype order
+        out[0] = self.helper.all.n
+        out[1] = self.helper.fwd.n
+        out[2] = self.helper.rev.n
+        out[3] = self.helper.pp.n
+        out[4] = self.helper.pp_fwd.n
+        out[5] = self.helper.pp_rev.n
+        out[6] = self.helper.all.rms()
+        out[7] = self.helper.fwd.rms()
+        out[8] = self.helper.rev.rms()
+        out[9] = self.helper.pp.rms()
+        out[10] = self.helper.pp_fwd.rms()
+        out[11] = self.helper.pp_rev.rms()
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        # base qualities are only needed for their root mean square
+        self.read_qual = selects(fields, ('baseq',))
+        self.helper.count_strand = selects(fields, ('fwd', 'rev'))
+        return 0
 
 
 ####################################
@@ -1291,30 +1429,34 @@ cdef class BaseqStrand(PileupStat):
 # noinspection PyAttributeOutsideInit
 cdef class BaseqExt(PileupStat):
 
+    fields = value_fields(config.dtype_baseq_ext)
+
     cdef:
         BaseqPpHelper all
         BaseqPpHelper matches
         BaseqPpHelper mismatches
+        bint count_seq
 
     def __init__(self):
         self.all = BaseqPpHelper()
         self.matches = BaseqPpHelper()
         self.mismatches = BaseqPpHelper()
+        self.count_seq = True
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.all.reset()
         self.matches.reset()
         self.mismatches.reset()
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
             bint is_reverse
             int64_t baseq = -1
             int64_t baseq_squared = -1
-            bytes alnbase
+            int alnnt
 
         # convenience variables
         flag = read.b.core.flag
@@ -1323,73 +1465,74 @@ cdef class BaseqExt(PileupStat):
 
         # do the counting
         if not read.is_del:
-            baseq = pysam_bam_get_qual(read.b)[read.qpos]
+            baseq = bam_get_qual(read.b)[read.qpos]
             baseq_squared = baseq**2
 
         self.all.update(baseq_squared, is_proper_pair)
-        if not read.is_del:
-            alnbase = get_seq_base(read.b, read.qpos)
-            if alnbase == refbase:
+        if self.count_seq and not read.is_del:
+            alnnt = seq_nt16(read.b, read.qpos)
+            if alnnt >= 0 and alnnt == refnt:
                 self.matches.update(baseq_squared, is_proper_pair)
             else:
                 self.mismatches.update(baseq_squared, is_proper_pair)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
-
-        # make record
-        if PY2:
-            ref = refbase
-        else:
-            ref = str(refbase, 'ascii')
-        rec = {
-            'ref': ref,
-            'reads_all': self.all.all.n,
-            'reads_pp': self.all.pp.n,
-            'matches': self.matches.all.n,
-            'matches_pp': self.matches.pp.n,
-            'mismatches': self.mismatches.all.n,
-            'mismatches_pp': self.mismatches.pp.n,
-            'rms_baseq': self.all.all.rms(),
-            'rms_baseq_pp': self.all.pp.rms(),
-            'rms_baseq_matches': self.matches.all.rms(),
-            'rms_baseq_matches_pp': self.matches.pp.rms(),
-            'rms_baseq_mismatches': self.mismatches.all.rms(),
-            'rms_baseq_mismatches_pp': self.mismatches.pp.rms(),
-        }
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
+
+        # write values in dtype order
+        out[0] = refc
+        out[1] = self.all.all.n
+        out[2] = self.all.pp.n
+        out[3] = self.matches.all.n
+        out[4] = self.matches.pp.n
+        out[5] = self.mismatches.all.n
+        out[6] = self.mismatches.pp.n
+        out[7] = self.all.all.rms()
+        out[8] = self.all.pp.rms()
+        out[9] = self.matches.all.rms()
+        out[10] = self.matches.pp.rms()
+        out[11] = self.mismatches.all.rms()
+        out[12] = self.mismatches.pp.rms()
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        # the aligned base is only needed for match and mismatch values
+        self.count_seq = selects(fields, ('matches', 'mismatches'))
+        return 0
 
 
 # noinspection PyAttributeOutsideInit
 cdef class BaseqExtStrand(PileupStat):
 
+    fields = value_fields(config.dtype_baseq_ext_strand)
+
     cdef:
         BaseqStrandPpHelper all
         BaseqStrandPpHelper matches
         BaseqStrandPpHelper mismatches
+        bint count_seq
 
     def __init__(self):
         self.all = BaseqStrandPpHelper()
         self.matches = BaseqStrandPpHelper()
         self.mismatches = BaseqStrandPpHelper()
+        self.count_seq = True
         self.reset()
 
-    def reset(self):
+    cdef void reset(self) noexcept nogil:
         self.all.reset()
         self.matches.reset()
         self.mismatches.reset()
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             uint32_t flag
             bint is_proper_pair
             bint is_reverse
             int64_t baseq = -1
             int64_t baseq_squared = -1
-            bytes alnbase
+            int alnnt
 
         # convenience variables
         flag = read.b.core.flag
@@ -1398,68 +1541,65 @@ cdef class BaseqExtStrand(PileupStat):
 
         # do the counting
         if not read.is_del:
-            baseq = pysam_bam_get_qual(read.b)[read.qpos]
+            baseq = bam_get_qual(read.b)[read.qpos]
             baseq_squared = baseq**2
 
         self.all.update(baseq_squared, is_proper_pair, is_reverse)
-        if not read.is_del:
-            alnbase = get_seq_base(read.b, read.qpos)
-            if alnbase == refbase:
+        if self.count_seq and not read.is_del:
+            alnnt = seq_nt16(read.b, read.qpos)
+            if alnnt >= 0 and alnnt == refnt:
                 self.matches.update(baseq_squared, is_proper_pair, is_reverse)
             else:
                 self.mismatches.update(baseq_squared, is_proper_pair, is_reverse)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
-
-        # make record
-        if PY2:
-            ref = refbase
-        else:
-            ref = str(refbase, 'ascii')
-        rec = {
-            'ref': ref,
-            'reads_all': self.all.all.n,
-            'reads_fwd': self.all.fwd.n,
-            'reads_rev': self.all.rev.n,
-            'reads_pp': self.all.pp.n,
-            'reads_pp_fwd': self.all.pp_fwd.n,
-            'reads_pp_rev': self.all.pp_rev.n,
-            'matches': self.matches.all.n,
-            'matches_fwd': self.matches.fwd.n,
-            'matches_rev': self.matches.rev.n,
-            'matches_pp': self.matches.pp.n,
-            'matches_pp_fwd': self.matches.pp_fwd.n,
-            'matches_pp_rev': self.matches.pp_rev.n,
-            'mismatches': self.mismatches.all.n,
-            'mismatches_fwd': self.mismatches.fwd.n,
-            'mismatches_rev': self.mismatches.rev.n,
-            'mismatches_pp': self.mismatches.pp.n,
-            'mismatches_pp_fwd': self.mismatches.pp_fwd.n,
-            'mismatches_pp_rev': self.mismatches.pp_rev.n,
-            'rms_baseq': self.all.all.rms(),
-            'rms_baseq_fwd': self.all.fwd.rms(),
-            'rms_baseq_rev': self.all.rev.rms(),
-            'rms_baseq_pp': self.all.pp.rms(),
-            'rms_baseq_pp_fwd': self.all.pp_fwd.rms(),
-            'rms_baseq_pp_rev': self.all.pp_rev.rms(),
-            'rms_baseq_matches': self.matches.all.rms(),
-            'rms_baseq_matches_fwd': self.matches.fwd.rms(),
-            'rms_baseq_matches_rev': self.matches.rev.rms(),
-            'rms_baseq_matches_pp': self.matches.pp.rms(),
-            'rms_baseq_matches_pp_fwd': self.matches.pp_fwd.rms(),
-            'rms_baseq_matches_pp_rev': self.matches.pp_rev.rms(),
-            'rms_baseq_mismatches': self.mismatches.all.rms(),
-            'rms_baseq_mismatches_fwd': self.mismatches.fwd.rms(),
-            'rms_baseq_mismatches_rev': self.mismatches.rev.rms(),
-            'rms_baseq_mismatches_pp': self.mismatches.pp.rms(),
-            'rms_baseq_mismatches_pp_fwd': self.mismatches.pp_fwd.rms(),
-            'rms_baseq_mismatches_pp_rev': self.mismatches.pp_rev.rms(),
-        }
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
+
+        # write values in dtype order
+        out[0] = refc
+        out[1] = self.all.all.n
+        out[2] = self.all.fwd.n
+        out[3] = self.all.rev.n
+        out[4] = self.all.pp.n
+        out[5] = self.all.pp_fwd.n
+        out[6] = self.all.pp_rev.n
+        out[7] = self.matches.all.n
+        out[8] = self.matches.fwd.n
+        out[9] = self.matches.rev.n
+        out[10] = self.matches.pp.n
+        out[11] = self.matches.pp_fwd.n
+        out[12] = self.matches.pp_rev.n
+        out[13] = self.mismatches.all.n
+        out[14] = self.mismatches.fwd.n
+        out[15] = self.mismatches.rev.n
+        out[16] = self.mismatches.pp.n
+        out[17] = self.mismatches.pp_fwd.n
+        out[18] = self.mismatches.pp_rev.n
+        out[19] = self.all.all.rms()
+        out[20] = self.all.fwd.rms()
+        out[21] = self.all.rev.rms()
+        out[22] = self.all.pp.rms()
+        out[23] = self.all.pp_fwd.rms()
+        out[24] = self.all.pp_rev.rms()
+        out[25] = self.matches.all.rms()
+        out[26] = self.matches.fwd.rms()
+        out[27] = self.matches.rev.rms()
+        out[28] = self.matches.pp.rms()
+        out[29] = self.matches.pp_fwd.rms()
+        out[30] = self.matches.pp_rev.rms()
+        out[31] = self.mismatches.all.rms()
+        out[32] = self.mismatches.fwd.rms()
+        out[33] = self.mismatches.rev.rms()
+        out[34] = self.mismatches.pp.rms()
+        out[35] = self.mismatches.pp_fwd.rms()
+        out[36] = self.mismatches.pp_rev.rms()
 
         # reset counters
         self.reset()
 
-        return rec
+    cdef int select(self, fields) except -1:
+        # the aligned base is only needed for match and mismatch values
+        self.count_seq = selects(fields, ('matches', 'mismatches'))
+        return 0
 
 
 #################################################
@@ -1470,8 +1610,12 @@ cdef class BaseqExtStrand(PileupStat):
 # noinspection PyAttributeOutsideInit
 cdef class CoverageGC(PileupStat):
 
+    fields = value_fields(config.dtype_coverage_gc)
+
+    position_dependent = True
+
     cdef:
-        CountPp reads
+        int32_t reads[PP_N]
         int window_size, window_offset
 
     def __init__(self, window_size, window_offset):
@@ -1479,13 +1623,11 @@ cdef class CoverageGC(PileupStat):
         if window_offset is None:
             window_offset = window_size // 2
         self.window_offset = window_offset
-        self.reads = CountPp()
-        self.reset()
 
-    def reset(self):
-        self.reads.reset()
+    cdef void reset(self) noexcept nogil:
+        memset(self.reads, 0, sizeof(self.reads))
 
-    cdef void recv(self, bam_pileup1_t* read, PileupColumn col, bytes refbase):
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
         cdef:
             bint is_proper_pair
 
@@ -1493,30 +1635,132 @@ cdef class CoverageGC(PileupStat):
         is_proper_pair = <bint>(read.b.core.flag & BAM_FPROPER_PAIR)
 
         # do the counting
-        self.reads.incr(is_proper_pair)
+        incr_pp(self.reads, is_proper_pair)
 
-    cdef dict rec(self, chrom, pos, FastaFile fafile, bytes refbase):
+    cdef int put(self, chrom, pos, RefCache ref, int refc, int32_t* out) except -1:
+        cdef:
+            int gc_count
+            Py_ssize_t n
 
         # compute GC
         ref_window_start = pos - self.window_offset
         ref_window_end = ref_window_start + self.window_size
         if ref_window_start < 0:
             ref_window_start = 0
-        ref_window = fafile.fetch(chrom, ref_window_start, ref_window_end).lower()
-        if len(ref_window) == 0:
+        gc_count = get_gc_count(ref, chrom, ref_window_start, ref_window_end, &n)
+        if n == 0:
             gc = -1
         else:
-            gc = gc_content(ref_window)
+            gc = gc_content(gc_count, n)
 
-        # make record
-        rec = {'reads_all': self.reads.all,
-               'reads_pp': self.reads.pp,
-               'gc': gc}
+        # write values in dtype order
+        out[0] = gc
+        memcpy(out + 1, self.reads, sizeof(self.reads))
 
         # reset counters
         self.reset()
 
-        return rec
+        return 0
+
+
+#################################
+# MULTIPLE STATISTICS IN A PASS #
+#################################
+
+
+cdef class MultiPileupStat(PileupStat):
+    """Several statistics computed in a single pass over the pileup, where each
+    read is passed to every statistic. Records are merged, and a field computed
+    by more than one statistic takes its value from the first. If `fields` is
+    given, records hold only those fields, and the statistics skip work which
+    is only needed for other fields."""
+
+    cdef:
+        readonly tuple fields
+        readonly bint position_dependent
+        readonly bint uses_read_props
+        readonly tuple stats
+        PileupStat first
+        int32_t* buf
+        Py_ssize_t* offsets
+        Py_ssize_t* index
+        Py_ssize_t nfields
+
+    def __init__(self, stats, fields=None):
+        cdef Py_ssize_t i
+        cdef PileupStat stat
+
+        self.stats = tuple(stats)
+        if not self.stats:
+            raise ValueError('no statistics')
+
+        # chain the statistics, so each is passed reads without the GIL
+        self.first = self.stats[0]
+        for i, stat in enumerate(self.stats[:-1]):
+            stat.next = self.stats[i + 1]
+        self.position_dependent = any(stat.position_dependent for stat in self.stats)
+        self.uses_read_props = any(stat.uses_read_props for stat in self.stats)
+
+        # values from all statistics are written side by side into buf
+        all_fields = list()
+        self.offsets = <Py_ssize_t*> malloc(max(1, len(self.stats)) * sizeof(Py_ssize_t))
+        if self.offsets == NULL:
+            raise MemoryError()
+        for i, stat in enumerate(self.stats):
+            self.offsets[i] = len(all_fields)
+            all_fields.extend(stat.fields)
+        self.buf = <int32_t*> malloc(max(1, len(all_fields)) * sizeof(int32_t))
+        if self.buf == NULL:
+            raise MemoryError()
+
+        # merged fields, first occurrence wins
+        merged = list()
+        for f in all_fields:
+            if f not in merged:
+                merged.append(f)
+        if fields is None:
+            fields = merged
+        else:
+            if any(f not in merged for f in fields):
+                raise ValueError('invalid fields: %r' % (fields,))
+            fields = [f for f in merged if f in fields]
+            for stat in self.stats:
+                stat.select(fields)
+        self.fields = tuple(fields)
+        self.nfields = len(fields)
+        self.index = <Py_ssize_t*> malloc(max(1, len(fields)) * sizeof(Py_ssize_t))
+        if self.index == NULL:
+            raise MemoryError()
+        for i, f in enumerate(fields):
+            self.index[i] = all_fields.index(f)
+
+    def __dealloc__(self):
+        free(self.buf)
+        free(self.offsets)
+        free(self.index)
+
+    cdef void recv(self, bam_pileup1_t* read, int refnt) noexcept nogil:
+        self.first.recv_chain(read, refnt)
+
+    cdef int put(self, chrom, pos, RefCache ref, int refc, int32_t* out) except -1:
+        cdef:
+            Py_ssize_t i
+            PileupStat stat
+
+        for i, stat in enumerate(self.stats):
+            stat.put(chrom, pos, ref, refc, self.buf + self.offsets[i])
+        self.merge(out)
+
+        return 0
+
+    cdef void write(self, int refc, int32_t* out) noexcept nogil:
+        self.first.write_chain(refc, self.buf, self.offsets)
+        self.merge(out)
+
+    cdef void merge(self, int32_t* out) noexcept nogil:
+        cdef Py_ssize_t i
+        for i in range(self.nfields):
+            out[i] = self.buf[self.index[i]]
 
 
 ###################
@@ -1524,25 +1768,38 @@ cdef class CoverageGC(PileupStat):
 ###################
 
 
-cdef int gc_content(ref_window) except -1:
-    cdef Py_ssize_t i, n
-    cdef char* seq
-    cdef int gc_count = 0
-    n = len(ref_window)
-    if not PY2:
-        ref_window = ref_window.encode('ascii')
-    seq = ref_window
-    for i in range(n):
-        if seq[i] == b'g' or seq[i] == b'c':
-            gc_count += 1
-    gc = int(round(gc_count * 100. / n))
-    return gc
+cdef int gc_content(int gc_count, Py_ssize_t n) except -1:
+    # rint rounds half to even, as numpy.around
+    return <int> rint(gc_count * 100. / n)
 
 
 cdef class BinnedStat(object):
 
-    cdef dict rec(self, chrom, bin_start, bin_end, FastaFile fafile):
-        return dict()
+    # names of fields written by put(), in dtype order
+    fields = ()
+
+    cdef:
+        int32_t* values
+
+    def __cinit__(self, *args, **kwargs):
+        self.values = <int32_t*> malloc(max(1, len(self.fields)) * sizeof(int32_t))
+        if self.values == NULL:
+            raise MemoryError()
+
+    def __dealloc__(self):
+        free(self.values)
+
+    cdef int put(self, chrom, bin_start, bin_end, RefCache ref, int32_t* out) except -1:
+        """Write values for the current bin into `out`, one per field, then reset
+        counters."""
+        return 0
+
+    cdef dict rec(self, chrom, bin_start, bin_end, RefCache ref):
+        cdef:
+            Py_ssize_t i
+
+        self.put(chrom, bin_start, bin_end, ref, self.values)
+        return {f: self.values[i] for i, f in enumerate(self.fields)}
 
     cdef void recv(self, bam1_t* b):
         pass
@@ -1550,26 +1807,31 @@ cdef class BinnedStat(object):
 
 cdef class CoverageBinned(BinnedStat):
 
+    fields = value_fields(config.dtype_coverage_binned)
+
     cdef int reads_all, reads_pp
 
     def __init__(self):
         self.reads_all = self.reads_pp = 0
 
-    cdef dict rec(self, chrom, bin_start, bin_end, FastaFile fafile):
+    cdef int put(self, chrom, bin_start, bin_end, RefCache ref, int32_t* out) except -1:
+        cdef:
+            int gc_count
+            Py_ssize_t n
 
         # determine %GC
-        ref_window = fafile.fetch(chrom, bin_start, bin_end).lower()
-        gc = gc_content(ref_window)
+        gc_count = get_gc_count(ref, chrom, bin_start, bin_end, &n)
+        gc = gc_content(gc_count, n)
 
-        # make record for bin
-        rec = {'gc': gc,
-               'reads_all': self.reads_all,
-               'reads_pp': self.reads_pp}
+        # write values for bin in dtype order
+        out[0] = gc
+        out[1] = self.reads_all
+        out[2] = self.reads_pp
 
         # reset counters
         self.reads_all = self.reads_pp = 0
 
-        return rec
+        return 0
 
     cdef void recv(self, bam1_t* b):
         cdef uint32_t flag
@@ -1591,6 +1853,8 @@ cdef class CoverageBinned(BinnedStat):
 
 cdef class CoverageExtBinned(BinnedStat):
 
+    fields = value_fields(config.dtype_coverage_ext_binned)
+
     cdef int reads_all, reads_pp, reads_mate_unmapped, reads_mate_other_chr, \
         reads_mate_same_strand, reads_faceaway, reads_softclipped, \
         reads_duplicate
@@ -1601,22 +1865,25 @@ cdef class CoverageExtBinned(BinnedStat):
             = self.reads_faceaway = self.reads_softclipped \
             = self.reads_duplicate = 0
 
-    cdef dict rec(self, chrom, bin_start, bin_end, FastaFile fafile):
+    cdef int put(self, chrom, bin_start, bin_end, RefCache ref, int32_t* out) except -1:
+        cdef:
+            int gc_count
+            Py_ssize_t n
 
         # determine %GC
-        ref_window = fafile.fetch(chrom, bin_start, bin_end).lower()
-        gc = gc_content(ref_window)
-
-        # make record for bin
-        rec = {'gc': gc,
-               'reads_all': self.reads_all,
-               'reads_pp': self.reads_pp,
-               'reads_mate_unmapped': self.reads_mate_unmapped,
-               'reads_mate_other_chr': self.reads_mate_other_chr,
-               'reads_mate_same_strand': self.reads_mate_same_strand,
-               'reads_faceaway': self.reads_faceaway,
-               'reads_softclipped': self.reads_softclipped,
-               'reads_duplicate': self.reads_duplicate}
+        gc_count = get_gc_count(ref, chrom, bin_start, bin_end, &n)
+        gc = gc_content(gc_count, n)
+
+        # write values for bin in dtype order
+        out[0] = gc
+        out[1] = self.reads_all
+        out[2] = self.reads_pp
+        out[3] = self.reads_mate_unmapped
+        out[4] = self.reads_mate_other_chr
+        out[5] = self.reads_mate_same_strand
+        out[6] = self.reads_faceaway
+        out[7] = self.reads_softclipped
+        out[8] = self.reads_duplicate
 
         # reset counters
         self.reads_all = self.reads_pp = self.reads_mate_unmapped \
@@ -1624,7 +1891,7 @@ cdef class CoverageExtBinned(BinnedStat):
             = self.reads_faceaway = self.reads_softclipped \
             = self.reads_duplicate = 0
 
-        return rec
+        return 0
 
     cdef void recv(self, bam1_t* b):
         cdef uint32_t flag
@@ -1669,23 +1936,25 @@ cdef class CoverageExtBinned(BinnedStat):
 
 cdef class MapqBinned(BinnedStat):
 
+    fields = value_fields(config.dtype_mapq_binned)
+
     cdef int reads_all, reads_mapq0
     cdef uint64_t mapq, mapq_squared_sum
 
     def __init__(self):
         self.reads_all = self.reads_mapq0 = self.mapq_squared_sum = 0
 
-    cdef dict rec(self, chrom, bin_start, bin_end, FastaFile fafile):
+    cdef int put(self, chrom, bin_start, bin_end, RefCache ref, int32_t* out) except -1:
 
-        # make record for bin
-        rec = {'reads_all': self.reads_all,
-               'reads_mapq0': self.reads_mapq0,
-               'rms_mapq': rootmean(self.mapq_squared_sum, self.reads_all)}
+        # write values for bin in dtype order
+        out[0] = self.reads_all
+        out[1] = self.reads_mapq0
+        out[2] = rootmean(self.mapq_squared_sum, self.reads_all)
 
         # reset counters
         self.reads_all = self.reads_mapq0 = self.mapq_squared_sum = 0
 
-        return rec
+        return 0
 
     cdef void recv(self, bam1_t* b):
         cdef uint32_t flag
@@ -1710,25 +1979,34 @@ cdef class MapqBinned(BinnedStat):
 
 cdef class AlignmentBinned(BinnedStat):
 
+    fields = value_fields(config.dtype_alignment_binned)
+
     cdef int reads_all, M, I, D, N, S, H, P, EQ, X
 
     def __init__(self):
         self.reads_all = self.M = self.I = self.D = self.N = self.S = self.H\
             = self.P = self.EQ = self.X = 0
 
-    cdef dict rec(self, chrom, bin_start, bin_end, FastaFile fafile):
-
-        # make record for bin
-        rec = {'reads_all': self.reads_all,
-               'M': self.M, 'I': self.I, 'D': self.D, 'N': self.N, 'S': self.S,
-               'H': self.H, 'P': self.P, '=': self.EQ, 'X': self.X,
-               'bases_all': self.M + self.I + self.S + self.EQ + self.X}
+    cdef int put(self, chrom, bin_start, bin_end, RefCache ref, int32_t* out) except -1:
+
+        # write values for bin in dtype order
+        out[0] = self.reads_all
+        out[1] = self.M + self.I + self.S + self.EQ + self.X
+        out[2] = self.M
+        out[3] = self.I
+        out[4] = self.D
+        out[5] = self.N
+        out[6] = self.S
+        out[7] = self.H
+        out[8] = self.P
+        out[9] = self.EQ
+        out[10] = self.X
 
         # reset counters
         self.reads_all = self.M = self.I = self.D = self.N = self.S = self.H\
             = self.P = self.EQ = self.X = 0
 
-        return rec
+        return 0
 
     cdef void recv(self, bam1_t* b):
         cdef uint32_t flag
@@ -1771,6 +2049,8 @@ cdef class AlignmentBinned(BinnedStat):
 
 cdef class TlenBinned(BinnedStat):
 
+    fields = value_fields(config.dtype_tlen_binned)
+
     cdef int reads_all
     cdef int reads_pp
     cdef int64_t tlen_sum
@@ -1782,21 +2062,21 @@ cdef class TlenBinned(BinnedStat):
         self.tlen_sum = self.tlen_squared_sum = self.tlen_pp_sum = \
             self.tlen_pp_squared_sum = self.reads_all = self.reads_pp = 0
 
-    cdef dict rec(self, chrom, bin_start, bin_end, FastaFile fafile):
+    cdef int put(self, chrom, bin_start, bin_end, RefCache ref, int32_t* out) except -1:
 
-        # make record for bin
-        rec = {'reads_all': self.reads_all, 'reads_pp': self.reads_pp,
-               'mean_tlen': mean(self.tlen_sum, self.reads_all),
-               'mean_tlen_pp': mean(self.tlen_pp_sum, self.reads_pp),
-               'rms_tlen': rootmean(self.tlen_squared_sum, self.reads_all),
-               'rms_tlen_pp': rootmean(self.tlen_pp_squared_sum,
-                                       self.reads_pp)}
+        # write values for bin in dtype order
+        out[0] = self.reads_all
+        out[1] = self.reads_pp
+        out[2] = mean(self.tlen_sum, self.reads_all)
+        out[3] = mean(self.tlen_pp_sum, self.reads_pp)
+        out[4] = rootmean(self.tlen_squared_sum, self.reads_all)
+        out[5] = rootmean(self.tlen_pp_squared_sum, self.reads_pp)
 
         # reset counters
         self.tlen_sum = self.tlen_squared_sum = self.tlen_pp_sum = \
             self.tlen_pp_squared_sum = self.reads_all = self.reads_pp = 0
 
-        return rec
+        return 0
 
     cdef void recv(self, bam1_t* b):
         cdef uint32_t flag
@@ -1819,15 +2099,677 @@ cdef class TlenBinned(BinnedStat):
                 self.tlen_pp_squared_sum += tlen_squared
 
 
-#####################
-# UTILITY FUNCTIONS #
-#####################
+##################
+# SCATTER ENGINE #
+##################
 
 
-def iter_pileup(stat, alignmentfile, fafile, pad, **kwargs):
-    """General purpose function to generate statistics, where one record is
+cdef class ScatterStat(object):
+    """Statistics which are sums of per-read values over the reference positions
+    each read covers, and so can be computed by scattering each read's values
+    over its aligned interval instead of via the pileup. Per-read values are
+    written by contrib() into `nsum` channels which are summed and `nmax`
+    channels where the maximum is taken, and put() computes record values from
+    the channel totals at a position."""
+
+    # names of fields written by put(), in dtype order
+    fields = ()
+
+    cdef readonly int nsum, nmax
+
+    cdef void contrib(self, bam1_t* b, int tid, int64_t* s, int64_t* m):
+        pass
+
+    cdef int put(self, int64_t* s, int64_t* m, int32_t* out) except -1:
+        return 0
+
+
+cdef class CoverageScatter(ScatterStat):
+
+    fields = value_fields(config.dtype_coverage)
+
+    def __init__(self):
+        self.nsum = 2
+
+    cdef void contrib(self, bam1_t* b, int tid, int64_t* s, int64_t* m):
+        s[0] = 1
+        s[1] = <bint>(b.core.flag & BAM_FPROPER_PAIR)
+
+    cdef int put(self, int64_t* s, int64_t* m, int32_t* out) except -1:
+        out[0] = s[0]
+        out[1] = s[1]
+        return 0
+
+
+cdef class CoverageStrandScatter(ScatterStat):
+
+    fields = value_fields(config.dtype_coverage_strand)
+
+    def __init__(self):
+        self.nsum = 6
+
+    cdef void contrib(self, bam1_t* b, int tid, int64_t* s, int64_t* m):
+        cdef:
+            bint is_reverse = <bint>(b.core.flag & BAM_FREVERSE)
+            bint is_proper_pair = <bint>(b.core.flag & BAM_FPROPER_PAIR)
+        s[0] = 1
+        s[1] = not is_reverse
+        s[2] = is_reverse
+        s[3] = is_proper_pair
+        s[4] = is_proper_pair and not is_reverse
+        s[5] = is_proper_pair and is_reverse
+
+    cdef int put(self, int64_t* s, int64_t* m, int32_t* out) except -1:
+        cdef int k
+        for k in range(6):
+            out[k] = s[k]
+        return 0
+
+
+cdef class CoverageExtScatter(ScatterStat):
+
+    fields = value_fields(config.dtype_coverage_ext)
+
+    def __init__(self):
+        self.nsum = 8
+
+    cdef void contrib(self, bam1_t* b, int tid, int64_t* s, int64_t* m):
+        cdef:
+            uint32_t flag = b.core.flag
+            bint is_reverse = <bint>(flag & BAM_FREVERSE)
+            bint mate_is_reverse = <bint>(flag & BAM_FMREVERSE)
+            int tlen = b.core.isize
+        s[0] = 1
+        s[1] = <bint>(flag & BAM_FPROPER_PAIR)
+        s[2] = s[3] = s[4] = s[5] = 0
+        if flag & BAM_FMUNMAP:
+            s[2] = 1
+        elif tid != b.core.mtid:
+            s[3] = 1
+        elif is_reverse == mate_is_reverse:
+            s[4] = 1
+        elif (is_reverse and tlen > 0) or (not is_reverse and tlen < 0):
+            s[5] = 1
+        s[6] = is_softclipped(b)
+        s[7] = <bint>(flag & BAM_FDUP)
+
+    cdef int put(self, int64_t* s, int64_t* m, int32_t* out) except -1:
+        cdef int k
+        for k in range(8):
+            out[k] = s[k]
+        return 0
+
+
+cdef class MapqScatter(ScatterStat):
+
+    fields = value_fields(config.dtype_mapq)
+
+    def __init__(self):
+        self.nsum = 6
+        self.nmax = 2
+
+    cdef void contrib(self, bam1_t* b, int tid, int64_t* s, int64_t* m):
+        cdef:
+            int64_t mapq = b.core.qual
+            bint is_proper_pair = <bint>(b.core.flag & BAM_FPROPER_PAIR)
+        s[0] = 1
+        s[1] = is_proper_pair
+        s[2] = mapq == 0
+        s[3] = is_proper_pair and mapq == 0
+        s[4] = mapq * mapq
+        s[5] = mapq * mapq if is_proper_pair else 0
+        m[0] = mapq
+        m[1] = mapq if is_proper_pair else 0
+
+    cdef int put(self, int64_t* s, int64_t* m, int32_t* out) except -1:
+        out[0] = s[0]
+        out[1] = s[1]
+        out[2] = s[2]
+        out[3] = s[3]
+        out[4] = rootmean(s[4], s[0])
+        out[5] = rootmean(s[5], s[1])
+        out[6] = m[0]
+        out[7] = m[1]
+        return 0
+
+
+cdef class TlenScatter(ScatterStat):
+
+    fields = value_fields(config.dtype_tlen)
+
+    def __init__(self):
+        self.nsum = 7
+
+    cdef void contrib(self, bam1_t* b, int tid, int64_t* s, int64_t* m):
+        cdef:
+            uint32_t flag = b.core.flag
+            int64_t tlen = b.core.isize
+            bint has_tlen = not (flag & BAM_FMUNMAP) and b.core.tid == b.core.mtid
+            bint is_proper_pair = <bint>(flag & BAM_FPROPER_PAIR)
+        s[0] = 1
+        # N.B. insert size is only meaningful if mate is mapped to same chromosome
+        s[1] = has_tlen
+        s[2] = tlen if has_tlen else 0
+        s[3] = tlen * tlen if has_tlen else 0
+        s[4] = is_proper_pair
+        s[5] = tlen if is_proper_pair else 0
+        s[6] = tlen * tlen if is_proper_pair else 0
+
+    cdef int put(self, int64_t* s, int64_t* m, int32_t* out) except -1:
+        out[0] = s[0]
+        out[1] = s[1]
+        out[2] = s[4]
+        out[3] = mean(s[2], s[1])
+        out[4] = mean(s[5], s[4])
+        out[5] = rootmean(s[3], s[1])
+        out[6] = rootmean(s[6], s[4])
+        out[7] = std_from_sums(s[2], s[3], s[1])
+        out[8] = std_from_sums(s[5], s[6], s[4])
+        return 0
+
+
+cdef inline int32_t std_from_sums(int64_t total, int64_t sqsum, int64_t count) noexcept nogil:
+    if count < 2:
+        return 0
+    return <int32_t> rint(sqrt((sqsum - <double> total * total / count) / (count - 1)))
+
+
+cdef class Scatter(object):
+    """State for scattering the per-read values of a ScatterStat over the
+    positions of one region and writing records to a batch. Summed channels are
+    held as difference arrays, where channel 0 is the number of reads in the
+    pileup at each position, in buffers which slide along the region as reads
+    are consumed in coordinate order."""
+
+    cdef:
+        ScatterStat stat
+        RecordBatch batch
+        int tid, nch, nmax
+        int64_t start, end, maxend
+        bint truncate, pad, one_based
+        bint begun, added, started
+        int64_t base, cur, pending
+        Py_ssize_t cap
+        int64_t* diff
+        int64_t* mx
+        int64_t* run
+        int64_t* s
+        int64_t* m
+        int64_t* zeros
+
+    def __init__(self, ScatterStat stat, RecordBatch batch, int tid, int64_t start, int64_t end,
+                 bint truncate, bint pad, bint one_based, Py_ssize_t cap=2**16):
+        self.stat = stat
+        self.batch = batch
+        self.tid = tid
+        self.nch = stat.nsum + 1
+        self.nmax = stat.nmax
+        self.start = self.maxend = start
+        self.end = self.pending = end
+        self.truncate = truncate
+        self.pad = pad
+        self.one_based = one_based
+        self.cap = cap
+        self.diff = <int64_t*> calloc(cap * self.nch, sizeof(int64_t))
+        self.mx = <int64_t*> calloc(cap * max(1, self.nmax), sizeof(int64_t))
+        self.run = <int64_t*> calloc(self.nch, sizeof(int64_t))
+        self.s = <int64_t*> calloc(self.nch, sizeof(int64_t))
+        self.m = <int64_t*> calloc(max(1, self.nmax), sizeof(int64_t))
+        self.zeros = <int64_t*> calloc(self.nch + self.nmax, sizeof(int64_t))
+        if (self.diff == NULL or self.mx == NULL or self.run == NULL or self.s == NULL
+                or self.m == NULL or self.zeros == NULL):
+            raise MemoryError()
+
+    def __dealloc__(self):
+        free(self.diff)
+        free(self.mx)
+        free(self.run)
+        free(self.s)
+        free(self.m)
+        free(self.zeros)
+
+    cdef void begin(self, int64_t pos):
+        """Start accumulating from the earlier of the region start and `pos`,
+        the start of the first read."""
+        if not self.begun:
+            self.base = self.cur = min(self.start, pos)
+            self.begun = True
+
+    cdef int reserve(self, int64_t hi) except -1:
+        """Make positions up to and including `hi` addressable, discarding
+        positions already flushed."""
+        cdef:
+            Py_ssize_t shift, keep, cap
+            int64_t* p
+        if hi - self.base < self.cap:
+            return 0
+
+        # slide buffers down to the current position, which may be beyond the
+        # end of the buffers if there is a gap between reads
+        shift = min(self.cur - self.base, self.cap)
+        keep = self.cap - shift
+        memmove(self.diff, self.diff + shift * self.nch, keep * self.nch * sizeof(int64_t))
+        memset(self.diff + keep * self.nch, 0, shift * self.nch * sizeof(int64_t))
+        if self.nmax:
+            memmove(self.mx, self.mx + shift * self.nmax, keep * self.nmax * sizeof(int64_t))
+            memset(self.mx + keep * self.nmax, 0, shift * self.nmax * sizeof(int64_t))
+        self.base = self.cur
+
+        # grow buffers if still too small
+        if hi - self.base >= self.cap:
+            cap = max(2 * self.cap, hi - self.base + 1)
+            p = <int64_t*> realloc(self.diff, cap * self.nch * sizeof(int64_t))
+            if p == NULL:
+                raise MemoryError()
+            memset(p + self.cap * self.nch, 0, (cap - self.cap) * self.nch * sizeof(int64_t))
+            self.diff = p
+            if self.nmax:
+                p = <int64_t*> realloc(self.mx, cap * self.nmax * sizeof(int64_t))
+                if p == NULL:
+                    raise MemoryError()
+                memset(p + self.cap * self.nmax, 0,
+                       (cap - self.cap) * self.nmax * sizeof(int64_t))
+                self.mx = p
+            self.cap = cap
+
+        return 0
+
+    cdef void scatter(self, int64_t lo, int64_t hi):
+        """Add the current read's values over positions from `lo` to `hi`."""
+        cdef:
+            int k
+            int64_t p
+            int64_t* x
+        for k in range(1, self.nch):
+            self.diff[(lo - self.base) * self.nch + k] += self.s[k - 1]
+            self.diff[(hi - self.base) * self.nch + k] -= self.s[k - 1]
+        if self.nmax:
+            for p in range(lo, hi):
+                x = self.mx + (p - self.base) * self.nmax
+                for k in range(self.nmax):
+                    if self.m[k] > x[k]:
+                        x[k] = self.m[k]
+
+    cdef int add(self, bam1_t* b, bint no_del) except -1:
+        """Add a read to the statistics and the number of reads in the pileup."""
+        cdef:
+            uint32_t* cigar_p = pysam_bam_get_cigar(b)
+            int64_t pos = b.core.pos
+            int64_t rend = pos
+            int k, op, l
+
+        # length of alignment on the reference
+        for k in range(b.core.n_cigar):
+            op = cigar_p[k] & BAM_CIGAR_MASK
+            if (op == BAM_CMATCH or op == BAM_CDEL or op == BAM_CREF_SKIP or op == BAM_CEQUAL
+                    or op == BAM_CDIFF):
+                rend += cigar_p[k] >> BAM_CIGAR_SHIFT
+        if rend == pos:
+            return 0
+        self.reserve(rend)
+        self.diff[(pos - self.base) * self.nch] += 1
+        self.diff[(rend - self.base) * self.nch] -= 1
+        self.maxend = max(self.maxend, rend)
+
+        self.stat.contrib(b, self.tid, self.s, self.m)
+        if not no_del:
+            self.scatter(pos, rend)
+        else:
+            # only count positions where a base is aligned
+            for k in range(b.core.n_cigar):
+                op = cigar_p[k] & BAM_CIGAR_MASK
+                l = cigar_p[k] >> BAM_CIGAR_SHIFT
+                if op == BAM_CMATCH or op == BAM_CEQUAL or op == BAM_CDIFF:
+                    self.scatter(pos, pos + l)
+                    pos += l
+                elif op == BAM_CDEL or op == BAM_CREF_SKIP:
+                    pos += l
+
+        return 0
+
+    cdef bint emit(self, int64_t pos, int64_t* s, int64_t* m) except -1:
+        """Write a record, returning False if the batch is full."""
+        cdef int32_t* row
+        if self.batch.full():
+            return False
+        row = self.batch.next_row(self.tid, pos + 1 if self.one_based else pos)
+        self.stat.put(s, m, row)
+        return True
+
+    cdef bint flush(self, int64_t upto) except -1:
+        """Write records for positions before `upto`, which no further reads
+        can cover, returning False if the batch filled up first. Positions are
+        emitted as pileup would, with or without padding and truncation."""
+        cdef:
+            int k
+            int64_t i
+            bint covered
+            int64_t* m
+
+        while self.cur < upto:
+            i = self.cur - self.base
+            if self.cur > self.maxend:
+                # beyond the last read, nothing left in the buffers
+                m = self.zeros + self.nch
+            else:
+                if not self.added:
+                    for k in range(self.nch):
+                        self.run[k] += self.diff[i * self.nch + k]
+                    self.added = True
+                m = self.mx + i * self.nmax
+            covered = self.run[0] > 0
+
+            if not self.pad:
+                if covered and (not self.truncate or self.start <= self.cur < self.end):
+                    if not self.emit(self.cur, self.run + 1, m):
+                        return False
+
+            elif self.truncate or self.start <= self.cur < self.end:
+                if self.start <= self.cur < self.end:
+                    if not self.emit(self.cur, self.run + 1, m):
+                        return False
+
+            elif self.cur < self.start:
+                # padding starts at the first covered position before the region
+                self.started = self.started or covered
+                if self.started:
+                    if not self.emit(self.cur, self.run + 1, m):
+                        return False
+
+            elif covered:
+                # pad up to a covered position beyond the region
+                while self.pending < self.cur:
+                    if not self.emit(self.pending, self.zeros, self.zeros + self.nch):
+                        return False
+                    self.pending += 1
+                if not self.emit(self.cur, self.run + 1, m):
+                    return False
+                self.pending = self.cur + 1
+
+            self.cur += 1
+            self.added = False
+
+        return True
+
+
+def fill_scatter_batches(stat, RecordBatch batch, alignmentfile, chrom, **kwargs):
+    """Fill `batch` with records computed by the scatter engine, yielding each
+    time the batch is ready to be consumed."""
+
+    if chrom is not None:
+        it = fill_scatter_batches_chrom(stat, batch, alignmentfile=alignmentfile, chrom=chrom,
+                                        **kwargs)
+    else:
+        its = list()
+        for chrom in alignmentfile.references:
+            itc = fill_scatter_batches_chrom(stat, batch, alignmentfile=alignmentfile,
+                                             chrom=chrom, **kwargs)
+            its.append(itc)
+        it = itertools.chain(*its)
+    for _ in it:
+        yield
+    if batch.n:
+        yield
+
+
+def fill_scatter_batches_chrom(ScatterStat stat, RecordBatch batch, AlignmentFile alignmentfile,
+                               chrom, start, end, one_based, truncate, pad, stepper, max_depth,
+                               int min_mapq, int min_baseq, bint no_del, bint no_dup,
+                               int flag_require, int flag_filter):
+    cdef:
+        IteratorRowRegion it
+        bam1_t* b
+        Scatter sc
+        uint32_t flag_skip
+
+    # read filters applied by the pileup stepper
+    if stepper == 'all':
+        flag_skip = BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL | BAM_FDUP
+    elif stepper == 'nofilter':
+        flag_skip = BAM_FUNMAP
+    else:
+        raise ValueError('stepper %r is not supported by the scatter engine' % stepper)
+    flag_skip |= read_flag_filter(flag_filter, no_dup)
+    if min_baseq > 0:
+        raise ValueError('min_baseq is not supported by the scatter engine')
+
+    # setup
+    assert chrom is not None, 'chromosome is None'
+    start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
+    tid = alignmentfile.get_tid(chrom)
+    sc = Scatter(stat, batch, tid, start, end, truncate, pad, one_based)
+    it = IteratorRowRegion(alignmentfile, tid, start, end, multiple_iterators=False)
+    b = it.b
+
+    # iterate over reads
+    it.cnext()
+    while it.retval > 0:
+        if (not b.core.flag & flag_skip and not ~b.core.flag & flag_require
+                and b.core.qual >= min_mapq):
+
+            # positions before the start of this read are complete
+            sc.begin(b.core.pos)
+            while not sc.flush(b.core.pos):
+                yield
+
+            # add the read
+            sc.add(b, no_del)
+
+        it.cnext()
+
+    # flush remaining positions
+    sc.begin(start)
+    while not sc.flush(max(sc.end, sc.maxend)):
+        yield
+
+
+#######################
+# FUSED PILEUP ENGINE #
+#######################
+
+
+# steppers whose read filters are applied by the fused engine
+fused_steppers = 'all', 'nofilter'
+
+
+cdef struct PileupReader:
+    htsFile* htsfile
+    hts_itr_t* iter
+    uint32_t flag_filter
+    uint32_t flag_require
+    int min_mapq
+
+
+cdef int read_pileup(void* data, bam1_t* b) noexcept nogil:
+    """Read callback for the htslib pileup, skipping reads filtered out by the
+    stepper or the read filters, so they never enter the pileup."""
+    cdef:
+        PileupReader* reader = <PileupReader*> data
+        int ret
+    while True:
+        ret = sam_itr_next(reader.htsfile, reader.iter, b)
+        if ret < 0:
+            return ret
+        if b.core.flag & reader.flag_filter:
+            continue
+        if ~b.core.flag & reader.flag_require:
+            continue
+        if b.core.qual < reader.min_mapq:
+            continue
+        return ret
+
+
+def fill_fused_batches(stat, RecordBatch batch, alignmentfile, ref, chrom, **kwargs):
+    """Fill `batch` with pileup records, driving the htslib pileup directly
+    rather than via pysam, yielding each time the batch is ready to be
+    consumed."""
+
+    if chrom is not None:
+        it = fill_fused_batches_chrom(stat, batch, alignmentfile=alignmentfile, ref=ref,
+                                      chrom=chrom, **kwargs)
+    else:
+        its = list()
+        for chrom in alignmentfile.references:
+            itc = fill_fused_batches_chrom(stat, batch, alignmentfile=alignmentfile, ref=ref,
+                                           chrom=chrom, **kwargs)
+            its.append(itc)
+        it = itertools.chain(*its)
+    for _ in it:
+        yield
+    if batch.n:
+        yield
+
+
+def fill_fused_batches_chrom(PileupStat stat, RecordBatch batch, AlignmentFile alignmentfile,
+                             RefCache ref, chrom, start, end, one_based, bint truncate, bint pad,
+                             stepper, int max_depth, int min_mapq, int min_baseq, bint no_del,
+                             bint no_dup, int flag_require, int flag_filter):
+    cdef:
+        IteratorRowRegion it
+        PileupReader reader
+        void* data
+        bam_mplp_t mplp
+        const bam_pileup1_t* plp
+        int tid, ctid, pos, n, ret, refc
+        int64_t curpos, region_start, region_end
+        int offset = 1 if one_based else 0
+        int32_t* row
+        Padding padding
+        bint position_dependent = stat.position_dependent
+        bint cached, held
+
+    # setup
+    assert chrom is not None, 'chromosome is None'
+    start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
+    region_start, region_end = start, end
+    tid = alignmentfile.get_tid(chrom)
+    if pad:
+        padding = Padding(stat)
+
+    # read filters applied by the pileup stepper, as pysam, and by the caller
+    if stepper == 'all':
+        reader.flag_filter = BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL | BAM_FDUP
+    elif stepper == 'nofilter':
+        reader.flag_filter = 0
+    else:
+        raise ValueError('stepper %r is not supported by the fused engine' % stepper)
+    reader.flag_filter |= read_flag_filter(flag_filter, no_dup)
+    reader.flag_require = flag_require
+    reader.min_mapq = min_mapq
+
+    # pileup over reads from the region, with overlapping read pairs counted
+    # once, as pysam
+    it = IteratorRowRegion(alignmentfile, tid, start, end, multiple_iterators=False)
+    reader.htsfile = it.htsfile
+    reader.iter = it.iter
+    data = &reader
+    mplp = bam_mplp_init(1, <bam_plp_auto_f> read_pileup, &data)
+    if mplp == NULL:
+        raise MemoryError()
+
+    try:
+        bam_mplp_init_overlaps(mplp)
+        bam_mplp_set_maxcnt(mplp, max_depth)
+        if stat.uses_read_props:
+            bam_mplp_constructor(mplp, cache_read_props)
+
+        # keep track of current position
+        curpos = start
+
+        # iterate over pileup columns, releasing the GIL for a run of columns
+        # until one needs padding before it, a reference base to be loaded or
+        # a position dependent record, or the batch is full
+        while True:
+            # reference bases are read from the buffer of the cache only once
+            # it holds the current chromosome
+            cached = ref is not None and ref.chrom == chrom
+            held = False
+            with nogil:
+                while True:
+                    ret = bam_mplp_auto(mplp, &ctid, &pos, &n, &plp)
+                    if ret <= 0:
+                        break
+                    if truncate:
+                        if pos < region_start:
+                            continue
+                        if pos >= region_end:
+                            ret = 0
+                            break
+                    if pad and curpos < pos:
+                        held = True
+                        break
+                    if ref is None:
+                        refc = 0
+                    elif cached:
+                        refc = ref.cached_base(pos)
+                    else:
+                        refc = -1
+                    if refc < 0 or position_dependent:
+                        held = True
+                        break
+                    accumulate(stat, plp, n, refc, min_baseq, no_del, False)
+                    stat.write(refc, batch.next_row(tid, pos + offset))
+                    curpos = pos + 1
+                    if batch.full():
+                        break
+            if ret < 0:
+                raise IOError('error reading pileup for %s' % chrom)
+            if ret == 0:
+                break
+            if not held:
+                # the run ended with a full batch
+                yield
+                continue
+
+            # pad up to next pileup column
+            if pad:
+                while curpos < pos:
+                    curpos += padding.fill(batch, tid, chrom, curpos, pos, ref, one_based)
+                    if batch.full():
+                        yield
+
+            # construct statistics record for current pileup column
+            refc = get_refbase(ref, chrom, pos)
+            accumulate(stat, plp, n, refc, min_baseq, no_del, False)
+            row = batch.next_row(tid, pos + offset)
+            stat.put(chrom, pos, ref, refc, row)
+            if batch.full():
+                yield
+
+            # advance current position
+            curpos = pos + 1
+
+        # pad out to end position
+        if pad:
+            while curpos < end:
+                curpos += padding.fill(batch, tid, chrom, curpos, end, ref, one_based)
+                if batch.full():
+                    yield
+
+    finally:
+        bam_mplp_destroy(mplp)
+
+
+def iter_batch_records(stat, alignmentfile, ref, pad, regions, batch_size=2**12, **kwargs):
+    """Generate records as dicts, converted from batches filled by one of the
+    batch engines."""
+    batch = RecordBatch(stat.fields, batch_size)
+    chroms = alignmentfile.references
+    for _ in fill_pileup_batches(stat, batch, alignmentfile, ref, pad, regions, **kwargs):
+        for rec in batch.records(chroms):
+            yield rec
+
+
+#####################
+# UTILITY FUNCTIONS #
+#####################
+
+
+def iter_pileup(stat, alignmentfile, fafile, pad, regions=None, **kwargs):
+    """General purpose function to generate statistics, where one record is
     generated for each genome position in the selected range, based on a
-    pileup column.
+    pileup column. If `regions` is given, the selected range is the union of
+    the regions, which are walked in genome order sharing the same open files.
 
     """
 
@@ -1836,29 +2778,59 @@ def iter_pileup(stat, alignmentfile, fafile, pad, **kwargs):
 
     if isinstance(fafile, _string_types):
         fafile = FastaFile(fafile)
-
-    if pad:
-        return iter_pileup_padded(stat, alignmentfile=alignmentfile, fafile=fafile, **kwargs)
+    ref = RefCache(fafile) if fafile is not None else None
+
+    if isinstance(stat, ScatterStat) or kwargs['stepper'] in fused_steppers:
+        if regions is not None:
+            regions = normalise_regions(alignmentfile, regions, kwargs['one_based'])
+        return iter_batch_records(stat, alignmentfile, ref, pad, regions, **kwargs)
+    elif pad:
+        iterfun = functools.partial(iter_pileup_padded, stat, alignmentfile=alignmentfile,
+                                    ref=ref)
     else:
-        return iter_pileup_default(stat, alignmentfile=alignmentfile, fafile=fafile, **kwargs)
+        iterfun = functools.partial(iter_pileup_default, stat, alignmentfile=alignmentfile,
+                                    ref=ref)
 
+    if regions is not None:
+        regions = normalise_regions(alignmentfile, regions, kwargs['one_based'])
+        return iter_regions(iterfun, regions, own=True, **kwargs)
+    return iterfun(**kwargs)
 
-def iter_pileup_default(stat, alignmentfile, fafile, chrom, start, end, one_based, truncate, stepper,
-                        max_depth, int min_mapq, int min_baseq, bint no_del, bint no_dup):
+
+def read_flag_filter(flag_filter, no_dup):
+    """Flags of reads to skip in addition to those the stepper skips."""
+    return flag_filter | (BAM_FDUP if no_dup else 0)
+
+
+def pileup_columns(alignmentfile, chrom, start, end, truncate, stepper, max_depth, min_mapq,
+                   no_dup, flag_require, flag_filter):
+    """Pileup iterator via pysam, with reads filtered out by the read filters
+    before they enter the pileup."""
+    # the flag filter replaces pysam's default, which is kept
+    flag_filter |= BAM_FUNMAP | BAM_FSECONDARY | BAM_FQCFAIL | BAM_FDUP
+    return alignmentfile.pileup(reference=chrom, start=start, end=end, truncate=truncate,
+                                stepper=stepper, max_depth=max_depth,
+                                min_mapping_quality=min_mapq, flag_require=flag_require,
+                                flag_filter=read_flag_filter(flag_filter, no_dup))
+
+
+def iter_pileup_default(stat, alignmentfile, ref, chrom, start, end, one_based, truncate, stepper,
+                        max_depth, int min_mapq, int min_baseq, bint no_del, bint no_dup,
+                        int flag_require, int flag_filter):
     cdef:
         PileupColumn col
 
     # obtain pileup iterator
     start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
-    it = alignmentfile.pileup(reference=chrom, start=start, end=end, truncate=truncate, stepper=stepper,
-                              max_depth=max_depth)
+    it = pileup_columns(alignmentfile, chrom, start, end, truncate=truncate, stepper=stepper,
+                        max_depth=max_depth, min_mapq=min_mapq, no_dup=no_dup,
+                        flag_require=flag_require, flag_filter=flag_filter)
 
     # iterate over pileup columns
     for col in it:
 
-        rec = stat_pileup(stat, col, alignmentfile=alignmentfile, fafile=fafile,
-                          one_based=one_based, min_mapq=min_mapq, min_baseq=min_baseq,
-                          no_del=no_del, no_dup=no_dup)
+        rec = stat_pileup(stat, col, alignmentfile=alignmentfile, ref=ref,
+                          one_based=one_based, min_baseq=min_baseq, no_del=no_del)
 
         yield rec
 
@@ -1866,84 +2838,153 @@ def iter_pileup_default(stat, alignmentfile, fafile, chrom, start, end, one_base
 def stat_pileup(PileupStat stat,
                 PileupColumn col,
                 AlignmentFile alignmentfile,
-                FastaFile fafile,
+                RefCache ref,
                 bint one_based,
-                int min_mapq,
                 int min_baseq,
-                bint no_del,
-                bint no_dup):
-    cdef:
-        bam_pileup1_t** plp
-        bam_pileup1_t* read
-        bam1_t* b
-        int i, n
-
-    # setup intermediate variables
-    n = col.n
-    plp = col.plp
+                bint no_del):
 
     # get current chromosome
     chrom = alignmentfile.getrname(col.tid)
 
     # setup reference base
-    refbase = get_refbase(fafile, chrom, col.pos)
+    refc = get_refbase(ref, chrom, col.pos)
+
+    # accumulate statistics
+    accumulate(stat, col.plp[0], col.n, refc, min_baseq=min_baseq, no_del=no_del,
+               set_props=stat.uses_read_props)
+
+    # construct record
+    rec = stat.rec(chrom, col.pos, ref, refc)
+    pos = col.pos + 1 if one_based else col.pos
+    rec['chrom'] = chrom
+    rec['pos'] = pos
+    return rec
+
+
+cdef void accumulate(PileupStat stat, const bam_pileup1_t* plp, int n, int refc, int min_baseq,
+                     bint no_del, bint set_props) noexcept nogil:
+    """Accumulate statistics over the reads in a pileup column. Read filters
+    applied to whole reads are left to the pileup reader. If `set_props`, the
+    per-read properties are computed here, for pileups which don't cache
+    them."""
+    cdef:
+        bam_pileup1_t* read
+        int i
+        int refnt = ref_nt16(refc)
 
     # iterate over reads in the column
     for i in range(n):
-        read = &(plp[0][i])
-        b = read.b
+        read = <bam_pileup1_t*> &plp[i]
+        if set_props:
+            read.cd.i = read_props(read.b)
 
         # read filters
-        if min_mapq > 0:
-            if b.core.qual < min_mapq:
-                continue
         if min_baseq > 0:
             if not read.is_del:
-                if pysam_bam_get_qual(read.b)[read.qpos] < min_baseq:
+                if bam_get_qual(read.b)[read.qpos] < min_baseq:
                     continue
         if no_del:
             if read.is_del:
                 continue
-        if no_dup:
-            if b.core.flag & BAM_FDUP:
-                continue
 
         # accumulate statistics
-        stat.recv(read, col, refbase)
-
-    # construct record
-    rec = stat.rec(chrom, col.pos, fafile, refbase)
-    pos = col.pos + 1 if one_based else col.pos
-    rec['chrom'] = chrom
-    rec['pos'] = pos
-    return rec
+        stat.recv(read, refnt)
 
 
-def iter_pileup_padded(stat, alignmentfile, fafile, chrom, **kwargs):
+def iter_pileup_padded(stat, alignmentfile, ref, chrom, **kwargs):
     if chrom is not None:
-        it = iter_pileup_padded_chrom(stat, alignmentfile=alignmentfile, fafile=fafile,
+        it = iter_pileup_padded_chrom(stat, alignmentfile=alignmentfile, ref=ref,
                                       chrom=chrom, **kwargs)
     else:
         its = list()
         for chrom in alignmentfile.references:
-            itc = iter_pileup_padded_chrom(stat, alignmentfile=alignmentfile, fafile=fafile,
+            itc = iter_pileup_padded_chrom(stat, alignmentfile=alignmentfile, ref=ref,
                                            chrom=chrom, **kwargs)
             its.append(itc)
         it = itertools.chain(*its)
     return it
 
 
-def iter_pileup_padded_chrom(PileupStat stat, alignmentfile, fafile, chrom, start, end,
-                             one_based, truncate, stepper, max_depth, min_mapq, min_baseq, no_del, no_dup):
+cdef class Padding(object):
+    """Records for positions with no reads in the pileup. These are the same at
+    every position apart from the reference base, so are copied from a template
+    computed once, unless the statistic has other position-dependent values,
+    such as GC content, in which case they are computed per position."""
+
+    cdef:
+        PileupStat stat
+        Py_ssize_t nfields
+        int ref_index
+        bint per_position
+        int32_t* template
+        dict template_rec
+
+    def __init__(self, PileupStat stat):
+        cdef Py_ssize_t i
+        fields = stat.fields
+        self.stat = stat
+        self.nfields = len(fields)
+        self.ref_index = fields.index('ref') if 'ref' in fields else -1
+        self.per_position = stat.position_dependent
+        self.template = <int32_t*> calloc(max(1, self.nfields), sizeof(int32_t))
+        if self.template == NULL:
+            raise MemoryError()
+        if not self.per_position:
+            # counters are reset, so this gives the values for an empty column
+            stat.put(None, 0, None, 0, self.template)
+            self.template_rec = {f: self.template[i] for i, f in enumerate(fields)}
+
+    def __dealloc__(self):
+        free(self.template)
+
+    cdef Py_ssize_t fill(self, RecordBatch batch, int tid, chrom, int64_t start, int64_t stop,
+                         RefCache ref, bint one_based) except -1:
+        """Write records for positions from `start` to `stop` into `batch` until
+        it is full, returning the number of records written."""
+        cdef:
+            Py_ssize_t i, n
+            int64_t pos
+            int32_t* row
+
+        n = min(stop - start, batch.size - batch.n)
+        for i in range(n):
+            pos = start + i
+            row = batch.next_row(tid, pos + 1 if one_based else pos)
+            if self.per_position:
+                self.stat.put(chrom, pos, ref, get_refbase(ref, chrom, pos), row)
+            else:
+                memcpy(row, self.template, self.nfields * sizeof(int32_t))
+                if self.ref_index >= 0 and ref is not None:
+                    row[self.ref_index] = ref.base(chrom, pos)
+        return n
+
+    cdef dict rec(self, chrom, int64_t pos, RefCache ref, bint one_based):
+        """Construct the record for a single position."""
+        if self.per_position:
+            rec = self.stat.rec(chrom, pos, ref, get_refbase(ref, chrom, pos))
+        else:
+            rec = self.template_rec.copy()
+            if self.ref_index >= 0:
+                rec['ref'] = refstr(get_refbase(ref, chrom, pos))
+        rec['chrom'] = chrom
+        rec['pos'] = pos + 1 if one_based else pos
+        return rec
+
+
+def iter_pileup_padded_chrom(PileupStat stat, alignmentfile, ref, chrom, start, end,
+                             one_based, truncate, stepper, max_depth, min_mapq, min_baseq, no_del,
+                             no_dup, flag_require, flag_filter):
     cdef:
         PileupColumn col
         int curpos
+        Padding padding = Padding(stat)
 
     # obtain pileup iterator
     assert chrom is not None, 'chromosome is None'
     start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
-    it = alignmentfile.pileup(reference=chrom, start=start, end=end, truncate=truncate, stepper=stepper,
-                              max_depth=max_depth)
+    it = pileup_columns(alignmentfile, chrom, start, end, truncate=truncate, stepper=stepper,
+                        max_depth=max_depth, min_mapq=min_mapq, no_dup=no_dup,
+                        flag_require=flag_require, flag_filter=flag_filter)
 
     # keep track of current position
     curpos = start
@@ -1953,20 +2994,12 @@ def iter_pileup_padded_chrom(PileupStat stat, alignmentfile, fafile, chrom, star
 
         # pad up to next pileup column
         while curpos < col.pos:
-            # setup reference base
-            refbase = get_refbase(fafile, chrom, curpos)
-            # construct record
-            rec = stat.rec(chrom, curpos, fafile, refbase)
-            rec['chrom'] = chrom
-            pos = curpos + 1 if one_based else curpos
-            rec['pos'] = pos
-            yield rec
+            yield padding.rec(chrom, curpos, ref, one_based)
             curpos += 1
 
         # construct and yield statistics record for current pileup column
-        rec = stat_pileup(stat, col, alignmentfile=alignmentfile, fafile=fafile,
-                          one_based=one_based, min_mapq=min_mapq, min_baseq=min_baseq,
-                          no_del=no_del, no_dup=no_dup)
+        rec = stat_pileup(stat, col, alignmentfile=alignmentfile, ref=ref,
+                          one_based=one_based, min_baseq=min_baseq, no_del=no_del)
         yield rec
 
         # advance current position
@@ -1975,55 +3008,415 @@ def iter_pileup_padded_chrom(PileupStat stat, alignmentfile, fafile, chrom, star
     while curpos < end:
 
         # pad out to end position
-        refbase = get_refbase(fafile, chrom, curpos)
-        rec = stat.rec(chrom, curpos, fafile, refbase)
-        rec['chrom'] = chrom
-        pos = curpos + 1 if one_based else curpos
-        rec['pos'] = pos
-        yield rec
+        yield padding.rec(chrom, curpos, ref, one_based)
         curpos += 1
 
 
-def get_refbase(fafile, chrom, pos):
-    if fafile is not None:
-        refbase = fafile.fetch(reference=chrom, start=pos, end=pos+1).upper()
-        if not PY2:
-            refbase = refbase.encode('ascii')
+
+
+cdef class RecordBatch(object):
+    """Preallocated column buffers for a batch of records. Values are written
+    directly by the stat objects, and the batch is converted to a numpy
+    structured array when full."""
+
+    cdef:
+        readonly Py_ssize_t n, size
+        tuple fields
+        object _values, _tid, _pos
+        int32_t[:, ::1] values
+        int32_t[::1] tid
+        int32_t[::1] pos
+        int64_t own_start, own_end
+        int32_t[::1] scratch
+
+    def __init__(self, fields, Py_ssize_t size):
+        self.fields = tuple(fields)
+        self.size = size
+        self.n = 0
+        self._values = np.zeros((size, max(1, len(self.fields))), dtype='i4')
+        self._tid = np.zeros(size, dtype='i4')
+        self._pos = np.zeros(size, dtype='i4')
+        self.values = self._values
+        self.tid = self._tid
+        self.pos = self._pos
+        self.scratch = np.zeros(max(1, len(self.fields)), dtype='i4')
+        self.own_start = -_sys.maxsize
+        self.own_end = _sys.maxsize
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int32_t* next_row(self, int tid, int pos) noexcept nogil:
+        """Claim the next row of the batch, returning a pointer to its values.
+        Positions outside the range owned by the current region are written to
+        a scratch row and discarded."""
+        cdef Py_ssize_t i = self.n
+        if pos < self.own_start or pos >= self.own_end:
+            return &self.scratch[0]
+        self.tid[i] = tid
+        self.pos[i] = pos
+        self.n += 1
+        return &self.values[i, 0]
+
+    cdef bint full(self) noexcept nogil:
+        return self.n >= self.size
+
+    def copy_to(self, out, fields, chroms):
+        """Copy the batch into `out`, then clear the batch so the buffers can be
+        reused.
+
+        Parameters
+        ----------
+        out : numpy array
+            Output array with one row per record in the batch. If this is not a
+            structured array, then a single field must be given.
+        fields : sequence of strings
+            Names of fields to copy.
+        chroms : numpy array
+            Chromosome names indexed by tid.
+
+        """
+        cdef Py_ssize_t n = self.n
+        for f in fields:
+            if out.dtype.names is None:
+                a = out
+            else:
+                a = out[f]
+            if f == 'chrom':
+                a[:] = chroms[self._tid[:n]]
+            elif f == 'pos':
+                a[:] = self._pos[:n]
+            elif f == 'ref':
+                a[:] = self._values[:n, self.fields.index(f)].astype('u1').view('S1')
+            else:
+                a[:] = self._values[:n, self.fields.index(f)]
+        self.n = 0
+
+    def records(self, chroms):
+        """Convert the batch into a list of dicts, one per record, then clear the
+        batch so the buffers can be reused."""
+        cdef Py_ssize_t i, j
+        cdef int ref_index = self.fields.index('ref') if 'ref' in self.fields else -1
+        recs = list()
+        for i in range(self.n):
+            rec = {f: self.values[i, j] for j, f in enumerate(self.fields)}
+            if ref_index >= 0:
+                rec['ref'] = chr(self.values[i, ref_index]) if self.values[i, ref_index] else ''
+            rec['chrom'] = chroms[self.tid[i]]
+            rec['pos'] = self.pos[i]
+            recs.append(rec)
+        self.n = 0
+        return recs
+
+    def rows(self, chroms):
+        """Convert the batch into a list of tuples, one per record, holding the
+        chrom and pos followed by the values in field order, then clear the
+        batch so the buffers can be reused."""
+        cdef Py_ssize_t n = self.n
+        cdef int ref_index = self.fields.index('ref') if 'ref' in self.fields else -1
+        values = self._values[:n, :len(self.fields)].tolist()
+        if ref_index >= 0:
+            for v in values:
+                v[ref_index] = chr(v[ref_index]) if v[ref_index] else ''
+        rows = [(chroms[t], p) + tuple(v)
+                for t, p, v in zip(self._tid[:n].tolist(), self._pos[:n].tolist(), values)]
+        self.n = 0
+        return rows
+
+    def to_array(self, dtype, chroms):
+        """Copy the batch into a new structured array with the given dtype, then
+        clear the batch so the buffers can be reused."""
+        a = np.empty(self.n, dtype=dtype)
+        self.copy_to(a, a.dtype.names, chroms)
+        return a
+
+
+# initial length of arrays loaded where the number of records is not known in
+# advance, which grow as needed
+MAX_INITIAL_RECORDS = 2**20
+
+
+cdef fill_array(it, RecordBatch batch, a, fields, chroms):
+    """Consume a batch-filling iterator, copying each batch into `a` at the
+    next free offset, then trim `a` to the number of records written."""
+    cdef Py_ssize_t n = 0, k
+    for _ in it:
+        k = batch.n
+        if n + k > a.shape[0]:
+            a.resize(max(2 * a.shape[0], n + k), refcheck=False)
+        batch.copy_to(a[n:n + k], fields, chroms)
+        n += k
+    a.resize(n, refcheck=False)
+    return a
+
+
+def iter_pileup_batches(stat, alignmentfile, fafile, pad, batch_size, dtype, regions=None,
+                        **kwargs):
+    """As iter_pileup, but generate numpy structured arrays each holding records
+    for up to `batch_size` genome positions.
+
+    """
+
+    if isinstance(alignmentfile, _string_types):
+        alignmentfile = AlignmentFile(alignmentfile)
+
+    if isinstance(fafile, _string_types):
+        fafile = FastaFile(fafile)
+    ref = RefCache(fafile) if fafile is not None else None
+
+    dtype = np.dtype(dtype)
+    chroms = np.array(alignmentfile.references, dtype=dtype['chrom'])
+    batch = RecordBatch(stat.fields, batch_size)
+
+    if regions is not None:
+        regions = normalise_regions(alignmentfile, regions, kwargs['one_based'])
+    it = fill_pileup_batches(stat, batch, alignmentfile, ref, pad, regions, **kwargs)
+    for _ in it:
+        yield batch.to_array(dtype, chroms)
+
+
+def iter_pileup_rows(stat, alignmentfile, fafile, pad, batch_size=2**12, regions=None, **kwargs):
+    """As iter_pileup, but generate tuples holding chrom, pos and then the values
+    in the order of `stat.fields`, converted from batches filled by one of the
+    batch engines without building a dict per record.
+
+    """
+
+    if isinstance(alignmentfile, _string_types):
+        alignmentfile = AlignmentFile(alignmentfile)
+
+    if isinstance(fafile, _string_types):
+        fafile = FastaFile(fafile)
+    ref = RefCache(fafile) if fafile is not None else None
+
+    chroms = alignmentfile.references
+    batch = RecordBatch(stat.fields, batch_size)
+
+    if regions is not None:
+        regions = normalise_regions(alignmentfile, regions, kwargs['one_based'])
+    for _ in fill_pileup_batches(stat, batch, alignmentfile, ref, pad, regions, **kwargs):
+        for row in batch.rows(chroms):
+            yield row
+
+
+def load_pileup(stat, alignmentfile, fafile, pad, dtype, fields, batch_size=2**16, regions=None,
+                **kwargs):
+    """Load statistics for every pileup column into a numpy array. The array is
+    allocated once at the number of records if that is known in advance, or
+    otherwise at an estimate bounded by MAX_INITIAL_RECORDS, and filled directly
+    from each batch, growing as needed, then trimmed.
+
+    """
+
+    if isinstance(alignmentfile, _string_types):
+        alignmentfile = AlignmentFile(alignmentfile)
+
+    if isinstance(fafile, _string_types):
+        fafile = FastaFile(fafile)
+    ref = RefCache(fafile) if fafile is not None else None
+
+    dtype = np.dtype(dtype)
+    if 'chrom' in fields:
+        chroms = np.array(alignmentfile.references, dtype=dtype['chrom'] if dtype.names else dtype)
+    else:
+        chroms = None
+    if regions is not None:
+        regions = normalise_regions(alignmentfile, regions, kwargs['one_based'])
+        # records between untruncated regions are only an estimate, the array
+        # grows if needed
+        size = sum(end - start for _, start, end in regions)
+        exact = False
     else:
-        refbase = None
-    return refbase
+        size = max_pileup_records(alignmentfile, kwargs['chrom'], kwargs['start'],
+                                  kwargs['end'], kwargs['one_based'], kwargs['truncate'])
+        # padded over whole contigs or a truncated region, every position
+        # produces a record
+        exact = pad and (kwargs['chrom'] is None or kwargs['truncate'])
+    if not exact:
+        size = min(size, MAX_INITIAL_RECORDS)
+    a = np.empty(size, dtype=dtype)
+    batch = RecordBatch(stat.fields, max(1, min(batch_size, size)))
+
+    it = fill_pileup_batches(stat, batch, alignmentfile, ref, pad, regions, **kwargs)
+    return fill_array(it, batch, a, fields, chroms)
+
+
+def fill_pileup_batches(stat, RecordBatch batch, alignmentfile, ref, pad, regions, **kwargs):
+    """Fill `batch` with pileup records over the selected range or regions,
+    yielding each time the batch is ready to be consumed."""
+
+    if isinstance(stat, ScatterStat):
+        fill = functools.partial(fill_scatter_batches, stat, batch, alignmentfile=alignmentfile,
+                                 pad=pad)
+    elif kwargs['stepper'] in fused_steppers:
+        fill = functools.partial(fill_fused_batches, stat, batch, alignmentfile=alignmentfile,
+                                 ref=ref, pad=pad)
+    elif pad:
+        fill = functools.partial(iter_pileup_batches_padded, stat, batch,
+                                 alignmentfile=alignmentfile, ref=ref)
+    else:
+        fill = functools.partial(iter_pileup_batches_default, stat, batch,
+                                 alignmentfile=alignmentfile, ref=ref)
+
+    if regions is not None:
+        return fill_regions(fill, batch, regions, own=True, **kwargs)
+    return fill(**kwargs)
+
+
+def max_pileup_records(AlignmentFile alignmentfile, chrom, start, end, one_based, truncate):
+    """Upper bound on the number of records a pileup over the given region can
+    produce, padded or not."""
+
+    if chrom is None:
+        return sum(alignmentfile.lengths)
+
+    start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
+    if truncate:
+        return max(0, end - start)
+
+    # positions are unique within a chromosome
+    return alignmentfile.get_reference_length(chrom)
+
+
+def iter_pileup_batches_default(PileupStat stat, RecordBatch batch, AlignmentFile alignmentfile,
+                                ref, chrom, start, end, one_based, truncate, stepper, max_depth,
+                                int min_mapq, int min_baseq, bint no_del, bint no_dup,
+                                int flag_require, int flag_filter):
+    """Fill `batch` from pileup columns, yielding each time the batch is ready to
+    be consumed."""
+    cdef:
+        PileupColumn col
+        int32_t* row
+
+    # obtain pileup iterator
+    start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
+    it = pileup_columns(alignmentfile, chrom, start, end, truncate=truncate, stepper=stepper,
+                        max_depth=max_depth, min_mapq=min_mapq, no_dup=no_dup,
+                        flag_require=flag_require, flag_filter=flag_filter)
+
+    # iterate over pileup columns
+    for col in it:
+        chrom = alignmentfile.getrname(col.tid)
+        refc = get_refbase(ref, chrom, col.pos)
+        accumulate(stat, col.plp[0], col.n, refc, min_baseq=min_baseq, no_del=no_del,
+                   set_props=stat.uses_read_props)
+        row = batch.next_row(col.tid, col.pos + 1 if one_based else col.pos)
+        stat.put(chrom, col.pos, ref, refc, row)
+        if batch.full():
+            yield
+
+    if batch.n:
+        yield
+
+
+def iter_pileup_batches_padded(stat, batch, alignmentfile, ref, chrom, **kwargs):
+    if chrom is not None:
+        it = iter_pileup_batches_padded_chrom(stat, batch, alignmentfile=alignmentfile,
+                                              ref=ref, chrom=chrom, **kwargs)
+    else:
+        its = list()
+        for chrom in alignmentfile.references:
+            itc = iter_pileup_batches_padded_chrom(stat, batch, alignmentfile=alignmentfile,
+                                                   ref=ref, chrom=chrom, **kwargs)
+            its.append(itc)
+        it = itertools.chain(*its)
+    for _ in it:
+        yield
+    if batch.n:
+        yield
+
+
+def iter_pileup_batches_padded_chrom(PileupStat stat, RecordBatch batch, AlignmentFile alignmentfile,
+                                     ref, chrom, start, end, one_based, truncate, stepper,
+                                     max_depth, min_mapq, min_baseq, no_del, no_dup, flag_require,
+                                     flag_filter):
+    """Fill `batch` with a record for every position on a single chromosome,
+    yielding each time the batch is full. Any partial batch is left for the
+    caller to flush."""
+    cdef:
+        PileupColumn col
+        int curpos, tid
+        int32_t* row
+        Padding padding = Padding(stat)
+
+    # obtain pileup iterator
+    assert chrom is not None, 'chromosome is None'
+    start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
+    it = pileup_columns(alignmentfile, chrom, start, end, truncate=truncate, stepper=stepper,
+                        max_depth=max_depth, min_mapq=min_mapq, no_dup=no_dup,
+                        flag_require=flag_require, flag_filter=flag_filter)
+    tid = alignmentfile.get_tid(chrom)
+
+    # keep track of current position
+    curpos = start
+
+    # iterate over pileup columns
+    for col in it:
+
+        # pad up to next pileup column
+        while curpos < col.pos:
+            curpos += padding.fill(batch, tid, chrom, curpos, col.pos, ref, one_based)
+            if batch.full():
+                yield
+
+        # construct statistics record for current pileup column
+        refc = get_refbase(ref, chrom, col.pos)
+        accumulate(stat, col.plp[0], col.n, refc, min_baseq=min_baseq, no_del=no_del,
+                   set_props=stat.uses_read_props)
+        row = batch.next_row(tid, col.pos + 1 if one_based else col.pos)
+        stat.put(chrom, col.pos, ref, refc, row)
+        if batch.full():
+            yield
+
+        # advance current position
+        curpos = col.pos + 1
+
+    while curpos < end:
+
+        # pad out to end position
+        curpos += padding.fill(batch, tid, chrom, curpos, end, ref, one_based)
+        if batch.full():
+            yield
 
 
 def iter_binned(stat, alignmentfile, fafile, chrom, window_size=300, window_offset=None,
-                **kwargs):
+                regions=None, **kwargs):
 
     if isinstance(alignmentfile, _string_types):
         alignmentfile = AlignmentFile(alignmentfile)
 
     if isinstance(fafile, _string_types):
         fafile = FastaFile(fafile)
+    ref = RefCache(fafile) if fafile is not None else None
 
     if window_offset is None:
         window_offset = window_size / 2
 
+    if regions is not None:
+        regions = normalise_regions(alignmentfile, regions, kwargs['one_based'])
+        iterfun = functools.partial(iter_binned_chrom, stat, alignmentfile=alignmentfile,
+                                    ref=ref, window_size=window_size,
+                                    window_offset=window_offset)
+        # bins are aligned to the start of each region, so are never dropped
+        return iter_regions(iterfun, regions, own=False, chrom=chrom, **kwargs)
+
     if chrom is None:
         its = list()
         for chrom in alignmentfile.references:
-            itc = iter_binned_chrom(stat, alignmentfile=alignmentfile, fafile=fafile,
+            itc = iter_binned_chrom(stat, alignmentfile=alignmentfile, ref=ref,
                                     chrom=chrom, window_size=window_size,
                                     window_offset=window_offset, **kwargs)
             its.append(itc)
         it = itertools.chain(*its)
 
     else:
-        it = iter_binned_chrom(stat, alignmentfile=alignmentfile, fafile=fafile,
+        it = iter_binned_chrom(stat, alignmentfile=alignmentfile, ref=ref,
                                chrom=chrom, window_size=window_size, window_offset=window_offset,
                                **kwargs)
 
     return it
 
 
-def iter_binned_chrom(BinnedStat stat, AlignmentFile alignmentfile, FastaFile fafile,
+def iter_binned_chrom(BinnedStat stat, AlignmentFile alignmentfile, RefCache ref,
                       chrom, start, end, one_based, int window_size, int window_offset,
                       int min_mapq, int no_dup):
 
@@ -2050,7 +3443,7 @@ def iter_binned_chrom(BinnedStat stat, AlignmentFile alignmentfile, FastaFile fa
         while b.core.pos > bin_end:  # end of bin
 
             # yield record for bin
-            rec = stat.rec(chrom, bin_start, bin_end, fafile)
+            rec = stat.rec(chrom, bin_start, bin_end, ref)
             pos = bin_start + window_offset
             if one_based:
                 pos += 1
@@ -2077,7 +3470,7 @@ def iter_binned_chrom(BinnedStat stat, AlignmentFile alignmentfile, FastaFile fa
         it.cnext()
 
     # deal with last non-empty bin
-    rec = stat.rec(chrom, bin_start, bin_end, fafile)
+    rec = stat.rec(chrom, bin_start, bin_end, ref)
     pos = bin_start + window_offset
     if one_based:
         pos += 1
@@ -2093,7 +3486,7 @@ def iter_binned_chrom(BinnedStat stat, AlignmentFile alignmentfile, FastaFile fa
             bin_end = bin_start + window_size
 
             # yield record
-            rec = stat.rec(chrom, bin_start, bin_end, fafile)
+            rec = stat.rec(chrom, bin_start, bin_end, ref)
             pos = bin_start + window_offset
             if one_based:
                 pos += 1
@@ -2102,6 +3495,207 @@ def iter_binned_chrom(BinnedStat stat, AlignmentFile alignmentfile, FastaFile fa
             yield rec
 
 
+def iter_binned_batches(stat, alignmentfile, fafile, batch_size, dtype, regions=None, **kwargs):
+    """As iter_binned, but generate numpy structured arrays each holding records
+    for up to `batch_size` bins.
+
+    """
+
+    if isinstance(alignmentfile, _string_types):
+        alignmentfile = AlignmentFile(alignmentfile)
+
+    if isinstance(fafile, _string_types):
+        fafile = FastaFile(fafile)
+    ref = RefCache(fafile) if fafile is not None else None
+
+    dtype = np.dtype(dtype)
+    chroms = np.array(alignmentfile.references, dtype=dtype['chrom'])
+    batch = RecordBatch(stat.fields, batch_size)
+
+    if regions is not None:
+        regions = normalise_regions(alignmentfile, regions, kwargs['one_based'])
+    for _ in fill_binned_batches(stat, batch, alignmentfile=alignmentfile, ref=ref,
+                                 regions=regions, **kwargs):
+        yield batch.to_array(dtype, chroms)
+
+
+def iter_binned_rows(stat, alignmentfile, fafile, batch_size=2**12, regions=None, **kwargs):
+    """As iter_binned, but generate tuples holding chrom, pos and then the values
+    in the order of `stat.fields`.
+
+    """
+
+    if isinstance(alignmentfile, _string_types):
+        alignmentfile = AlignmentFile(alignmentfile)
+
+    if isinstance(fafile, _string_types):
+        fafile = FastaFile(fafile)
+    ref = RefCache(fafile) if fafile is not None else None
+
+    chroms = alignmentfile.references
+    batch = RecordBatch(stat.fields, batch_size)
+
+    if regions is not None:
+        regions = normalise_regions(alignmentfile, regions, kwargs['one_based'])
+    for _ in fill_binned_batches(stat, batch, alignmentfile=alignmentfile, ref=ref,
+                                 regions=regions, **kwargs):
+        for row in batch.rows(chroms):
+            yield row
+
+
+def load_binned(stat, alignmentfile, fafile, dtype, fields, batch_size=2**16, regions=None,
+                **kwargs):
+    """Load statistics for every bin into a numpy array, allocated once at the
+    maximum number of bins, bounded by MAX_INITIAL_RECORDS, and filled directly
+    from each batch, growing as needed, then trimmed.
+
+    """
+
+    if isinstance(alignmentfile, _string_types):
+        alignmentfile = AlignmentFile(alignmentfile)
+
+    if isinstance(fafile, _string_types):
+        fafile = FastaFile(fafile)
+    ref = RefCache(fafile) if fafile is not None else None
+
+    dtype = np.dtype(dtype)
+    if 'chrom' in fields:
+        chroms = np.array(alignmentfile.references, dtype=dtype['chrom'] if dtype.names else dtype)
+    else:
+        chroms = None
+    window_size = kwargs.get('window_size', 300)
+    if regions is not None:
+        regions = normalise_regions(alignmentfile, regions, kwargs['one_based'])
+        size = sum((end - start) // window_size + 2 for _, start, end in regions)
+    else:
+        size = max_binned_records(alignmentfile, kwargs['chrom'], kwargs['start'],
+                                  kwargs['end'], kwargs['one_based'], window_size)
+    # bins are only produced up to the last read on each contig
+    a = np.empty(min(size, MAX_INITIAL_RECORDS), dtype=dtype)
+    batch = RecordBatch(stat.fields, max(1, min(batch_size, size)))
+
+    it = fill_binned_batches(stat, batch, alignmentfile=alignmentfile, ref=ref, regions=regions,
+                             **kwargs)
+    return fill_array(it, batch, a, fields, chroms)
+
+
+def max_binned_records(AlignmentFile alignmentfile, chrom, start, end, one_based, window_size):
+    """Upper bound on the number of bins produced over the given region."""
+
+    if chrom is None:
+        return sum(l // window_size + 2 for l in alignmentfile.lengths)
+
+    start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
+    return max(0, end - start) // window_size + 2
+
+
+def fill_binned_batches(stat, RecordBatch batch, alignmentfile, ref, chrom, window_size=300,
+                        window_offset=None, regions=None, **kwargs):
+    """Fill `batch` with binned records, yielding each time the batch is ready
+    to be consumed."""
+
+    if window_offset is None:
+        window_offset = window_size / 2
+
+    if regions is not None:
+        fill = functools.partial(fill_binned_batches_chrom, stat, batch,
+                                 alignmentfile=alignmentfile, ref=ref, window_size=window_size,
+                                 window_offset=window_offset)
+        # bins are aligned to the start of each region, so are never dropped
+        it = fill_regions(fill, batch, regions, own=False, chrom=chrom, **kwargs)
+
+    elif chrom is None:
+        its = list()
+        for chrom in alignmentfile.references:
+            itc = fill_binned_batches_chrom(stat, batch, alignmentfile=alignmentfile,
+                                            ref=ref, chrom=chrom, window_size=window_size,
+                                            window_offset=window_offset, **kwargs)
+            its.append(itc)
+        it = itertools.chain(*its)
+
+    else:
+        it = fill_binned_batches_chrom(stat, batch, alignmentfile=alignmentfile, ref=ref,
+                                       chrom=chrom, window_size=window_size,
+                                       window_offset=window_offset, **kwargs)
+
+    for _ in it:
+        yield
+    if batch.n:
+        yield
+
+
+def fill_binned_batches_chrom(BinnedStat stat, RecordBatch batch, AlignmentFile alignmentfile,
+                              RefCache ref, chrom, start, end, one_based, int window_size,
+                              int window_offset, int min_mapq, int no_dup):
+
+    # setup
+
+    assert chrom is not None, 'chromosome is None'
+    start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
+
+    cdef int rtid, rstart, rend, has_coord, bin_start, bin_end
+    has_coord, rtid, rstart, rend = alignmentfile.parse_region(chrom, start, end, None)
+
+    cdef IteratorRowRegion it
+    cdef bam1_t* b
+    cdef int32_t* row
+    cdef int offset = window_offset + 1 if one_based else window_offset
+    it = IteratorRowRegion(alignmentfile, rtid, rstart, rend, multiple_iterators=False)
+    b = it.b
+
+    # setup first bin
+    bin_start = rstart
+    bin_end = bin_start + window_size
+
+    # iterate over reads
+    it.cnext()
+    while it.retval > 0:
+        while b.core.pos > bin_end:  # end of bin
+
+            # write record for bin
+            row = batch.next_row(rtid, bin_start + offset)
+            stat.put(chrom, bin_start, bin_end, ref, row)
+            if batch.full():
+                yield
+
+            # start new bin
+            bin_start = bin_end
+            bin_end = bin_start + window_size
+
+        # process current read
+        if min_mapq > 0:
+            if b.core.qual < min_mapq:
+                it.cnext()
+                continue
+        if no_dup:
+            if <bint>(b.core.flag & BAM_FDUP):
+                it.cnext()
+                continue
+        stat.recv(b)
+
+        # move iterator on
+        it.cnext()
+
+    # deal with last non-empty bin
+    row = batch.next_row(rtid, bin_start + offset)
+    stat.put(chrom, bin_start, bin_end, ref, row)
+    if batch.full():
+        yield
+
+    # deal with empty bins up to explicit end
+    if end is not None:
+        while bin_end < end:
+            # start new bin
+            bin_start = bin_end
+            bin_end = bin_start + window_size
+
+            # write record
+            row = batch.next_row(rtid, bin_start + offset)
+            stat.put(chrom, bin_start, bin_end, ref, row)
+            if batch.full():
+                yield
+
+
 def normalise_coords(AlignmentFile alignmentfile, chrom, start, end, one_based):
     """Convert to zero-based coordinates and deal with unspecified start
     and/or end.
@@ -2112,14 +3706,16 @@ def normalise_coords(AlignmentFile alignmentfile, chrom, start, end, one_based):
         return None, None
 
     else:
-        assert chrom in alignmentfile.references, \
+        # N.B., look up the one contig, as references and lengths are rebuilt
+        # on every access
+        assert alignmentfile.get_tid(chrom) >= 0, \
             'chromosome not in SAM references: %s' % chrom
 
         if one_based:
             start = start - 1 if start is not None else None
             end = end - 1 if end is not None else None
 
-        chrlen = alignmentfile.lengths[alignmentfile.references.index(chrom)]
+        chrlen = alignmentfile.get_reference_length(chrom)
         if start is None:
             start = 0
         if end is None:
@@ -2130,6 +3726,95 @@ def normalise_coords(AlignmentFile alignmentfile, chrom, start, end, one_based):
         return start, end
 
 
+def normalise_regions(AlignmentFile alignmentfile, regions, one_based):
+    """Convert regions to a list of (chrom, start, end) tuples in zero-based
+    coordinates, sorted in reference order, with overlapping or adjacent
+    regions merged.
+
+    `regions` is either the path to a BED file, whose coordinates are always
+    zero-based, or a sequence of (chrom, start, end) tuples in the coordinate
+    system given by `one_based`.
+
+    """
+
+    if isinstance(regions, _string_types):
+        regions = util.read_bed(regions)
+        one_based = False
+
+    chroms = alignmentfile.references
+    tids = dict((c, i) for i, c in enumerate(chroms))
+    intervals = list()
+    for chrom, start, end in regions:
+        if chrom not in tids:
+            raise ValueError('chromosome not in SAM references: %s' % chrom)
+        start, end = normalise_coords(alignmentfile, chrom, start, end, one_based)
+        if start < end:
+            intervals.append((tids[chrom], start, end))
+    intervals.sort()
+
+    merged = list()
+    for tid, start, end in intervals:
+        if merged and merged[-1][0] == tid and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([tid, start, end])
+
+    return [(chroms[tid], start, end) for tid, start, end in merged]
+
+
+def region_ownership(regions, Py_ssize_t i, bint one_based):
+    """Range of record positions owned by region `i`. Pileups over neighbouring
+    regions on the same chromosome may overlap if not truncated, so each region
+    owns the positions from its own start to the start of the next region."""
+
+    offset = 1 if one_based else 0
+    chrom = regions[i][0]
+    own_start, own_end = -_sys.maxsize, _sys.maxsize
+    if i > 0 and regions[i - 1][0] == chrom:
+        own_start = regions[i][1] + offset
+    if i + 1 < len(regions) and regions[i + 1][0] == chrom:
+        own_end = regions[i + 1][1] + offset
+    return own_start, own_end
+
+
+def iter_regions(iterfun, regions, one_based, own, chrom=None, start=None, end=None,
+                 **kwargs):
+    """Chain records generated by `iterfun` over each of `regions` in turn. If
+    `own`, only records owned by each region are kept."""
+
+    offset = 1 if one_based else 0
+    for i, (chrom, start, end) in enumerate(regions):
+        own_start, own_end = -_sys.maxsize, _sys.maxsize
+        if own:
+            own_start, own_end = region_ownership(regions, i, one_based)
+        for rec in iterfun(chrom=chrom, start=start + offset, end=end + offset,
+                           one_based=one_based, **kwargs):
+            if own_start <= rec['pos'] < own_end:
+                yield rec
+
+
+def fill_regions(fill, RecordBatch batch, regions, one_based, own, chrom=None, start=None,
+                 end=None, **kwargs):
+    """Fill `batch` by calling `fill` over each of `regions` in turn, yielding
+    each time the batch is full, and once more for any final partial batch. If
+    `own`, only records owned by each region are kept."""
+
+    offset = 1 if one_based else 0
+    try:
+        for i, (chrom, start, end) in enumerate(regions):
+            if own:
+                batch.own_start, batch.own_end = region_ownership(regions, i, one_based)
+            for _ in fill(chrom=chrom, start=start + offset, end=end + offset,
+                          one_based=one_based, **kwargs):
+                # partial batches are only flushed at the end of the last region
+                if batch.full():
+                    yield
+    finally:
+        batch.own_start, batch.own_end = -_sys.maxsize, _sys.maxsize
+    if batch.n:
+        yield
+
+
 cdef inline bint is_softclipped(bam1_t* aln):
     cdef int k
     cigar_p = pysam_bam_get_cigar(aln)
@@ -2140,36 +3825,473 @@ cdef inline bint is_softclipped(bam1_t* aln):
     return 0
 
 
-cdef inline object get_seq_base(bam1_t *src, uint32_t k):
-    cdef uint8_t* p
-    cdef char* s
+cdef inline int64_t read_props(const bam1_t* b) noexcept nogil:
+    """Properties of a read which are the same at every position it covers, as
+    READ_* bit flags."""
+    cdef:
+        uint32_t flag = b.core.flag
+        bint is_reverse = (flag & BAM_FREVERSE) != 0
+        bint mate_is_reverse = (flag & BAM_FMREVERSE) != 0
+        const uint32_t* cigar_p = bam_get_cigar(<bam1_t*> b)
+        int64_t props = 0
+        int k
+
+    # mates are classified in order, the first match wins
+    if flag & BAM_FMUNMAP:
+        props |= READ_MATE_UNMAPPED
+    elif b.core.tid != b.core.mtid:
+        props |= READ_MATE_OTHER_CHR
+    elif is_reverse == mate_is_reverse:
+        props |= READ_MATE_SAME_STRAND
+    elif (is_reverse and b.core.isize > 0) or (not is_reverse and b.core.isize < 0):
+        props |= READ_FACEAWAY
+
+    for k in range(b.core.n_cigar):
+        if cigar_p[k] & BAM_CIGAR_MASK == BAM_CSOFT_CLIP:
+            props |= READ_SOFTCLIPPED
+            break
 
-    if not src.core.l_qseq:
-        return None
+    return props
 
-    seq = PyBytes_FromStringAndSize(NULL, 1)
-    s   = <char*>seq
-    p   = pysam_bam_get_seq(src)
 
-    s[0] = bam_nt16_rev_table[p[k//2] >> 4 * (1 - k%2) & 0xf]
+cdef int cache_read_props(void* data, const bam1_t* b, bam_pileup_cd* cd) noexcept nogil:
+    """Pileup constructor caching the properties of each read as it enters the
+    pileup."""
+    cd.i = read_props(b)
+    return 0
 
-    return seq
 
+# N.B., values are rounded with rint, which rounds half to even as
+# numpy.around
 
-def rootmean(uint64_t sqsum, int count):
+cdef inline int32_t rootmean(uint64_t sqsum, int64_t count) noexcept nogil:
     if count > 0:
-        return int(round(sqrt(sqsum / count)))
+        return <int32_t> rint(sqrt(<double> sqsum / count))
     else:
         return 0
 
 
-def mean(int64_t total, int count):
+cdef inline int32_t mean(int64_t total, int64_t count) noexcept nogil:
     if count > 0:
-        return int(round(total / count))
+        return <int32_t> rint(<double> total / count)
     else:
         return 0
 
 
+###############
+# TEXT OUTPUT #
+###############
+
+
+cdef inline Py_ssize_t format_int(char* p, int64_t v) noexcept nogil:
+    """Write the decimal representation of `v` at `p`, returning the number of
+    characters written."""
+    cdef char tmp[20]
+    cdef Py_ssize_t n = 0, k = 0
+    cdef uint64_t u
+    if v < 0:
+        p[0] = b'-'
+        k = 1
+        u = <uint64_t> (-(v + 1)) + 1
+    else:
+        u = <uint64_t> v
+    while True:
+        tmp[n] = <char> (48 + u % 10)
+        u //= 10
+        n += 1
+        if u == 0:
+            break
+    while n > 0:
+        n -= 1
+        p[k] = tmp[n]
+        k += 1
+    return k
+
+
+# uncompressed size of a BGZF block, as written by htslib
+DEF BGZF_BLOCK_SIZE = 0xff00
+DEF BGZF_MAX_BLOCK_SIZE = 0x10000
+
+# tabix index parameters
+DEF TBX_UCSC = 0x10000
+DEF TBI_MIN_SHIFT = 14
+DEF TBI_N_LVLS = 5
+
+# empty block marking the end of a BGZF file
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00' \
+           b'\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def compress_block(bytes data, int level):
+    """Compress up to one block of data into a BGZF block."""
+    cdef const char* src = data
+    cdef size_t slen = len(data), dlen = BGZF_MAX_BLOCK_SIZE
+    cdef int ret
+    block = PyBytes_FromStringAndSize(NULL, BGZF_MAX_BLOCK_SIZE)
+    cdef char* dst = PyBytes_AS_STRING(block)
+    with nogil:
+        ret = bgzf_compress(dst, &dlen, src, slen, level)
+    if ret < 0:
+        raise IOError('failed to compress block')
+    return block[:dlen]
+
+
+cdef struct IndexEntry:
+    int tid  # -1 for the start of the first record
+    int64_t beg
+    int64_t end
+    uint64_t offset  # uncompressed offset of the end of the line
+
+
+cdef class BgzfWriter(object):
+    """Binary stream writing BGZF compressed blocks to a file, optionally
+    building a tabix index as lines are written.
+
+    Blocks are compressed by a pool of threads and written in order. Index
+    entries are kept with their uncompressed offsets until the block holding
+    them has been written, then pushed to the index with virtual offsets.
+
+    Parameters
+    ----------
+    path : string
+        Output file path. The index is written to `path` + '.tbi'.
+    threads : int
+        Number of compression threads.
+    level : int
+        Compression level, -1 for the zlib default.
+    index : bool
+        If True, build a tabix index of the lines passed to `push`.
+    seq_col : int
+        Column of the chromosome name, one-based.
+    pos_col : int
+        Column of the position, one-based.
+    one_based : bool
+        Coordinate system of the position column.
+    skip : int
+        Number of header lines to skip.
+
+    """
+
+    cdef:
+        object fileobj, path, pending, blocks, executor
+        int level, threads
+        readonly bint indexing
+        readonly uint64_t uoffset
+        uint64_t block_index, address
+        tuple conf
+        list names
+        dict tids
+        bytes last_chrom
+        int last_tid
+        IndexEntry* entries
+        Py_ssize_t n_entries, head, max_entries
+        hts_idx_t* idx
+
+    def __init__(self, path, threads=1, level=-1, index=False, seq_col=1, pos_col=2,
+                 one_based=True, skip=0):
+        self.path = path
+        self.threads = threads
+        self.level = level
+        self.indexing = index
+        self.conf = (0 if one_based else TBX_UCSC, seq_col, pos_col, pos_col, ord('#'), skip)
+        self.names = list()
+        self.tids = dict()
+        self.last_chrom = None
+        self.last_tid = -1
+        self.pending = bytearray()
+        self.blocks = collections.deque()
+        self.executor = None
+        if threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(self.threads)
+        self.fileobj = open(path, 'wb')
+
+    def __dealloc__(self):
+        free(self.entries)
+        if self.idx != NULL:
+            hts_idx_destroy(self.idx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def tell(self):
+        """Number of uncompressed bytes written so far."""
+        return self.uoffset
+
+    def write(self, data):
+        """Write bytes, or a string encoded as UTF-8."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.pending += data
+        self.uoffset += len(data)
+        while len(self.pending) >= BGZF_BLOCK_SIZE:
+            self.submit(bytes(self.pending[:BGZF_BLOCK_SIZE]))
+            del self.pending[:BGZF_BLOCK_SIZE]
+        return len(data)
+
+    cdef submit(self, data):
+        if self.executor is None:
+            self.write_block(compress_block(data, self.level), len(data))
+            return
+        self.blocks.append((self.executor.submit(compress_block, data, self.level), len(data)))
+        # keep the compression threads busy, but bound the blocks held in memory
+        while self.blocks and (self.blocks[0][0].done() or
+                               len(self.blocks) > 4 * self.threads):
+            future, size = self.blocks.popleft()
+            self.write_block(future.result(), size)
+
+    cdef write_block(self, block, Py_ssize_t size):
+        """Write a compressed block, then resolve index entries up to the end of
+        the block."""
+        cdef uint64_t start = self.block_index * BGZF_BLOCK_SIZE
+        cdef uint64_t address = self.address
+        self.fileobj.write(block)
+        self.address += len(block)
+        self.block_index += 1
+        if self.indexing:
+            self.resolve(start, start + size, address)
+
+    cdef resolve(self, uint64_t start, uint64_t stop, uint64_t address):
+        cdef IndexEntry* e
+        cdef uint64_t voffset
+        while self.head < self.n_entries and self.entries[self.head].offset <= stop:
+            e = &self.entries[self.head]
+            if e.offset < stop:
+                voffset = (address << 16) | (e.offset - start)
+            else:
+                # the end of a block is the start of the next, as when reading
+                voffset = self.address << 16
+            if e.tid < 0:
+                self.idx = hts_idx_init(0, HTS_FMT_TBI, voffset, TBI_MIN_SHIFT, TBI_N_LVLS)
+                if self.idx == NULL:
+                    raise MemoryError()
+            elif hts_idx_push(self.idx, e.tid, e.beg, e.end, voffset, 1) < 0:
+                raise ValueError('records are not sorted by chromosome and position')
+            self.head += 1
+
+    cdef int add_entry(self, int tid, int64_t beg, int64_t end, uint64_t offset) except -1:
+        cdef IndexEntry* entries
+        if self.n_entries == self.max_entries:
+            if self.head > 0:
+                # drop resolved entries
+                memmove(self.entries, &self.entries[self.head],
+                        (self.n_entries - self.head) * sizeof(IndexEntry))
+                self.n_entries -= self.head
+                self.head = 0
+            if self.n_entries == self.max_entries:
+                self.max_entries = max(2 * self.max_entries, 2**12)
+                entries = <IndexEntry*> realloc(self.entries,
+                                                self.max_entries * sizeof(IndexEntry))
+                if entries == NULL:
+                    raise MemoryError()
+                self.entries = entries
+        self.entries[self.n_entries].tid = tid
+        self.entries[self.n_entries].beg = beg
+        self.entries[self.n_entries].end = end
+        self.entries[self.n_entries].offset = offset
+        self.n_entries += 1
+        return 0
+
+    cdef int push(self, const char* chrom, Py_ssize_t n, int64_t pos, uint64_t offset) except -1:
+        """Add an index entry for a line ending at the uncompressed `offset`,
+        which must be pushed before the line itself is written."""
+        cdef int64_t beg = pos if self.conf[0] & TBX_UCSC else pos - 1
+        if self.last_chrom is None:
+            # the first record starts after everything written so far
+            self.add_entry(-1, 0, 0, self.uoffset)
+        if (self.last_chrom is None or n != len(self.last_chrom) or
+                memcmp(chrom, PyBytes_AS_STRING(self.last_chrom), n) != 0):
+            self.last_chrom = PyBytes_FromStringAndSize(chrom, n)
+            if self.last_chrom not in self.tids:
+                self.tids[self.last_chrom] = len(self.names)
+                self.names.append(self.last_chrom)
+            self.last_tid = self.tids[self.last_chrom]
+        return self.add_entry(self.last_tid, max(beg, 0), max(beg, 0) + 1, offset)
+
+    def close(self):
+        """Write any remaining data and the end of file marker, then save the
+        index."""
+        if self.fileobj is None:
+            return
+        try:
+            if self.pending:
+                self.submit(bytes(self.pending))
+                self.pending = bytearray()
+            while self.blocks:
+                future, size = self.blocks.popleft()
+                self.write_block(future.result(), size)
+            self.fileobj.write(BGZF_EOF)
+        finally:
+            self.fileobj.close()
+            self.fileobj = None
+            if self.executor is not None:
+                self.executor.shutdown()
+        if self.indexing:
+            self.save_index()
+
+    cdef save_index(self):
+        # start of the end of file marker
+        cdef uint64_t final = self.address << 16
+        if self.idx == NULL:
+            self.idx = hts_idx_init(0, HTS_FMT_TBI, final, TBI_MIN_SHIFT, TBI_N_LVLS)
+            if self.idx == NULL:
+                raise MemoryError()
+        if hts_idx_finish(self.idx, final) < 0:
+            raise IOError('failed to finish index')
+        names = b''.join(name + b'\0' for name in self.names)
+        meta = struct.pack('<7i', *(self.conf + (len(names),))) + names
+        if hts_idx_set_meta(self.idx, len(meta), <uint8_t*> PyBytes_AS_STRING(meta), 1) < 0:
+            raise MemoryError()
+        path = self.path.encode() if isinstance(self.path, str) else self.path
+        if hts_idx_save(self.idx, path, HTS_FMT_TBI) < 0:
+            raise IOError('failed to save index: %s.tbi' % self.path)
+
+
+cdef class TextWriter(object):
+    """Write structured arrays of records to a stream as delimited text, one line
+    per record. Lines are formatted into a reusable buffer which is written out
+    in large blocks. Values are never quoted, so string fields must not contain
+    the delimiter or line terminator.
+
+    Parameters
+    ----------
+    out : file-like
+        Text or binary stream to write to.
+    fields : sequence of strings
+        Names of fields to write, in order.
+    delimiter : string
+        Field delimiter.
+    lineterminator : string
+        Line terminator.
+
+    """
+
+    cdef:
+        object out
+        tuple fields
+        bint text
+        bytes delimiter, lineterminator
+        char* buf
+        Py_ssize_t bufsize
+
+    def __init__(self, out, fields, delimiter='\t', lineterminator='\r\n'):
+        self.out = out
+        self.fields = tuple(fields)
+        self.text = isinstance(out, io.TextIOBase)
+        self.delimiter = delimiter.encode('ascii')
+        self.lineterminator = lineterminator.encode('ascii')
+        self.bufsize = 0
+
+    def __dealloc__(self):
+        free(self.buf)
+
+    cdef flush(self, Py_ssize_t size):
+        data = PyBytes_FromStringAndSize(self.buf, size)
+        if self.text:
+            self.out.write(data.decode('ascii'))
+        else:
+            self.out.write(data)
+
+    def write(self, a):
+        """Write every record in the structured array `a`, returning the number
+        of records written."""
+        cdef Py_ssize_t n = a.shape[0], nf = len(self.fields), i, j, m, w, rowsize
+        cdef Py_ssize_t nd = len(self.delimiter), nl = len(self.lineterminator)
+        cdef const char* delimiter = self.delimiter
+        cdef const char* lineterminator = self.lineterminator
+        cdef const uint8_t[:, ::1] strs
+        cdef const int64_t[::1] ints
+        cdef char* p
+        cdef char* end
+        cdef const uint8_t* src
+        cdef Py_ssize_t* widths
+        cdef const void** cols
+        cdef char* buf
+        cdef BgzfWriter index = None
+        cdef Py_ssize_t chrom_j = 0, pos_j = 0
+        if n == 0 or nf == 0:
+            return n
+        if isinstance(self.out, BgzfWriter) and self.out.indexing:
+            # lines are indexed by chrom and pos
+            index = self.out
+            chrom_j = self.fields.index('chrom')
+            pos_j = self.fields.index('pos')
+
+        # columns as contiguous integers, or fixed width bytes
+        columns = list()
+        widths = <Py_ssize_t*> malloc(nf * sizeof(Py_ssize_t))
+        cols = <const void**> malloc(nf * sizeof(void*))
+        if widths == NULL or cols == NULL:
+            free(widths)
+            free(cols)
+            raise MemoryError()
+        try:
+            rowsize = nl
+            for j, f in enumerate(self.fields):
+                c = a[f]
+                if c.dtype.kind == 'S':
+                    w = c.dtype.itemsize
+                    strs = np.ascontiguousarray(c).view('u1').reshape(n, w)
+                    cols[j] = &strs[0, 0]
+                    columns.append(strs)
+                else:
+                    w = 0
+                    ints = np.ascontiguousarray(c, dtype='i8')
+                    cols[j] = &ints[0]
+                    columns.append(ints)
+                widths[j] = w
+                rowsize += (w if w else 20) + nd
+
+            # buffer holds many lines, and at least one
+            if self.bufsize < max(rowsize, 2**20):
+                buf = <char*> realloc(self.buf, max(rowsize, 2**20))
+                if buf == NULL:
+                    raise MemoryError()
+                self.buf = buf
+                self.bufsize = max(rowsize, 2**20)
+
+            p = self.buf
+            end = self.buf + self.bufsize
+            for i in range(n):
+                if end - p < rowsize:
+                    self.flush(p - self.buf)
+                    p = self.buf
+                for j in range(nf):
+                    if j > 0:
+                        memcpy(p, delimiter, nd)
+                        p += nd
+                    w = widths[j]
+                    if w:
+                        # copy up to the first null byte
+                        src = (<const uint8_t*> cols[j]) + i * w
+                        m = 0
+                        while m < w and src[m] != 0:
+                            p[m] = <char> src[m]
+                            m += 1
+                        p += m
+                    else:
+                        p += format_int(p, (<const int64_t*> cols[j])[i])
+                memcpy(p, lineterminator, nl)
+                p += nl
+                if index is not None:
+                    src = (<const uint8_t*> cols[chrom_j]) + i * widths[chrom_j]
+                    m = 0
+                    while m < widths[chrom_j] and src[m] != 0:
+                        m += 1
+                    index.push(<const char*> src, m, (<const int64_t*> cols[pos_j])[i],
+                               index.uoffset + (p - self.buf))
+            self.flush(p - self.buf)
+
+        finally:
+            free(widths)
+            free(cols)
+
+        return n
+
+
 # SANDBOX
 
 
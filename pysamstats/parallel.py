@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division
+import functools
+import multiprocessing
+import sys
+
+
+from pysam import AlignmentFile, FastaFile
+
+
+import pysamstats.opt as opt
+
+
+# number of shards to aim for per worker process, so that shards of uneven
+# cost still keep all workers busy
+SHARDS_PER_JOB = 4
+
+# shards are never split smaller than this many bases
+MIN_SHARD_LENGTH = 1000
+
+
+def determine_n_jobs(n_jobs):
+    """Number of worker processes to use, where a negative value counts back
+    from the number of CPUs, e.g., -1 means use all CPUs."""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, multiprocessing.cpu_count() + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+def make_shards(alignmentfile, chrom, start, end, one_based, n_jobs, split=True, regions=None,
+                own=True):
+    """Split the selected region(s) into shards for parallel execution.
+
+    Parameters
+    ----------
+
+    alignmentfile : pysam.AlignmentFile or string
+        SAM or BAM file or file path.
+    chrom : string
+        Chromosome/contig, or None for all contigs.
+    start : int
+        Start position.
+    end : int
+        End position.
+    one_based : bool
+        Coordinate system.
+    n_jobs : int
+        Number of worker processes.
+    split : bool
+        If True, regions may be split into smaller intervals, otherwise each
+        shard holds one or more whole regions.
+    regions : string or list of tuples
+        BED file path or list of (chrom, start, end) tuples, overriding `chrom`,
+        `start` and `end`.
+    own : bool
+        If True, records between neighbouring regions on the same chromosome
+        belong to the preceding region, as in a single pass over the regions.
+
+    Returns
+    -------
+
+    shards : list of tuples
+        Shards in genome order, each a tuple (regions, own_start, own_end),
+        where regions is a list of (chrom, start, end) tuples and records with
+        positions from own_start to own_end belong to the shard, all in
+        zero-based coordinates. Ownership is unbounded at the edges of each
+        chromosome.
+
+    """
+
+    if not isinstance(alignmentfile, AlignmentFile):
+        alignmentfile = AlignmentFile(alignmentfile)
+
+    # regions to shard
+    if regions is not None:
+        regions = opt.normalise_regions(alignmentfile, regions, one_based)
+    elif chrom is None:
+        regions = [(c, 0, l) for c, l in zip(alignmentfile.references, alignmentfile.lengths)]
+    else:
+        start, end = opt.normalise_coords(alignmentfile, chrom, start, end, one_based)
+        regions = [(chrom, start, end)]
+
+    # estimate number of reads in each region from the index, assuming reads
+    # are evenly spread along each contig
+    lengths = dict(zip(alignmentfile.references, alignmentfile.lengths))
+    try:
+        mapped = dict((s.contig, s.mapped) for s in alignmentfile.get_index_statistics())
+    except ValueError:
+        # no index, fall back to contig length
+        mapped = lengths
+    loads = [mapped.get(c, 0) * (e - s) / max(1, lengths[c]) for c, s, e in regions]
+    target = max(1, sum(loads) / (n_jobs * SHARDS_PER_JOB))
+
+    # split large regions, and group consecutive small regions up to the target
+    # load
+    groups = list()
+    group, group_load = list(), 0
+    for (c, s, e), load in zip(regions, loads):
+        n = 1
+        if split:
+            n = int(min(load // target + 1, max(1, (e - s) // MIN_SHARD_LENGTH)))
+        if n > 1:
+            if group:
+                groups.append(group)
+                group, group_load = list(), 0
+            bounds = [s + (e - s) * i // n for i in range(n + 1)]
+            groups.extend([[(c, bounds[i], bounds[i + 1])] for i in range(n)])
+        else:
+            group.append((c, s, e))
+            group_load += load
+            if group_load >= target:
+                groups.append(group)
+                group, group_load = list(), 0
+    if group:
+        groups.append(group)
+
+    shards = list()
+    for i, group in enumerate(groups):
+        own_start, own_end = -sys.maxsize, sys.maxsize
+        c = group[0][0]
+        if own and i > 0 and groups[i - 1][-1][0] == c:
+            own_start = group[0][1]
+        c = group[-1][0]
+        if own and i + 1 < len(groups) and groups[i + 1][0][0] == c:
+            own_end = groups[i + 1][0][1]
+        shards.append((group, own_start, own_end))
+
+    return shards
+
+
+def map_shards(statfun, shards, n_jobs, one_based, **kwargs):
+    """Compute statistics for each shard in a pool of worker processes, yielding
+    results in genome order."""
+
+    func = functools.partial(_run_shard, statfun, one_based, kwargs)
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        for result in pool.imap(func, shards):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _run_shard(statfun, one_based, kwargs, shard):
+    regions, own_start, own_end = shard
+    offset = 1 if one_based else 0
+    own_start += offset
+    own_end += offset
+    regions = [(c, s + offset, e + offset) for c, s, e in regions]
+    it = statfun(regions=regions, one_based=one_based, **kwargs)
+    if kwargs.get('batch_size') is None:
+        # position is the second item of a tuple record
+        key = 1 if kwargs.get('record_type') == 'tuple' else 'pos'
+        return [rec for rec in it if own_start <= rec[key] < own_end]
+    else:
+        return [a[(a['pos'] >= own_start) & (a['pos'] < own_end)] for a in it]
+
+
+def _filename(f):
+    # worker processes open files by path
+    if isinstance(f, (AlignmentFile, FastaFile)):
+        filename = f.filename
+        if not isinstance(filename, str):
+            # bytes under Python 3
+            filename = filename.decode(sys.getfilesystemencoding(), 'surrogateescape')
+        return filename
+    return f
+
+
+def stat_sharded(statfun, alignmentfile, fafile, n_jobs, split, chrom, start, end, one_based,
+                 regions=None, **kwargs):
+    """Generate statistics by running `statfun` over shards of the selected
+    region(s) in parallel, yielding the same records as a single pass would.
+    Sub-contig shards are only used where `split` is True, which also means
+    records between neighbouring regions belong to the preceding region."""
+
+    n_jobs = determine_n_jobs(n_jobs)
+    shards = make_shards(alignmentfile, chrom, start, end, one_based, n_jobs, split=split,
+                         regions=regions, own=split)
+    results = map_shards(statfun, shards, n_jobs, one_based,
+                         alignmentfile=_filename(alignmentfile), fafile=_filename(fafile),
+                         **kwargs)
+    for result in results:
+        for rec in result:
+            yield rec
+
+
+def load_sharded(statfun, alignmentfile, fafile, dtype, fields, n_jobs, split, batch_size=2**16,
+                 **kwargs):
+    """Load statistics into a numpy array by running `statfun` over shards of
+    the selected region in parallel."""
+
+    import numpy as np
+
+    batches = list(stat_sharded(statfun, alignmentfile, fafile, n_jobs=n_jobs, split=split,
+                                batch_size=batch_size, **kwargs))
+    a = np.empty(sum(len(b) for b in batches), dtype=dtype)
+    n = 0
+    for b in batches:
+        k = len(b)
+        if a.dtype.names is None:
+            a[n:n + k] = b[fields[0]]
+        else:
+            for f in fields:
+                a[f][n:n + k] = b[f]
+        n += k
+    return a
@@ -5,16 +5,18 @@ import functools
 
 import pysamstats.opt as opt
 import pysamstats.util as util
+import pysamstats.parallel as parallel
 import pysamstats.config as config
 
 
 _doc_params = """
     Parameters
     ----------
-    type : string
+    type : string or list of strings
         Statistics type. One of "coverage", "coverage_strand", "coverage_ext",
         "coverage_ext_strand", "variation", "variation_strand", "tlen", "tlen_strand", "mapq",
         "mapq_strand", "baseq", "baseq_strand", "baseq_ext", "baseq_ext_strand", "coverage_gc".
+        If a list, all types are computed in a single pass and merged into one record.
     alignmentfile : pysam.AlignmentFile or string
         SAM or BAM file or file path.
     fafile : pysam.FastaFile or string, optional
@@ -25,6 +27,12 @@ _doc_params = """
         Start position.
     end : int, optional
         End position.
+    regions : string or list of tuples, optional
+        BED file path, or list of (chrom, start, end) tuples in the coordinate system given by
+        `one_based`, selecting several regions instead of `chrom`, `start` and `end`. Regions are
+        sorted and merged, then walked in genome order in a single pass. If not truncated,
+        records between neighbouring regions on the same chromosome come from the preceding
+        region.
     one_based : bool, optional
         Coordinate system, False if zero-based (default), True if one-based.
     truncate : bool, optional
@@ -39,14 +47,30 @@ _doc_params = """
         Distance from window start to record position (only applies to coverage_gc).
     min_mapq : int, optional
         Only reads with mapping quality equal to or greater than this value will be counted (0
-        by default).
+        by default). Other reads are skipped before they enter the pileup, so they do not count
+        towards max_depth.
     min_baseq : int, optional
         Only reads with base quality equal to or greater than this value will be counted (0 by
         default).
     no_del : bool, optional
         If True, don't count reads aligned with a deletion at the current position.
     no_dup : bool, optional
-        If True, don't count reads flagged as duplicate."""
+        If True, don't count reads flagged as duplicate. Like min_mapq, applied before the
+        pileup.
+    flag_require : int, optional
+        Only count reads with all of these flags set, applied before the pileup.
+    flag_filter : int, optional
+        Don't count reads with any of these flags set, in addition to reads skipped by the
+        stepper, applied before the pileup.
+    n_jobs : int, optional
+        Number of processes to use (1 by default, -1 for all CPUs). If greater than 1, the
+        selected region is split into shards balanced by read counts from the BAM index, which
+        are computed in parallel and merged back in genome order.
+    engine : {{'pileup', 'scatter'}}, optional
+        If 'scatter', compute statistics by adding each read's values over the positions it
+        covers, instead of via the pileup, which is much faster at high depth. Only supported for
+        "coverage", "coverage_strand", "coverage_ext", "mapq" and "tlen", with the "all" or
+        "nofilter" stepper and no min_baseq. N.B., max_depth is not applied."""
 
 
 # noinspection PyShadowingBuiltins
@@ -66,32 +90,78 @@ def stat_pileup(type,
                 min_mapq=0,
                 min_baseq=0,
                 no_del=False,
-                no_dup=False):
+                no_dup=False,
+                flag_require=0,
+                flag_filter=0,
+                n_jobs=1,
+                engine='pileup',
+                batch_size=None,
+                regions=None,
+                fields=None,
+                record_type='dict'):
     """Generate statistics per genome position, based on read pileups.
     {params}
+    batch_size : int, optional
+        If given, generate numpy structured arrays each holding records for up to this many
+        genome positions, instead of one dict per position.
+    fields : list of strings, optional
+        If given, only compute these fields. Records always include "chrom" and "pos".
+    record_type : {{'dict', 'tuple'}}, optional
+        If 'tuple', generate one tuple per genome position instead of a dict, holding "chrom" and
+        "pos" followed by the other computed fields, in the order of the default dtype. Ignored
+        if `batch_size` is given.
 
     Returns
     -------
     recs : iterator
-        An iterator yielding dict objects, where each dict holds data for a single genome position.
+        An iterator yielding dict objects, where each dict holds data for a single genome position,
+        or tuples if `record_type` is 'tuple', or structured arrays if `batch_size` is given.
 
     """
 
-    if type in config.stats_types_withref and fafile is None:
-        raise ValueError('reference sequence is required; please provide fafile argument')
+    if record_type not in ('dict', 'tuple'):
+        raise ValueError('unsupported record type: %r' % record_type)
 
-    try:
-        if type == 'coverage_gc':
-            stat = stats_classes_pileup[type](window_size=window_size, window_offset=window_offset)
-        else:
-            stat = stats_classes_pileup[type]()
-    except KeyError:
-        raise ValueError('unsupported statistics type: %r' % type)
+    stat = _make_stat(type, fafile=fafile, window_size=window_size, window_offset=window_offset,
+                      engine=engine, fields=fields)
+
+    if parallel.determine_n_jobs(n_jobs) > 1:
+        return parallel.stat_sharded(functools.partial(stat_pileup, type), alignmentfile,
+                                     fafile=fafile, n_jobs=n_jobs, split=True, chrom=chrom,
+                                     start=start, end=end, regions=regions, one_based=one_based,
+                                     truncate=truncate, stepper=stepper, pad=pad,
+                                     max_depth=max_depth, window_size=window_size,
+                                     window_offset=window_offset, min_mapq=min_mapq,
+                                     min_baseq=min_baseq, no_del=no_del, no_dup=no_dup,
+                                     flag_require=flag_require, flag_filter=flag_filter,
+                                     engine=engine, batch_size=batch_size, fields=fields,
+                                     record_type=record_type)
+
+    if batch_size is not None:
+        dtype = [(f, t) for f, t in util.determine_dtype(_default_dtype(type), alignmentfile)
+                 if f in ('chrom', 'pos') or f in stat.fields]
+        return opt.iter_pileup_batches(stat, alignmentfile=alignmentfile, fafile=fafile,
+                                       chrom=chrom, start=start, end=end, regions=regions,
+                                       one_based=one_based, truncate=truncate, stepper=stepper,
+                                       pad=pad,
+                                       max_depth=max_depth, min_mapq=min_mapq,
+                                       min_baseq=min_baseq, no_del=no_del, no_dup=no_dup,
+                                       flag_require=flag_require, flag_filter=flag_filter,
+                                       batch_size=batch_size, dtype=dtype)
+
+    if record_type == 'tuple':
+        return opt.iter_pileup_rows(stat, alignmentfile=alignmentfile, fafile=fafile,
+                                    chrom=chrom, start=start, end=end, regions=regions,
+                                    one_based=one_based, truncate=truncate, stepper=stepper,
+                                    pad=pad, max_depth=max_depth, min_mapq=min_mapq,
+                                    min_baseq=min_baseq, no_del=no_del, no_dup=no_dup,
+                                    flag_require=flag_require, flag_filter=flag_filter)
 
     return opt.iter_pileup(stat, alignmentfile=alignmentfile, fafile=fafile, chrom=chrom,
-                           start=start, end=end, one_based=one_based, truncate=truncate, stepper=stepper, pad=pad,
-                           max_depth=max_depth, min_mapq=min_mapq, min_baseq=min_baseq,
-                           no_del=no_del, no_dup=no_dup)
+                           start=start, end=end, regions=regions, one_based=one_based,
+                           truncate=truncate, stepper=stepper, pad=pad, max_depth=max_depth,
+                           min_mapq=min_mapq, min_baseq=min_baseq, no_del=no_del, no_dup=no_dup,
+                           flag_require=flag_require, flag_filter=flag_filter)
 
 
 stat_pileup.__doc__ = stat_pileup.__doc__.format(params=_doc_params)
@@ -115,8 +185,13 @@ def load_pileup(type,
                 min_baseq=0,
                 no_del=False,
                 no_dup=False,
+                flag_require=0,
+                flag_filter=0,
                 dtype=None,
-                fields=None):
+                fields=None,
+                n_jobs=1,
+                engine='pileup',
+                regions=None):
     """Load statistics per genome position, based on read pileups.
     {params}
     dtype : dtype
@@ -131,20 +206,80 @@ def load_pileup(type,
 
     """
 
-    statfun = functools.partial(stat_pileup, type)
+    default_dtype = _default_dtype(type)
+    kwargs = dict()
+
+    if parallel.determine_n_jobs(n_jobs) > 1:
+        # worker processes make their own stat
+        loadfun = functools.partial(parallel.load_sharded,
+                                    functools.partial(stat_pileup, type, fields=fields),
+                                    n_jobs=n_jobs, split=True)
+        kwargs = dict(window_size=window_size, window_offset=window_offset, engine=engine)
+    else:
+        stat = _make_stat(type, fafile=fafile, window_size=window_size,
+                          window_offset=window_offset, engine=engine, fields=fields)
+        loadfun = functools.partial(opt.load_pileup, stat)
+
+    return util.load_stats(loadfun, user_dtype=dtype, default_dtype=default_dtype,
+                           user_fields=fields, alignmentfile=alignmentfile, fafile=fafile,
+                           chrom=chrom, start=start, end=end, regions=regions, one_based=one_based,
+                           truncate=truncate, stepper=stepper, pad=pad, max_depth=max_depth,
+                           min_mapq=min_mapq, min_baseq=min_baseq, no_del=no_del, no_dup=no_dup,
+                           flag_require=flag_require, flag_filter=flag_filter, **kwargs)
+
+
+load_pileup.__doc__ = load_pileup.__doc__.format(params=_doc_params)
+
+
+# noinspection PyShadowingBuiltins
+def _default_dtype(type):
+
+    if isinstance(type, (list, tuple)):
+        return util.merge_dtypes([_default_dtype(t) for t in type])
+
     try:
-        default_dtype = getattr(config, 'dtype_' + type)
+        return getattr(config, 'dtype_' + type)
     except AttributeError:
         raise ValueError('unsupported statistics type: %r' % type)
 
-    return util.load_stats(statfun, user_dtype=dtype, default_dtype=default_dtype,
-                           user_fields=fields, alignmentfile=alignmentfile, fafile=fafile,
-                           chrom=chrom, start=start, end=end, one_based=one_based,
-                           truncate=truncate, stepper=stepper, pad=pad, max_depth=max_depth, window_size=window_size,
-                           window_offset=window_offset, min_mapq=min_mapq, min_baseq=min_baseq, no_del=no_del, no_dup=no_dup)
 
+# noinspection PyShadowingBuiltins
+def _make_stat(type, fafile, window_size, window_offset, engine='pileup', fields=None):
 
-load_pileup.__doc__ = load_pileup.__doc__.format(params=_doc_params)
+    if fields is not None and engine == 'pileup':
+        # only compute the selected fields
+        stat = _make_stat(type, fafile=fafile, window_size=window_size,
+                          window_offset=window_offset)
+        stats = stat.stats if isinstance(stat, opt.MultiPileupStat) else [stat]
+        if isinstance(fields, str):
+            fields = [fields]
+        return opt.MultiPileupStat(stats, fields=opt.value_fields([(f, None) for f in fields]))
+
+    if engine == 'scatter':
+        try:
+            return stats_classes_scatter[type]()
+        except (KeyError, TypeError):
+            raise ValueError('statistics type not supported by the scatter engine: %r' % (type,))
+    elif engine != 'pileup':
+        raise ValueError('unsupported engine: %r' % engine)
+
+    if isinstance(type, (list, tuple)):
+        return opt.MultiPileupStat([_make_stat(t, fafile=fafile, window_size=window_size,
+                                               window_offset=window_offset)
+                                    for t in type])
+
+    if type in config.stats_types_withref and fafile is None:
+        raise ValueError('reference sequence is required; please provide fafile argument')
+
+    try:
+        if type == 'coverage_gc':
+            stat = stats_classes_pileup[type](window_size=window_size, window_offset=window_offset)
+        else:
+            stat = stats_classes_pileup[type]()
+    except KeyError:
+        raise ValueError('unsupported statistics type: %r' % type)
+
+    return stat
 
 
 stats_classes_pileup = {
@@ -166,6 +301,15 @@ stats_classes_pileup = {
 }
 
 
+stats_classes_scatter = {
+    'coverage': opt.CoverageScatter,
+    'coverage_strand': opt.CoverageStrandScatter,
+    'coverage_ext': opt.CoverageExtScatter,
+    'mapq': opt.MapqScatter,
+    'tlen': opt.TlenScatter,
+}
+
+
 # backwards compatibility
 #########################
 
@@ -173,8 +317,8 @@ stats_classes_pileup = {
 _stat_doc_lines = stat_pileup.__doc__.split('\n')
 _load_doc_lines = load_pileup.__doc__.split('\n')
 # strip "type" parameter
-_stat_doc = '\n'.join(_stat_doc_lines[:4] + _stat_doc_lines[8:])
-_load_doc = '\n'.join(_load_doc_lines[:4] + _load_doc_lines[8:])
+_stat_doc = '\n'.join(_stat_doc_lines[:4] + _stat_doc_lines[9:])
+_load_doc = '\n'.join(_load_doc_lines[:4] + _load_doc_lines[9:])
 
 
 def _specialize(type):
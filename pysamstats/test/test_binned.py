@@ -6,7 +6,8 @@ import logging
 
 
 from pysam import Samfile, Fastafile
-from nose.tools import eq_
+from nose.tools import eq_, assert_raises
+import numpy as np
 from numpy import around as round
 
 
@@ -624,3 +625,74 @@ def test_binned_pad_wg():
         eq_(60100, a[a['chrom'] == b'Pf3D7_02_v3']['pos'][-1])
         eq_(100, a[a['chrom'] == b'Pf3D7_03_v3']['pos'][0])
         eq_(70100, a[a['chrom'] == b'Pf3D7_03_v3']['pos'][-1])
+
+
+def test_binned_batches():
+    kwargs = {'chrom': 'Pf3D7_01_v3',
+              'start': 1000,
+              'end': 20000,
+              'one_based': False,
+              'window_size': 200,
+              'window_offset': 100}
+    for f, needs_ref in binned_functions:
+        debug(f.__name__)
+        stats_type = f.args[0]
+        if needs_ref:
+            expect = f(Samfile('fixture/test.bam'), Fastafile('fixture/ref.fa'), **kwargs)
+            batches = list(pysamstats.stat_binned(stats_type, Samfile('fixture/test.bam'),
+                                                  Fastafile('fixture/ref.fa'), batch_size=30,
+                                                  **kwargs))
+        else:
+            expect = f(Samfile('fixture/test.bam'), **kwargs)
+            batches = list(pysamstats.stat_binned(stats_type, Samfile('fixture/test.bam'),
+                                                  batch_size=30, **kwargs))
+        assert all(len(b) == 30 for b in batches[:-1])
+        actual = np.concatenate(batches)
+        eq_(expect.dtype.names, actual.dtype.names)
+        for k in expect.dtype.names:
+            assert np.array_equal(expect[k], actual[k]), k
+
+
+def test_binned_parallel():
+    for kwargs in ({}, {'chrom': 'Pf3D7_02_v3', 'start': 1000, 'end': 30000}):
+        expect = pysamstats.load_coverage_binned(Samfile('fixture/test.bam'),
+                                                 Fastafile('fixture/ref.fa'), **kwargs)
+        actual = pysamstats.load_coverage_binned(Samfile('fixture/test.bam'),
+                                                 Fastafile('fixture/ref.fa'), n_jobs=2, **kwargs)
+        eq_(expect.dtype, actual.dtype)
+        for k in expect.dtype.names:
+            assert np.array_equal(expect[k], actual[k]), k
+
+
+def test_binned_regions():
+    regions = [('Pf3D7_02_v3', 5000, 6000), ('Pf3D7_01_v3', 1000, 3000)]
+    expect = list()
+    for chrom, start, end in sorted(regions):
+        expect.extend(pysamstats.stat_coverage_binned(Samfile('fixture/test.bam'),
+                                                      Fastafile('fixture/ref.fa'), chrom=chrom,
+                                                      start=start, end=end))
+    actual = list(pysamstats.stat_coverage_binned(Samfile('fixture/test.bam'),
+                                                  Fastafile('fixture/ref.fa'), regions=regions))
+    eq_(expect, actual)
+
+
+def test_binned_no_fasta():
+    with assert_raises(ValueError):
+        pysamstats.load_coverage_binned(Samfile('fixture/test.bam'))
+
+
+def test_binned_tuples():
+    kwargs = {'chrom': 'Pf3D7_01_v3', 'start': 1000, 'end': 20000, 'window_size': 200}
+    for stats_type in 'coverage_ext', 'tlen':
+        debug(stats_type)
+        fields = [f for f, _ in getattr(pysamstats.config, 'dtype_%s_binned' % stats_type)]
+        expect = [tuple(rec[f] for f in fields) for rec in
+                  pysamstats.stat_binned(stats_type, Samfile('fixture/test.bam'),
+                                         Fastafile('fixture/ref.fa'), **kwargs)]
+        actual = list(pysamstats.stat_binned(stats_type, Samfile('fixture/test.bam'),
+                                             Fastafile('fixture/ref.fa'), record_type='tuple',
+                                             **kwargs))
+        eq_(expect, actual)
+    with assert_raises(ValueError):
+        pysamstats.stat_binned('coverage', Samfile('fixture/test.bam'),
+                               Fastafile('fixture/ref.fa'), record_type='list')
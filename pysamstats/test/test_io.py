@@ -1,10 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, division
 import logging
+import csv
+import io
+import json
+import os
+import shutil
+import gzip
+import tempfile
 
-from pysam import Samfile
+import pysam
+from pysam import Samfile, Fastafile
+from nose.tools import eq_
+from nose.plugins.skip import SkipTest
+import numpy as np
 
-from pysamstats.io import write_hdf5
+import pysamstats
+from pysamstats.io import write_csv, write_hdf5, write_parquet, write_zarr, write_native, \
+    write_bigwig
 import tables
 
 logger = logging.getLogger(__name__)
@@ -38,3 +51,327 @@ def test_write_hdf5_chrom_dtype():
 
     for arg in zip(dtypes, alignments, results, labels):
         assert check_write_hdf5_chrom_dtype(arg)
+
+
+def test_write_hdf5_per_contig():
+    expect = pysamstats.load_coverage(Samfile('fixture/test.bam'), pad=True)
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'out.h5')
+        write_hdf5('coverage', path, Samfile('fixture/test.bam'), pad=True,
+                   hdf5_per_contig=True, hdf5_complib='blosc:lz4', threads=2,
+                   hdf5_chunksize=2**14)
+        with tables.open_file(path, mode='r') as h5file:
+            contigs = [node.name for node in h5file.root.data]
+            eq_(['Pf3D7_01_v3', 'Pf3D7_02_v3', 'Pf3D7_03_v3'], contigs)
+            for chrom in contigs:
+                table = h5file.get_node('/data', chrom)
+                eq_(('pos', 'reads_all', 'reads_pp'), table.dtype.names)
+                assert table.cols.pos.is_indexed
+                e = expect[expect['chrom'] == chrom.encode('ascii')]
+                for k in table.dtype.names:
+                    assert np.array_equal(e[k], table.col(k)), k
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_write_hdf5_checkpoint():
+    kwargs = {'pad': True}
+    expect = pysamstats.load_coverage(Samfile('fixture/test.bam'), **kwargs)
+    append = tables.Table.append
+    for per_contig in False, True:
+        debug(per_contig)
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'out.h5')
+            checkpoint = os.path.join(tmp, 'out.checkpoint')
+            calls = [0]
+
+            def interrupted_append(table, rows):
+                # interrupted after half of the 8th chunk
+                calls[0] += 1
+                if calls[0] == 8:
+                    append(table, rows[:len(rows) // 2])
+                    raise _Interrupted()
+                append(table, rows)
+
+            tables.Table.append = interrupted_append
+            try:
+                write_hdf5('coverage', path, Samfile('fixture/test.bam'), hdf5_chunksize=80000,
+                           hdf5_per_contig=per_contig, checkpoint=checkpoint,
+                           checkpoint_interval=0, **kwargs)
+            except _Interrupted:
+                pass
+            else:
+                assert False, 'not interrupted'
+            finally:
+                tables.Table.append = append
+            write_hdf5('coverage', path, Samfile('fixture/test.bam'), hdf5_chunksize=80000,
+                       hdf5_per_contig=per_contig, checkpoint=checkpoint, resume=True,
+                       **kwargs)
+            check_write_hdf5_resumed(path, expect, per_contig)
+        finally:
+            shutil.rmtree(tmp)
+
+    # checkpoint on the last record of a contig, which was already indexed
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'out.h5')
+        checkpoint = os.path.join(tmp, 'out.checkpoint')
+        write_hdf5('coverage', path, Samfile('fixture/test.bam'), hdf5_per_contig=True,
+                   checkpoint=checkpoint, **kwargs)
+        with open(checkpoint) as f:
+            state = json.load(f)
+        state.update(chrom='Pf3D7_01_v3', pos=50000, rows=50001, complete=False)
+        with open(checkpoint, 'w') as f:
+            json.dump(state, f)
+        write_hdf5('coverage', path, Samfile('fixture/test.bam'), hdf5_per_contig=True,
+                   checkpoint=checkpoint, resume=True, **kwargs)
+        check_write_hdf5_resumed(path, expect, True)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def check_write_hdf5_resumed(path, expect, per_contig):
+    with tables.open_file(path, mode='r') as h5file:
+        if per_contig:
+            actual = list()
+            for c in 'Pf3D7_01_v3', 'Pf3D7_02_v3', 'Pf3D7_03_v3':
+                table = h5file.get_node('/data', c)
+                assert table.cols.pos.is_indexed
+                actual.append(table.read())
+            actual = np.concatenate(actual)
+        else:
+            actual = h5file.get_node('/data').read()
+    for k in actual.dtype.names:
+        assert np.array_equal(expect[k], actual[k]), k
+
+
+def test_write_csv():
+    # output is the same as writing each record with the csv module
+    kwargs = {'chrom': 'Pf3D7_01_v3', 'start': 1000, 'end': 20000, 'pad': True}
+    for stats_type, fields, dialect in (('variation', None, 'excel-tab'),
+                                        ('tlen', ['pos', 'chrom', 'mean_tlen'], 'excel'),
+                                        ('coverage', ['reads_all'], 'excel-tab')):
+        debug((stats_type, fields, dialect))
+        names = fields or [f for f, _ in getattr(pysamstats.config, 'dtype_' + stats_type)]
+        expect = io.StringIO()
+        writer = csv.writer(expect, dialect=dialect)
+        writer.writerow(names)
+        for rec in pysamstats.stat_pileup(stats_type, Samfile('fixture/test.bam'),
+                                          Fastafile('fixture/ref.fa'), **kwargs):
+            writer.writerow([rec[f] for f in names])
+        actual = io.StringIO()
+        write_csv(stats_type, actual, Samfile('fixture/test.bam'),
+                  fafile=Fastafile('fixture/ref.fa'), fields=fields, dialect=dialect, **kwargs)
+        eq_(expect.getvalue(), actual.getvalue())
+
+
+def test_write_csv_bgzf():
+    kwargs = {'chrom': 'Pf3D7_01_v3', 'start': 1000, 'end': 20000, 'pad': True, 'one_based': True}
+    expect = io.StringIO()
+    write_csv('coverage', expect, Samfile('fixture/test.bam'), **kwargs)
+    for threads in 1, 3:
+        debug(threads)
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'out.tsv.gz')
+            write_csv('coverage', path, Samfile('fixture/test.bam'), bgzf=True,
+                      threads=threads, **kwargs)
+            with gzip.open(path, 'rt', newline='') as f:
+                eq_(expect.getvalue(), f.read())
+            # tabix index is zero-based, half-open
+            tbx = pysam.TabixFile(path)
+            rows = [row.split('\t')[:2] for row in tbx.fetch('Pf3D7_01_v3', 1999, 2002)]
+            eq_([['Pf3D7_01_v3', '2000'], ['Pf3D7_01_v3', '2001'], ['Pf3D7_01_v3', '2002']],
+                rows)
+            tbx.close()
+        finally:
+            shutil.rmtree(tmp)
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class _InterruptedFile(io.TextIOWrapper):
+    # text file which fails half way through its n-th write
+    n = 0
+
+    def write(self, s):
+        self.n -= 1
+        if self.n == 0:
+            io.TextIOWrapper.write(self, s[:len(s) // 2])
+            self.flush()
+            raise _Interrupted()
+        return io.TextIOWrapper.write(self, s)
+
+
+def test_write_csv_checkpoint():
+    for stats_type, batch_size, kwargs in (
+            ('variation_strand', 10000, {'pad': True}),
+            ('coverage', 500, {'regions': [('Pf3D7_01_v3', 1000, 2000),
+                                           ('Pf3D7_01_v3', 5000, 8000),
+                                           ('Pf3D7_03_v3', 100, 20000)], 'one_based': True}),
+            ('coverage_binned', 50, {'chrom': 'Pf3D7_02_v3', 'start': 1000, 'window_size': 100})):
+        debug((stats_type, kwargs))
+        expect = io.StringIO()
+        write_csv(stats_type, expect, Samfile('fixture/test.bam'),
+                  fafile=Fastafile('fixture/ref.fa'), **kwargs)
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'out.txt')
+            checkpoint = os.path.join(tmp, 'out.checkpoint')
+            # interrupted part way through the 5th batch, checkpointed after each batch
+            f = _InterruptedFile(io.open(path, 'wb'))
+            f.n = 5
+            try:
+                write_csv(stats_type, f, Samfile('fixture/test.bam'),
+                          fafile=Fastafile('fixture/ref.fa'), progress=batch_size,
+                          checkpoint=checkpoint, checkpoint_interval=0, **kwargs)
+            except _Interrupted:
+                pass
+            else:
+                assert False, 'not interrupted'
+            f.close()
+            with open(path, 'r+') as f:
+                write_csv(stats_type, f, Samfile('fixture/test.bam'),
+                          fafile=Fastafile('fixture/ref.fa'), checkpoint=checkpoint,
+                          resume=True, **kwargs)
+            with open(path, newline='') as f:
+                eq_(expect.getvalue(), f.read())
+        finally:
+            shutil.rmtree(tmp)
+
+
+def test_write_parquet():
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SkipTest('pyarrow not installed')
+    kwargs = {'pad': True}
+    expect = pysamstats.load_variation(Samfile('fixture/test.bam'), Fastafile('fixture/ref.fa'),
+                                       **kwargs)
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'out.parquet')
+        write_parquet('variation', path, Samfile('fixture/test.bam'),
+                      fafile=Fastafile('fixture/ref.fa'), parquet_row_group_size=40000, **kwargs)
+        f = pq.ParquetFile(path)
+        # row groups are split between contigs
+        eq_([40000, 10001, 40000, 20001, 40000, 30001],
+            [f.metadata.row_group(i).num_rows for i in range(f.metadata.num_row_groups)])
+        actual = f.read()
+    finally:
+        shutil.rmtree(tmp)
+    eq_(list(expect.dtype.names), actual.column_names)
+    for k in expect.dtype.names:
+        values = actual.column(k).to_pylist()
+        if expect.dtype[k].kind == 'S':
+            values = [v.encode('ascii') for v in values]
+        assert np.array_equal(expect[k], np.array(values, dtype=expect.dtype[k])), k
+
+
+def test_write_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise SkipTest('zarr not installed')
+    # the second run writes to the output of the first
+    tmp = tempfile.mkdtemp(suffix='.zarr')
+    try:
+        for kwargs in {'pad': True}, {'chrom': 'Pf3D7_02_v3', 'start': 1000, 'end': 30000}:
+            debug(kwargs)
+            expect = pysamstats.load_coverage(Samfile('fixture/test.bam'), **kwargs)
+            write_zarr('coverage', tmp, Samfile('fixture/test.bam'), zarr_chunklen=5000, threads=2,
+                       **kwargs)
+            root = zarr.open_group(tmp, mode='r')
+            eq_(sorted(set(expect['chrom'].astype(str))), root.attrs['contigs'])
+            eq_(root.attrs['contigs'], sorted(root.group_keys()))
+            for chrom in root.attrs['contigs']:
+                e = expect[expect['chrom'] == chrom.encode('ascii')]
+                group = root[chrom]
+                eq_((5000,), group['reads_all'].chunks)
+                eq_((len(e),), group['reads_all'].shape)
+                if kwargs.get('pad'):
+                    # positions are implied
+                    assert 'pos' not in group
+                    pos = group.attrs['pos_start'] + np.arange(len(e))
+                else:
+                    pos = group['pos'][:]
+                assert np.array_equal(e['pos'], pos)
+                assert np.array_equal(e['reads_all'], group['reads_all'][:])
+                assert np.array_equal(e['reads_pp'], group['reads_pp'][:])
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_write_native():
+    kwargs = {'pad': True, 'one_based': True}
+    expect = pysamstats.load_coverage(Samfile('fixture/test.bam'), **kwargs)
+    for compression in None, 'zlib':
+        debug(compression)
+        tmp = tempfile.mkdtemp(suffix='.pss')
+        try:
+            write_native('coverage', tmp, Samfile('fixture/test.bam'), fields=['reads_all'],
+                         native_blocklen=5000, native_compression=compression, **kwargs)
+            stats = pysamstats.open_stats(tmp)
+            # pos is always written
+            eq_(('pos', 'reads_all'), stats.dtype.names)
+            eq_(['Pf3D7_01_v3', 'Pf3D7_02_v3', 'Pf3D7_03_v3'], stats.contigs)
+            eq_(len(expect), len(stats))
+            for chrom in stats.contigs:
+                e = expect[expect['chrom'] == chrom.encode('ascii')]
+                eq_(np.flatnonzero(expect['chrom'] == chrom.encode('ascii'))[0],
+                    stats.offset(chrom))
+                assert np.array_equal(e['reads_all'], stats.column(chrom, 'reads_all'))
+                for start, end in (None, None), (1000, 2000), (4999, 15002), (60000, None):
+                    columns = stats.fetch(chrom, start, end)
+                    mask = np.ones(len(e), dtype=bool)
+                    if start is not None:
+                        mask &= e['pos'] >= start
+                    if end is not None:
+                        mask &= e['pos'] < end
+                    for f in 'pos', 'reads_all':
+                        assert np.array_equal(e[f][mask], columns[f]), (start, end, f)
+                    if compression is None and mask.any():
+                        assert isinstance(columns['reads_all'], np.memmap)
+        finally:
+            shutil.rmtree(tmp)
+
+
+def test_write_bigwig():
+    try:
+        import pyBigWig
+    except ImportError:
+        raise SkipTest('pyBigWig not installed')
+    for field, kwargs in (('reads_all', {'pad': True}),
+                          ('reads_rev', {'chrom': 'Pf3D7_02_v3', 'start': 1000, 'end': 20000,
+                                         'one_based': True})):
+        debug((field, kwargs))
+        expect = pysamstats.load_coverage_strand(Samfile('fixture/test.bam'), **kwargs)
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'out.bw')
+            write_bigwig('coverage_strand', path, Samfile('fixture/test.bam'),
+                         fields=[field], **kwargs)
+            bw = pyBigWig.open(path)
+            try:
+                for chrom in sorted(set(expect['chrom'].astype(str))):
+                    e = expect[expect['chrom'] == chrom.encode('ascii')]
+                    pos = e['pos'] - (1 if kwargs.get('one_based') else 0)
+                    values = bw.values(chrom, 0, int(pos[-1]) + 1, numpy=True)
+                    assert np.array_equal(e[field], values[pos]), chrom
+                    # neighbouring positions with equal values are merged
+                    breaks = (np.diff(e[field]) != 0) | (np.diff(pos) != 1)
+                    eq_(np.count_nonzero(breaks) + 1, len(bw.intervals(chrom)))
+                # zoom level summaries agree with the data for aligned bins
+                assert bw.header()['nLevels'] > 0
+                for stat in 'mean', 'min', 'max', 'coverage':
+                    assert np.allclose(bw.stats('Pf3D7_02_v3', 2048, 10240, type=stat, nBins=4),
+                                       bw.stats('Pf3D7_02_v3', 2048, 10240, type=stat, nBins=4,
+                                                exact=True)), stat
+            finally:
+                bw.close()
+        finally:
+            shutil.rmtree(tmp)
@@ -10,7 +10,8 @@ import numpy as np
 from numpy import around as round
 
 
-from .util import normalise_coords, fwd, rev, pp, mean, std, rms, vmax, compare_iterators
+from .util import normalise_coords, fwd, rev, pp, mean, std, rms, vmax, compare_iterators, \
+    pileup
 import pysamstats
 
 
@@ -78,8 +79,7 @@ def stat_coverage_refimpl(samfile, chrom=None, start=None, end=None, one_based=F
                           min_baseq=0, no_del=False, no_dup=False):
 
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -95,8 +95,7 @@ def stat_coverage_strand_refimpl(samfile, chrom=None, start=None, end=None,
                                  one_based=False, min_mapq=0, min_baseq=0, no_del=False,
                                  no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -116,8 +115,7 @@ def test_stat_coverage_strand():
 def stat_coverage_ext_refimpl(samfile, chrom=None, start=None, end=None, one_based=False,
                               min_mapq=0, min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -165,8 +163,7 @@ def test_stat_coverage_ext():
 def stat_coverage_ext_strand_refimpl(samfile, chrom=None, start=None, end=None, one_based=False,
                                      min_mapq=0, min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -232,8 +229,7 @@ def test_stat_coverage_ext_strand():
 def stat_variation_refimpl(samfile, fafile, chrom=None, start=None, end=None, one_based=False,
                            min_mapq=0, min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -313,8 +309,7 @@ def stat_variation_strand_refimpl(samfile, fafile, chrom=None, start=None, end=N
                                   one_based=False, min_mapq=0, min_baseq=0, no_del=False,
                                   no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -417,8 +412,7 @@ def test_stat_variation_strand_rna():
 def stat_tlen_refimpl(samfile, chrom=None, start=None, end=None, one_based=False, min_mapq=0,
                       min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -450,8 +444,7 @@ def test_stat_tlen():
 def stat_tlen_strand_refimpl(samfile, chrom=None, start=None, end=None, one_based=False,
                              min_mapq=0, min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -531,8 +524,7 @@ def mapq(reads):
 def stat_mapq_refimpl(samfile, chrom=None, start=None, end=None, one_based=False, min_mapq=0,
                       min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -562,8 +554,7 @@ def test_stat_mapq():
 def stat_mapq_strand_refimpl(samfile, chrom=None, start=None, end=None, one_based=False,
                              min_mapq=0, min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -641,8 +632,7 @@ def nodup(reads):
 def stat_baseq_refimpl(samfile, chrom=None, start=None, end=None, one_based=False, min_mapq=0,
                        min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -666,8 +656,7 @@ def test_stat_baseq():
 def stat_baseq_strand_refimpl(samfile, chrom=None, start=None, end=None, one_based=False,
                               min_mapq=0, min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -712,8 +701,7 @@ def test_stat_baseq_strand():
 def stat_baseq_ext_refimpl(samfile, fafile, chrom=None, start=None, end=None, one_based=False,
                            min_mapq=0, min_baseq=0, no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -760,8 +748,7 @@ def stat_baseq_ext_strand_refimpl(samfile, fafile, chrom=None, start=None, end=N
                                   one_based=False, min_mapq=0, min_baseq=0, no_del=False,
                                   no_dup=False):
     start, end = normalise_coords(one_based, start, end)
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -860,8 +847,7 @@ def stat_coverage_gc_refimpl(samfile, fafile, chrom=None, start=None, end=None,
                              no_del=False, no_dup=False):
     start, end = normalise_coords(one_based, start, end)
 
-    for col in samfile.pileup(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
-                              min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True):
+    for col in pileup(samfile, chrom, start, end, min_mapq, no_dup):
         chrom = samfile.getrname(col.tid)
         pos = col.pos + 1 if one_based else col.pos
         reads = filter_reads(col.pileups, min_mapq, min_baseq, no_del, no_dup)
@@ -1082,6 +1068,16 @@ def test_load_cov_long_contig_name():
     assert 10 == x.dtype["chrom"].itemsize
 
 
+def test_load_cov_whole_file():
+    # the array is not allocated at the length of the genome unless padded
+    x = pysamstats.load_coverage(Samfile('fixture/longcontignames.bam'))
+    eq_(102303, len(x))
+    eq_(len(list(pysamstats.stat_coverage(Samfile('fixture/longcontignames.bam')))), len(x))
+    x = pysamstats.load_mapq_binned(Samfile('fixture/longcontignames.bam'))
+    eq_(len(list(pysamstats.stat_mapq_binned(Samfile('fixture/longcontignames.bam')))),
+        len(x))
+
+
 def test_load_cov_using_steppers():
 
     # test that expected steppers give different/consistent results
@@ -1100,3 +1096,177 @@ def test_load_cov_using_steppers():
 
     with assert_raises(ValueError):
         pysamstats.load_coverage(Samfile(bampath), chrom=seq, stepper="notastepper")
+
+
+def test_pileup_batches():
+    kwargs = {'chrom': 'Pf3D7_01_v3',
+              'start': 0,
+              'end': 2000,
+              'one_based': False}
+    for pad in False, True:
+        for f, needs_ref in pileup_functions:
+            debug(f.__name__)
+            stat_f = getattr(pysamstats, f.__name__.replace('load_', 'stat_'))
+            if needs_ref:
+                expect = f(Samfile('fixture/test.bam'), Fastafile('fixture/ref.fa'), pad=pad,
+                           **kwargs)
+                batches = list(stat_f(Samfile('fixture/test.bam'), Fastafile('fixture/ref.fa'),
+                                      pad=pad, batch_size=100, **kwargs))
+            else:
+                expect = f(Samfile('fixture/test.bam'), pad=pad, **kwargs)
+                batches = list(stat_f(Samfile('fixture/test.bam'), pad=pad, batch_size=100,
+                                      **kwargs))
+            assert all(len(b) == 100 for b in batches[:-1])
+            actual = np.concatenate(batches)
+            eq_(expect.dtype.names, actual.dtype.names)
+            for k in expect.dtype.names:
+                assert np.array_equal(expect[k], actual[k]), k
+
+
+def test_pileup_multi():
+    kwargs = {'chrom': 'Pf3D7_01_v3',
+              'start': 0,
+              'end': 2000,
+              'one_based': False}
+    types = ['coverage_ext_strand', 'variation_strand', 'mapq_strand', 'baseq_ext_strand']
+    for pad in False, True:
+        actual = pysamstats.load_pileup(types, Samfile('fixture/test.bam'),
+                                        Fastafile('fixture/ref.fa'), pad=pad, **kwargs)
+        recs = list(pysamstats.stat_pileup(types, Samfile('fixture/test.bam'),
+                                           Fastafile('fixture/ref.fa'), pad=pad, **kwargs))
+        eq_(len(actual), len(recs))
+        for k in actual.dtype.names:
+            if k not in ('chrom', 'ref'):
+                eq_(list(actual[k]), [r[k] for r in recs])
+        for t in types:
+            expect = pysamstats.load_pileup(t, Samfile('fixture/test.bam'),
+                                            Fastafile('fixture/ref.fa'), pad=pad, **kwargs)
+            for k in expect.dtype.names:
+                assert np.array_equal(expect[k], actual[k]), (t, k)
+
+
+def test_pileup_parallel():
+    for kwargs in ({'chrom': 'Pf3D7_01_v3', 'start': 100, 'end': 20000},
+                   {'chrom': 'Pf3D7_01_v3', 'start': 100, 'end': 20000, 'truncate': True,
+                    'one_based': True},
+                   {'pad': True}):
+        debug(kwargs)
+        expect = pysamstats.load_variation(Samfile('fixture/test.bam'),
+                                           Fastafile('fixture/ref.fa'), **kwargs)
+        actual = pysamstats.load_variation(Samfile('fixture/test.bam'),
+                                           Fastafile('fixture/ref.fa'), n_jobs=3, **kwargs)
+        eq_(expect.dtype, actual.dtype)
+        for k in expect.dtype.names:
+            assert np.array_equal(expect[k], actual[k]), k
+        expect = list(pysamstats.stat_coverage(Samfile('fixture/test.bam'), **kwargs))
+        actual = list(pysamstats.stat_coverage(Samfile('fixture/test.bam'), n_jobs=3, **kwargs))
+        eq_(expect, actual)
+
+
+def test_pileup_scatter():
+    for kwargs in ({'chrom': 'Pf3D7_01_v3', 'start': 100, 'end': 20000},
+                   {'chrom': 'Pf3D7_01_v3', 'start': 1000, 'end': 20000, 'pad': True},
+                   {'chrom': 'Pf3D7_01_v3', 'start': 1000, 'end': 20000, 'pad': True,
+                    'truncate': True, 'one_based': True},
+                   {'min_mapq': 20, 'no_dup': True, 'no_del': True, 'stepper': 'nofilter'}):
+        for stats_type in 'coverage', 'coverage_strand', 'coverage_ext', 'mapq', 'tlen':
+            debug((stats_type, kwargs))
+            expect = pysamstats.load_pileup(stats_type, Samfile('fixture/test.bam'), **kwargs)
+            actual = pysamstats.load_pileup(stats_type, Samfile('fixture/test.bam'),
+                                            engine='scatter', **kwargs)
+            eq_(len(expect), len(actual))
+            for k in expect.dtype.names:
+                assert np.array_equal(expect[k], actual[k]), k
+    expect = list(pysamstats.stat_coverage(Samfile('fixture/test.bam'), chrom='Pf3D7_01_v3'))
+    actual = list(pysamstats.stat_coverage(Samfile('fixture/test.bam'), chrom='Pf3D7_01_v3',
+                                           engine='scatter'))
+    eq_(expect, actual)
+    with assert_raises(ValueError):
+        pysamstats.load_variation(Samfile('fixture/test.bam'), Fastafile('fixture/ref.fa'),
+                                  engine='scatter')
+    with assert_raises(ValueError):
+        pysamstats.load_coverage(Samfile('fixture/test.bam'), engine='scatter', min_baseq=17)
+
+
+def test_pileup_regions():
+    regions = [('Pf3D7_02_v3', 5000, 6000), ('Pf3D7_01_v3', 2000, 3000),
+               ('Pf3D7_01_v3', 1000, 1500), ('Pf3D7_01_v3', 1400, 1800)]
+    merged = [('Pf3D7_01_v3', 1000, 1800), ('Pf3D7_01_v3', 2000, 3000),
+              ('Pf3D7_02_v3', 5000, 6000)]
+    for kwargs in ({'truncate': True}, {'truncate': True, 'pad': True}):
+        debug(kwargs)
+        expect = list()
+        for chrom, start, end in merged:
+            expect.extend(pysamstats.stat_coverage(Samfile('fixture/test.bam'), chrom=chrom,
+                                                   start=start, end=end, **kwargs))
+        actual = list(pysamstats.stat_coverage(Samfile('fixture/test.bam'), regions=regions,
+                                               **kwargs))
+        eq_(expect, actual)
+        a = pysamstats.load_coverage(Samfile('fixture/test.bam'), regions=regions, **kwargs)
+        eq_([rec['pos'] for rec in expect], list(a['pos']))
+        eq_([rec['reads_all'] for rec in expect], list(a['reads_all']))
+    # records between untruncated regions come from the preceding region
+    recs = list(pysamstats.stat_coverage(Samfile('fixture/test.bam'), regions=regions))
+    pos = [(rec['chrom'], rec['pos']) for rec in recs]
+    eq_(sorted(set(pos)), pos)
+    expect = list(pysamstats.stat_coverage(Samfile('fixture/test.bam'), chrom='Pf3D7_01_v3',
+                                           start=1000, end=1800))
+    eq_([rec for rec in expect if rec['pos'] < 2000],
+        [rec for rec in recs if rec['chrom'] == 'Pf3D7_01_v3' and rec['pos'] < 2000])
+
+
+def test_pileup_fields():
+    kwargs = {'chrom': 'Pf3D7_01_v3', 'start': 1000, 'end': 20000, 'pad': True}
+    for stats_type, fields in (('variation_strand', ['pos', 'mismatches_pp']),
+                               ('variation', ['reads_all', 'deletions']),
+                               ('baseq_ext_strand', ['chrom', 'pos', 'rms_baseq_pp']),
+                               ('coverage_ext_strand', ['reads_softclipped_fwd']),
+                               ('tlen', ['reads_pp', 'std_tlen']),
+                               ('tlen_strand', ['mean_tlen_rev', 'std_tlen_pp_fwd']),
+                               ('mapq', ['rms_mapq']),
+                               ('mapq_strand', ['reads_mapq0_pp_rev', 'max_mapq_fwd']),
+                               ('baseq', ['reads_pp']),
+                               ('baseq_strand', ['rms_baseq_rev', 'reads_pp']),
+                               (['coverage_ext', 'variation'], ['reads_faceaway', 'A_pp'])):
+        debug((stats_type, fields))
+        expect = pysamstats.load_pileup(stats_type, Samfile('fixture/test.bam'),
+                                        Fastafile('fixture/ref.fa'), **kwargs)
+        actual = pysamstats.load_pileup(stats_type, Samfile('fixture/test.bam'),
+                                        Fastafile('fixture/ref.fa'), fields=fields, **kwargs)
+        for f in fields:
+            assert np.array_equal(expect[f], actual[f] if len(fields) > 1 else actual), f
+        recs = pysamstats.stat_pileup(stats_type, Samfile('fixture/test.bam'),
+                                      Fastafile('fixture/ref.fa'), fields=fields, **kwargs)
+        eq_(set(fields) | {'chrom', 'pos'}, set(next(iter(recs))))
+
+
+def test_pileup_tuples():
+    kwargs = {'chrom': 'Pf3D7_01_v3', 'start': 1000, 'end': 20000, 'pad': True}
+    for stats_type, fields in (('variation', None),
+                               ('baseq_ext_strand', None),
+                               ('coverage_ext', ['reads_faceaway', 'pos', 'reads_pp'])):
+        debug((stats_type, fields))
+        # fields in dtype order, including chrom and pos
+        names = [f for f, _ in getattr(pysamstats.config, 'dtype_' + stats_type)
+                 if fields is None or f in fields or f == 'chrom']
+        expect = [tuple(rec[f] for f in names) for rec in
+                  pysamstats.stat_pileup(stats_type, Samfile('fixture/test.bam'),
+                                         Fastafile('fixture/ref.fa'), fields=fields, **kwargs)]
+        actual = list(pysamstats.stat_pileup(stats_type, Samfile('fixture/test.bam'),
+                                             Fastafile('fixture/ref.fa'), fields=fields,
+                                             record_type='tuple', **kwargs))
+        eq_(expect, actual)
+
+
+def test_pileup_flags():
+    # reads are filtered by flag before they enter the pileup
+    kwargs = {'chrom': 'Pf3D7_01_v3', 'start': 1000, 'end': 20000, 'pad': True}
+    expect = pysamstats.load_coverage_strand(Samfile('fixture/test.bam'), **kwargs)
+    for engine in 'pileup', 'scatter':
+        debug(engine)
+        fwd_only = pysamstats.load_coverage(Samfile('fixture/test.bam'), flag_filter=16,
+                                            engine=engine, **kwargs)
+        assert np.array_equal(expect['reads_fwd'], fwd_only['reads_all'])
+        rev_only = pysamstats.load_coverage(Samfile('fixture/test.bam'), flag_require=16,
+                                            engine=engine, **kwargs)
+        assert np.array_equal(expect['reads_rev'], rev_only['reads_all'])
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, division
 import logging
+import os
+import shutil
 import sys
+import tempfile
 from math import sqrt
 
 
@@ -10,6 +13,7 @@ from numpy import around as round
 from nose.tools import eq_, assert_almost_equal
 
 
+import pysam
 from pysam import Samfile, Fastafile
 
 
@@ -51,6 +55,30 @@ def compare_iterators(expected, actual):
                 raise
 
 
+def pileup(samfile, chrom, start, end, min_mapq=0, no_dup=False):
+    """Pileup columns without read filters, except reads failing `min_mapq` or
+    `no_dup`, which are removed before the pileup."""
+    kwargs = dict(reference=chrom, start=start, end=end, stepper="nofilter", flag_filter=0,
+                  min_base_quality=0, min_mapping_quality=0, ignore_overlaps=True)
+    if min_mapq == 0 and not no_dup:
+        for col in samfile.pileup(**kwargs):
+            yield col
+        return
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, 'filtered.bam')
+        with Samfile(fn, 'wb', template=samfile) as out:
+            for read in samfile.fetch(chrom, start, end):
+                if read.mapq >= min_mapq and not (no_dup and read.is_duplicate):
+                    out.write(read)
+        pysam.index(fn)
+        with Samfile(fn) as filtered:
+            for col in filtered.pileup(**kwargs):
+                yield col
+    finally:
+        shutil.rmtree(tmpdir)
+
+
 def normalise_coords(one_based, start, end):
     """Normalise start and end coordinates.
 
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, division
+import gzip
 from operator import itemgetter
 from pysam import AlignmentFile
 
@@ -28,7 +29,35 @@ def flatten(recs, *fields):
     return it
 
 
-def load_stats(statfun, default_dtype, user_dtype, user_fields, **kwargs):
+def select(rows, names, *fields):
+    """Select fields from a row (tuple) iterator.
+
+    Parameters
+    ----------
+
+    rows : iterator of tuples
+        rows generator
+    names : list of strings
+        names of the items in each row
+    fields : list of strings
+        names of fields to select
+
+    Returns
+    -------
+
+    rows : iterator of tuples
+        rows generator
+
+    """
+
+    if list(fields) == list(names):
+        return rows
+    getter = itemgetter(*[names.index(f) for f in fields])
+    it = (getter(row) for row in rows)
+    return it
+
+
+def load_stats(loadfun, default_dtype, user_dtype, user_fields, **kwargs):
 
     import numpy as np
 
@@ -42,14 +71,7 @@ def load_stats(statfun, default_dtype, user_dtype, user_fields, **kwargs):
             raise ValueError('invalid fields: %r' % fields)
 
     # determine dtype
-    dtype = dict(default_dtype)
-
-    # check if contig label dtype is appropriate length
-    max_seqid_len = determine_max_seqid(kwargs["alignmentfile"])
-    dtype["chrom"] = "a{0}".format(max_seqid_len)
-
-    if user_dtype is not None:
-        dtype.update(dict(user_dtype))
+    dtype = dict(determine_dtype(default_dtype, kwargs["alignmentfile"], user_dtype))
 
     # handle single field requested
     if len(fields) == 1:
@@ -57,14 +79,8 @@ def load_stats(statfun, default_dtype, user_dtype, user_fields, **kwargs):
     else:
         dtype = [(f, dtype[f]) for f in fields]
 
-    # setup record generator
-    recs = statfun(**kwargs)
-
-    # flatten records
-    it = flatten(recs, *fields)
-
-    # load into a Numpy array
-    a = np.fromiter(it, dtype=dtype)
+    # load directly into a Numpy array
+    a = loadfun(dtype=dtype, fields=fields, **kwargs)
 
     # view as recarray for convenience
     if len(fields) > 1:
@@ -73,9 +89,97 @@ def load_stats(statfun, default_dtype, user_dtype, user_fields, **kwargs):
     return a
 
 
+def determine_dtype(default_dtype, alignmentfile, user_dtype=None):
+    """Determine the dtype for all fields of a statistics type.
+
+    Parameters
+    ----------
+
+    default_dtype : list of tuples
+        default dtype for the statistics type, from pysamstats.config
+    alignmentfile : pysam.AlignmentFile or string
+        SAM or BAM file or file path, used to size the chrom field
+    user_dtype : dict, optional
+        overrides for individual fields
+
+    Returns
+    -------
+
+    dtype : list of tuples
+        dtype with fields in the default order
+
+    """
+
+    dtype = dict(default_dtype)
+
+    # check if contig label dtype is appropriate length
+    max_seqid_len = determine_max_seqid(alignmentfile)
+    dtype["chrom"] = "a{0}".format(max_seqid_len)
+
+    if user_dtype is not None:
+        dtype.update(dict(user_dtype))
+
+    return [(f, dtype[f]) for f, _ in default_dtype]
+
+
+def merge_dtypes(dtypes):
+    """Merge the dtypes of several statistics types computed in a single pass.
+
+    Parameters
+    ----------
+
+    dtypes : list of lists of tuples
+        default dtypes for the statistics types, from pysamstats.config
+
+    Returns
+    -------
+
+    dtype : list of tuples
+        dtype with fields in order of first occurrence
+
+    """
+
+    merged = list()
+    seen = set()
+    for dtype in dtypes:
+        for f, t in dtype:
+            if f not in seen:
+                merged.append((f, t))
+                seen.add(f)
+    return merged
+
+
 def determine_max_seqid(alignmentfile):
 
     if isinstance(alignmentfile, str):
         alignmentfile = AlignmentFile(alignmentfile)
 
     return max([len(x) for x in alignmentfile.references])
+
+
+def read_bed(path):
+    """Read regions from a BED file.
+
+    Parameters
+    ----------
+
+    path : string
+        path to a BED file, optionally gzip compressed
+
+    Returns
+    -------
+
+    regions : list of tuples
+        (chrom, start, end) tuples in zero-based coordinates, in file order
+
+    """
+
+    opener = gzip.open if path.endswith('.gz') else open
+    regions = list()
+    with opener(path, 'rt') as f:
+        for line in f:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split()
+            regions.append((fields[0], int(fields[1]), int(fields[2])))
+    return regions
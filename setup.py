@@ -7,7 +7,7 @@ try:
 except ImportError:
     raise Exception('pysam not found; please install pysam first')
 from distutils.version import LooseVersion
-required_pysam_version = '0.15'
+required_pysam_version = '0.22'
 if LooseVersion(pysam.__version__) < LooseVersion(required_pysam_version):
     raise Exception('pysam version >= %s is required; found %s' %
                     (required_pysam_version, pysam.__version__))
@@ -30,7 +30,8 @@ try:
         Extension('pysamstats.opt',
                   sources=['pysamstats/opt.pyx'],
                   include_dirs=pysam.get_include(),
-                  define_macros=pysam.get_defines())]
+                  define_macros=pysam.get_defines(),
+                  extra_link_args=pysam.get_libraries())]
     )
 
 except ImportError:
@@ -38,7 +39,8 @@ except ImportError:
     extensions = [Extension('pysamstats.opt',
                             sources=['pysamstats/opt.c'],
                             include_dirs=pysam.get_include(),
-                            define_macros=pysam.get_defines())]
+                            define_macros=pysam.get_defines(),
+                            extra_link_args=pysam.get_libraries())]
 
 
 setup(
@@ -53,18 +55,18 @@ setup(
                 'BAM or CRAM file.',
     scripts=['scripts/pysamstats'],
     package_dir={'': '.'},
+    python_requires='>=3.9',
     install_requires=[
-        "pysam (<0.16)",
+        "pysam (>=0.22)",
         "numpy",
     ],
     packages=find_packages(),
     classifiers=[
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Software Development :: Libraries :: Python Modules'
     ],
     ext_modules=extensions,